@@ -1,3 +1,5 @@
+import os
+import tempfile
 from typing import List
 
 CLAIMS_REQUIRED_COLUMNS = {"claim_id", "patient_id", "date_of_service", "charges_amount"}
@@ -5,3 +7,78 @@ INVOICES_REQUIRED_COLUMNS = {"invoice_id", "claim_id", "transaction_value"}
 
 # allowed CORS origins while developing (update for production)
 CORS_ORIGINS: List[str] = ["*"]
+
+# reconciliation engine: "columnar" (pandas/NumPy, default) or "python" (per-claim loop)
+RECONCILIATION_ENGINE: str = os.getenv("RECONCILIATION_ENGINE", "columnar")
+
+# rows parsed per CSV chunk during upload; bounds the parser's working memory
+CSV_CHUNK_ROWS: int = int(os.getenv("CSV_CHUNK_ROWS", "100000"))
+# cap on rejected-row messages kept per uploaded file
+CSV_MAX_REPORTED_ERRORS: int = int(os.getenv("CSV_MAX_REPORTED_ERRORS", "100"))
+# threads parsing the files of a multi-file upload side by side
+INGEST_WORKERS: int = int(os.getenv("INGEST_WORKERS", str(min(8, os.cpu_count() or 1))))
+
+# rows formatted per chunk when streaming /api/reconciliation/export
+EXPORT_BATCH_ROWS: int = int(os.getenv("EXPORT_BATCH_ROWS", "10000"))
+# pre-rendered JSON bodies (first result pages, summaries) kept per dataset version
+RENDER_CACHE_MB: int = int(os.getenv("RENDER_CACHE_MB", "32"))
+# JSON bodies at least this large are gzip/brotli-compressed when the client accepts it
+COMPRESS_MIN_BYTES: int = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+
+# log line format: "text" or "json" (one object per line, stage timings as fields)
+LOG_FORMAT: str = os.getenv("LOG_FORMAT", "text")
+# opt-in request profiling: requests sent with an X-Profile header are sampled and their
+# collapsed stacks written here; empty disables it
+PROFILE_DIR: str = os.getenv("PROFILE_DIR", "")
+# interval between stack samples of a profiled request
+PROFILE_INTERVAL_MS: float = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+
+# finished upload jobs kept for /api/jobs/{id}
+JOB_HISTORY: int = int(os.getenv("JOB_HISTORY", "100"))
+
+# worker processes for a full reconcile; 1 reconciles in-process
+RECONCILE_WORKERS: int = int(os.getenv("RECONCILE_WORKERS", "1"))
+# below this many claims a reconcile stays in-process even with several workers
+RECONCILE_SHARD_MIN_ROWS: int = int(os.getenv("RECONCILE_SHARD_MIN_ROWS", "200000"))
+
+# published versions per dataset kept for /api/reconciliation/diff; each kept full reconcile
+# costs about 20 bytes per claim, an upsert only its touched claims
+DIFF_HISTORY: int = int(os.getenv("DIFF_HISTORY", "8"))
+
+# on-disk snapshots of the loaded dataset (memory-mapped on startup); empty disables them
+SNAPSHOT_DIR: str = os.getenv("SNAPSHOT_DIR", "")
+# completed snapshots kept besides the latest one
+SNAPSHOT_KEEP: int = int(os.getenv("SNAPSHOT_KEEP", "1"))
+# upserts are appended to the latest snapshot as delta segments, replayed on load; past this
+# many segments the next save writes a full snapshot instead
+SNAPSHOT_MAX_DELTAS: int = int(os.getenv("SNAPSHOT_MAX_DELTAS", "16"))
+
+# dataset storage: "memory" (columnar arrays, snapshotted to disk) or "sqlite" (on-disk
+# database per dataset, for datasets larger than RAM)
+STORAGE_BACKEND: str = os.getenv("STORAGE_BACKEND", "memory")
+# SQLite page cache per connection with STORAGE_BACKEND=sqlite; bounds its resident memory
+SQLITE_CACHE_MB: int = int(os.getenv("SQLITE_CACHE_MB", "64"))
+
+# summary aggregates: "exact" (per-patient sums) or "sketch" (bounded-memory quantile and
+# heavy-hitter sketches, adding charge/invoice/credit percentiles)
+ANALYTICS_MODE: str = os.getenv("ANALYTICS_MODE", "exact")
+# relative error of every percentile reported in sketch mode
+SKETCH_RELATIVE_ERROR: float = float(os.getenv("SKETCH_RELATIVE_ERROR", "0.01"))
+# counters per top-patient sketch; a listed count is low by at most total / (counters + 1)
+SKETCH_COUNTERS: int = int(os.getenv("SKETCH_COUNTERS", "200"))
+
+# named datasets: resident ones are kept within this budget, least recently used spill to disk
+DATASET_MEMORY_BUDGET_MB: int = int(os.getenv("DATASET_MEMORY_BUDGET_MB", "2048"))
+# where datasets spill (and snapshot, when SNAPSHOT_DIR is set), one directory per dataset
+DATASET_DIR: str = os.getenv("DATASET_DIR") or SNAPSHOT_DIR or os.path.join(tempfile.gettempdir(), "claims-datasets")
+DEFAULT_DATASET: str = "default"
+# the uploaded patient directory (memory-mapped, shared by every dataset); until one is
+# uploaded, names come from app/data/patients.csv
+PATIENT_DIR: str = os.getenv("PATIENT_DIR") or os.path.join(DATASET_DIR, ".patients")
+DATASET_NAME_PATTERN: str = r"^[A-Za-z0-9_-]{1,64}$"
+
+# several API worker processes share datasets through DATASET_DIR: every upload is
+# snapshotted there and each worker maps the newest snapshot in the background
+SHARED_STORE: bool = os.getenv("SHARED_STORE", "0").lower() in ("1", "true", "yes")
+# how often a shared-store worker looks for other workers' publishes
+SHARED_REFRESH_SECONDS: float = float(os.getenv("SHARED_REFRESH_SECONDS", "1"))
@@ -1,99 +1,247 @@
-import random
-import csv
+"""
+Synthetic claims, invoices and patients CSVs, at any scale.
+
+    python generate_data.py [--claims 10m] [--patients 200k] [--seed 42] [--balance-ratio 0.25]
+                            [--orphan-rate 0.01] [--date-from 2020-01-01] [--date-to 2024-12-31]
+                            [--rows-per-file 5m] [--gzip] [--output-dir DIR]
+
+Rows are generated in vectorized batches (--batch-size claims at a time)
+and formatted to CSV bytes with NumPy, then streamed to disk, so memory use
+stays flat whatever the row count. Output goes to --output-dir, else
+$HOST_OUTPUT_DIR, else this script's folder. With --rows-per-file the
+claims and invoices are split into numbered files (claims-00000.csv, ...),
+each with its header; --gzip compresses them (.csv.gz).
+
+patients.csv names every patient id the claims use. Each claim gets 0 to
+--max-invoices invoices; a --balance-ratio share of claims instead gets one
+invoice for exactly its charges, and an --orphan-rate share of invoices
+points at claim ids that do not exist. The same seed and batch size always
+produce the same files.
+"""
+import argparse
+import gzip
 import logging
 import os
+from datetime import date
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
 from faker import Faker
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.StreamHandler()]
-)
-
-fake = Faker()
-
-def generate_patients(n=2000):
-    logging.info(f"Generating {n} patients...")
-    patients = [{"patient_id": i, "name": fake.name()} for i in range(1, n+1)]
-    logging.info(f"Generated {len(patients)} patients.")
-    return patients
-
-def generate_claims(patients):
-    logging.info("Generating claims for patients...")
-    claims = []
-    for p in patients:
-        for _ in range(random.randint(10, 100)):
-            claims.append({
-                "claim_id": fake.uuid4(),
-                "patient_id": p["patient_id"],
-                "date_of_service": fake.date_this_decade().isoformat(),
-                "charges_amount": random.randint(100, 5000),
-            })
-    logging.info(f"Generated {len(claims)} claims.")
-    return claims
-
-def generate_invoices(claims, balance_ratio=0.25):
-    logging.info("Generating invoices for claims...")
-    invoices = []
-
-    # Determine balanced claims
-    num_balanced = int(len(claims) * balance_ratio)
-    balanced_claim_ids = set(c["claim_id"] for c in random.sample(claims, num_balanced))
-    logging.info(f"{num_balanced} claims will have balanced invoices.")
-
-    for c in claims:
-        num_invoices = random.randint(0, 5)
-        for i in range(num_invoices):
-            if c["claim_id"] in balanced_claim_ids and i == 0:
-                invoices.append({
-                    "invoice_id": fake.uuid4(),
-                    "claim_id": c["claim_id"],
-                    "transaction_value": c["charges_amount"],
-                })
-                balanced_claim_ids.remove(c["claim_id"])
-            else:
-                invoices.append({
-                    "invoice_id": fake.uuid4(),
-                    "claim_id": c["claim_id"],
-                    "transaction_value": random.randint(-500, 5000),
-                })
-
-    logging.info(f"Generated {len(invoices)} invoices.")
-    return invoices
-
-def write_csv(filename, rows):
-    if not rows:
-        logging.warning(f"No rows to write for {filename}. Skipping.")
-        return
+COMMA, NEWLINE, MINUS = ord(","), ord("\n"), ord("-")
+NAME_POOL = 1000  # distinct first and last names combined into patient names
 
-    # Use host path if provided via environment variable, otherwise script folder
-    host_output_dir = os.environ.get("HOST_OUTPUT_DIR")
-    if host_output_dir:
-        os.makedirs(host_output_dir, exist_ok=True)
-        filepath = os.path.join(host_output_dir, filename)
-    else:
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        filepath = os.path.join(script_dir, filename)
 
-    try:
-        with open(filepath, "w", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=rows[0].keys())
-            writer.writeheader()
-            writer.writerows(rows)
-        logging.info(f"Wrote {len(rows)} rows to {filepath}.")
-    except Exception as e:
-        logging.error(f"Error writing {filename}: {e}")
+def parse_count(text: str) -> int:
+    """"2500", "10k", "1.5m" -> int."""
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(text[-1].lower(), 1)
+    return int(float(text[:-1] if multiplier > 1 else text) * multiplier)
 
-if __name__ == "__main__":
+
+def uuid4s(rng: np.random.Generator, n: int) -> np.ndarray:
+    """n random version-4 UUIDs as an (n, 36) array of ASCII bytes."""
+    raw = rng.integers(0, 256, (n, 16), dtype=np.uint8)
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80
+    hexed = np.frombuffer(raw.tobytes().hex().encode("ascii"), dtype=np.uint8).reshape(n, 32)
+    out = np.full((n, 36), MINUS, dtype=np.uint8)
+    out[:, [i for i in range(36) if i not in (8, 13, 18, 23)]] = hexed
+    return out
+
+
+def digits(values: np.ndarray, width: int) -> np.ndarray:
+    """Decimal digits of integers as an (n, width + 1) byte array: optional '-', digits, then 0 padding."""
+    values = np.asarray(values, dtype=np.int64)
+    magnitude = np.abs(values)
+    n_digits = np.floor(np.log10(np.maximum(magnitude, 1))).astype(np.int64) + 1
+    negative = values < 0
+    out = np.zeros((len(values), width + 1), dtype=np.uint8)
+    out[negative, 0] = MINUS
+    rows = np.arange(len(values))
+    last = n_digits - 1 + negative  # column of the units digit
+    for place in range(width):
+        column = last - place
+        live = column >= negative
+        out[rows[live], column[live]] = magnitude[live] % 10 + ord("0")
+        magnitude //= 10
+    return out
+
+
+def padded(values: np.ndarray, width: int) -> np.ndarray:
+    """Non-negative integers as zero-padded (n, width) digits."""
+    values = np.asarray(values, dtype=np.int64)
+    places = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    return (values[:, None] // places % 10 + ord("0")).astype(np.uint8)
+
+
+def iso_dates(days: np.ndarray) -> np.ndarray:
+    """datetime64[D] values as (n, 10) YYYY-MM-DD bytes."""
+    years = days.astype("datetime64[Y]")
+    months = days.astype("datetime64[M]")
+    dash = np.full((len(days), 1), MINUS, dtype=np.uint8)
+    return np.hstack([
+        padded(years.astype(np.int64) + 1970, 4), dash,
+        padded(months.astype(np.int64) % 12 + 1, 2), dash,
+        padded((days - months).astype(np.int64) + 1, 2),
+    ])
+
+
+def csv_lines(columns: List[np.ndarray]):
+    """
+    CSV bytes of rows whose fields are given as byte arrays (0 bytes are padding
+    and dropped), and the end offset of each row in them.
+    """
+    n = len(columns[0])
+    comma = np.full((n, 1), COMMA, dtype=np.uint8)
+    parts = []
+    for column in columns:
+        parts += [column, comma]
+    parts[-1] = np.full((n, 1), NEWLINE, dtype=np.uint8)
+    matrix = np.hstack(parts)
+    keep = matrix != 0
+    return matrix[keep].tobytes(), np.cumsum(keep.sum(axis=1))
+
+
+class CsvSink:
+    """Rows written to `stem`.csv(.gz), or to numbered files of at most rows_per_file rows each."""
+
+    def __init__(self, directory: Path, stem: str, header: str, rows_per_file: int = 0, compress: bool = False):
+        self.directory, self.stem, self.header = directory, stem, header.encode("ascii") + b"\n"
+        self.rows_per_file = rows_per_file
+        self.compress = compress
+        self.paths: List[Path] = []
+        self.rows = 0
+        self._file = None
+        self._room = 0
+
+    def _next_file(self):
+        self.close()
+        suffix = ".csv.gz" if self.compress else ".csv"
+        name = f"{self.stem}-{len(self.paths):05d}{suffix}" if self.rows_per_file else f"{self.stem}{suffix}"
+        path = self.directory / name
+        # level 1: several times faster than the default and most of its size reduction
+        self._file = gzip.open(path, "wb", compresslevel=1) if self.compress else open(path, "wb")
+        self._file.write(self.header)
+        self.paths.append(path)
+        self._room = self.rows_per_file or -1
+
+    def write(self, data: bytes, ends: np.ndarray):
+        start_row, start_byte = 0, 0
+        if self._file is None:
+            self._next_file()
+        while start_row < len(ends):
+            if self._room == 0:
+                self._next_file()
+            take = len(ends) - start_row if self._room < 0 else min(self._room, len(ends) - start_row)
+            end_byte = int(ends[start_row + take - 1])
+            self._file.write(data[start_byte:end_byte])
+            start_row, start_byte = start_row + take, end_byte
+            if self._room > 0:
+                self._room -= take
+        self.rows += len(ends)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def write_patients(directory: Path, n_patients: int, seed: int) -> Path:
+    """patients.csv for ids 1..n_patients; names combine a seeded pool of first and last names."""
+    Faker.seed(seed)
+    fake = Faker()
+    first = np.array([fake.first_name() for _ in range(NAME_POOL)], dtype=object)
+    last = np.array([fake.last_name() for _ in range(NAME_POOL)], dtype=object)
+    rng = np.random.default_rng([seed, 0xFACE])
+    path = directory / "patients.csv"
+    with open(path, "w", newline="") as f:
+        f.write("patient_id,name\n")
+        for start in range(1, n_patients + 1, 1_000_000):
+            ids = range(start, min(start + 1_000_000, n_patients + 1))
+            names = first[rng.integers(0, NAME_POOL, len(ids))] + " " + last[rng.integers(0, NAME_POOL, len(ids))]
+            f.write("".join(f"{i},{name}\n" for i, name in zip(ids, names)))
+    return path
+
+
+def generate(directory: Path, n_claims: int, n_patients: Optional[int] = None, seed: int = 42,
+             balance_ratio: float = 0.25, orphan_rate: float = 0.0, date_from: date = date(2020, 1, 1),
+             date_to: date = date(2024, 12, 31), max_invoices: int = 5, batch_size: int = 100_000,
+             rows_per_file: int = 0, compress: bool = False) -> Dict:
+    """Write patients, claims and invoices CSVs under `directory`; returns row counts and file paths."""
+    directory.mkdir(parents=True, exist_ok=True)
+    n_patients = n_patients or max(1, n_claims // 55)
+    first_day = np.datetime64(date_from, "D")
+    n_days = (np.datetime64(date_to, "D") - first_day).astype(np.int64) + 1
+    if n_days <= 0:
+        raise ValueError("date_to must not be before date_from")
+
+    patients = write_patients(directory, n_patients, seed)
+    claims = CsvSink(directory, "claims", "claim_id,patient_id,date_of_service,charges_amount",
+                     rows_per_file, compress)
+    invoices = CsvSink(directory, "invoices", "invoice_id,claim_id,transaction_value", rows_per_file, compress)
     try:
-        patients = generate_patients()
-        claims = generate_claims(patients)
-        invoices = generate_invoices(claims, balance_ratio=0.25)
+        for batch, start in enumerate(range(0, n_claims, batch_size)):
+            n = min(batch_size, n_claims - start)
+            rng = np.random.default_rng([seed, batch])
+            claim_ids = uuid4s(rng, n)
+            charges = rng.integers(100, 5001, n)
+            claims.write(*csv_lines([
+                claim_ids, digits(rng.integers(1, n_patients + 1, n), 10),
+                iso_dates(first_day + rng.integers(0, n_days, n)), digits(charges, 10),
+            ]))
 
-        write_csv("claims.csv", claims)
-        write_csv("invoices.csv", invoices)
+            counts = rng.integers(0, max_invoices + 1, n)
+            balanced = rng.random(n) < balance_ratio
+            counts[balanced] = 1
+            owner = np.repeat(np.arange(n), counts)
+            values = rng.integers(-500, 5001, len(owner))
+            values[np.cumsum(counts)[balanced] - 1] = charges[balanced]
+            invoice_claims = claim_ids[owner]
+            orphans = rng.random(len(owner)) < orphan_rate
+            invoice_claims[orphans] = uuid4s(rng, int(orphans.sum()))
+            invoices.write(*csv_lines([uuid4s(rng, len(owner)), invoice_claims, digits(values, 10)]))
+            logging.info("batch %d: %d claims, %d invoices written", batch, claims.rows, invoices.rows)
+    finally:
+        claims.close()
+        invoices.close()
+    return {"patients": n_patients, "claims": claims.rows, "invoices": invoices.rows,
+            "files": [patients] + claims.paths + invoices.paths}
 
-        logging.info("Sample data generation complete.")
-    except Exception as e:
-        logging.exception(f"An error occurred: {e}")
+
+def output_dir() -> Path:
+    # Use host path if provided via environment variable, otherwise script folder
+    return Path(os.environ.get("HOST_OUTPUT_DIR") or Path(__file__).resolve().parent)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--claims", type=parse_count, default=110_000, help="number of claims, e.g. 500k, 10m")
+    parser.add_argument("--patients", type=parse_count, default=None, help="default: one per 55 claims")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--balance-ratio", type=float, default=0.25)
+    parser.add_argument("--orphan-rate", type=float, default=0.0, help="share of invoices without a claim")
+    parser.add_argument("--max-invoices", type=int, default=5, help="per claim")
+    parser.add_argument("--date-from", type=date.fromisoformat, default=date(2020, 1, 1))
+    parser.add_argument("--date-to", type=date.fromisoformat, default=date(2024, 12, 31))
+    parser.add_argument("--batch-size", type=parse_count, default=100_000, help="claims generated at a time")
+    parser.add_argument("--rows-per-file", type=parse_count, default=0, help="split output files; 0 = one each")
+    parser.add_argument("--gzip", action="store_true", help="write .csv.gz")
+    parser.add_argument("--output-dir", type=Path, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s",
+                        handlers=[logging.StreamHandler()])
+    written = generate(
+        args.output_dir or output_dir(), args.claims, args.patients, args.seed, args.balance_ratio,
+        args.orphan_rate, args.date_from, args.date_to, args.max_invoices, args.batch_size,
+        args.rows_per_file, args.gzip,
+    )
+    for path in written["files"]:
+        logging.info("wrote %s", path)
+    logging.info("Sample data generation complete: %d patients, %d claims, %d invoices.",
+                 written["patients"], written["claims"], written["invoices"])
+
+
+if __name__ == "__main__":
+    main()
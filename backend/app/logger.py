@@ -1,14 +1,37 @@
+import json
 import logging
 import sys
 
+from app.config import LOG_FORMAT
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; key=value fields passed as extra={"fields": {...}} become top-level keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
 def get_logger(name: str) -> logging.Logger:
     logger = logging.getLogger(name)
     if logger.handlers:
         return logger
 
     handler = logging.StreamHandler(sys.stdout)
-    fmt = "%(asctime)s %(levelname)s %(name)s %(message)s"
-    formatter = logging.Formatter(fmt)
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        fmt = "%(asctime)s %(levelname)s %(name)s %(message)s"
+        formatter = logging.Formatter(fmt)
     handler.setFormatter(formatter)
 
     logger.setLevel(logging.INFO)
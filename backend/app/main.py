@@ -1,11 +1,32 @@
-from fastapi import FastAPI
-from app.routes import upload, reconciliation, summary
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from app.routes import upload, reconciliation, summary, jobs, datasets, metrics as metrics_route
 from fastapi.middleware.cors import CORSMiddleware
-from app.config import CORS_ORIGINS
+from app.config import CORS_ORIGINS, DEFAULT_DATASET, PROFILE_DIR
 from app.logger import get_logger
+from app.utils.metrics import metrics
+from app.utils.profiler import SamplingProfiler
+
+
+logger = get_logger(__name__)
 
 
-app = FastAPI(title="Claims Reconciliation API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # memory-map the default dataset's last snapshot instead of waiting for a re-upload;
+    # other datasets are mapped on first use
+    service = upload.get_datasets().get(DEFAULT_DATASET, create=True)
+    if service.version:
+        logger.info("restored dataset %s version %d from snapshot", DEFAULT_DATASET, service.version)
+    upload.get_datasets().start_watcher()  # shared store: pick up other workers' publishes
+    yield
+    upload.get_datasets().stop_watcher()
+    upload.get_datasets().drain()  # let spills in flight finish writing
+
+
+app = FastAPI(title="Claims Reconciliation API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -15,9 +36,54 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+def _route_template(request: Request) -> str:
+    """The request path with path parameters put back as {name}, so each route is one label value."""
+    if request.scope.get("route") is None:
+        return "unmatched"
+    names = {value: name for name, value in request.path_params.items()}
+    return "/".join("{%s}" % names[part] if part in names else part for part in request.url.path.split("/"))
+
+
+async def _profiled_body(body, profiler: SamplingProfiler, path, request: Request):
+    """The response body; the profile ends and is written once its last chunk is sent."""
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        profiler.stop()
+        profiler.write(path)
+        logger.info("profile %s %s samples=%d path=%s", request.method, request.url.path, profiler.samples, path)
+
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    """Request counts and latency per route; with PROFILE_DIR set, profile requests sent with X-Profile."""
+    start = time.perf_counter()
+    if PROFILE_DIR and request.headers.get("x-profile"):
+        profiler = SamplingProfiler().start()
+        try:
+            response = await call_next(request)
+        except BaseException:
+            profiler.stop()
+            raise
+        path = SamplingProfiler.path(PROFILE_DIR, f"{request.method}-{request.url.path}")
+        response.headers["X-Profile"] = path.name
+        response.body_iterator = _profiled_body(response.body_iterator, profiler, path, request)
+    else:
+        response = await call_next(request)
+    route = _route_template(request)
+    metrics.inc("http_requests_total", route=route, method=request.method, status=response.status_code)
+    metrics.observe("http_request_seconds", time.perf_counter() - start, route=route)
+    return response
+
+
 app.include_router(upload.router, prefix="/api")
 app.include_router(reconciliation.router, prefix="/api")
 app.include_router(summary.router, prefix="/api")
+app.include_router(jobs.router, prefix="/api")
+app.include_router(datasets.router, prefix="/api")
+app.include_router(metrics_route.router)
 
 @app.get("/health", summary="Health check")
 async def health():
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from datetime import date
 
 
@@ -19,3 +19,20 @@ class SummaryStats(BaseModel):
     overpaid: int
     underpaid: int
     no_invoices: int
+
+
+class ResultQuery(BaseModel):
+    """Filters and sort order for /api/reconciliation."""
+    status: Optional[List[str]] = None
+    patient_id: Optional[int] = None
+    patient_name: Optional[str] = None  # case-insensitive prefix
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+    min_charges: Optional[float] = None
+    max_charges: Optional[float] = None
+    min_credit: Optional[float] = None
+    max_credit: Optional[float] = None
+    sort: Optional[str] = None  # date_of_service | charges_amount | credit, "-" prefix for descending
+
+    def is_filtered(self) -> bool:
+        return any(v is not None for k, v in self if k != "sort")
@@ -0,0 +1,21 @@
+from fastapi import APIRouter
+from app.routes.upload import get_datasets, get_renders
+from app.utils.patients import get_patients
+
+router = APIRouter()
+
+@router.get("/datasets")
+async def list_datasets():
+    """
+    Known datasets: whether each is resident, its resident bytes, version and row counts;
+    plus the pre-rendered response cache's size and hit/miss counters, and the patient
+    directory's generation and size.
+    """
+    registry = get_datasets()
+    return {
+        "budget_bytes": registry.budget_bytes,
+        "resident_bytes": registry.resident_bytes(),
+        "datasets": registry.stats(),
+        "render_cache": get_renders().stats(),
+        "patients": get_patients().stats(),
+    }
@@ -0,0 +1,12 @@
+from fastapi import APIRouter, HTTPException
+from app.routes.upload import get_jobs
+
+router = APIRouter()
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status, per-stage progress and, once finished, the result or errors of an upload job."""
+    status = get_jobs().status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown job id.")
+    return status
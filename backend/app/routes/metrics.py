@@ -0,0 +1,33 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from app.routes.upload import get_datasets, get_renders
+from app.utils.metrics import metrics, peak_rss_bytes
+
+router = APIRouter()
+
+
+def _collect():
+    """Refresh the gauges whose values live elsewhere."""
+    renders = get_renders().stats()
+    metrics.set("render_cache_hits_total", renders["hits"])
+    metrics.set("render_cache_misses_total", renders["misses"])
+    metrics.set("render_cache_bytes", renders["bytes"])
+    metrics.clear("dataset_results")  # datasets spilled since the last scrape drop out
+    metrics.clear("dataset_resident_bytes")
+    for dataset in get_datasets().stats():
+        if dataset["resident"]:
+            metrics.set("dataset_results", dataset["results"], dataset=dataset["name"])
+            metrics.set("dataset_resident_bytes", dataset["resident_bytes"], dataset=dataset["name"])
+    metrics.set("process_peak_rss_bytes", peak_rss_bytes())
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Counters, gauges and latency histograms in the Prometheus text format:
+    ingest rows/bytes, pipeline and job stage durations, HTTP latency per route,
+    render cache hits, result counts per dataset and peak RSS.
+    """
+    _collect()
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
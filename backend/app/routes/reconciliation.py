@@ -1,22 +1,163 @@
-from fastapi import APIRouter
-from app.routes.upload import get_service
+from datetime import date
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from app.config import DEFAULT_DATASET, EXPORT_BATCH_ROWS
+from app.models.schemas import ResultQuery
+from app.routes.upload import get_renders, get_service
+from app.utils.export import dumps, iter_csv, iter_ndjson
+from app.utils.profiler import profiled, sampled
+from app.utils.reconciliation import ReconciliationService
+from app.utils.render_cache import not_modified, validators
+from app.utils.query import decode_cursor, encode_cursor, validate_query
 
 router = APIRouter()
 
+# The read routes are plain functions: rendering and serializing a page is CPU
+# work, so FastAPI runs them in its threadpool instead of on the event loop.
+
+
+def result_query(
+    status: Optional[List[str]] = Query(None, description="Repeat for several statuses"),
+    patient_id: Optional[int] = None,
+    patient_name: Optional[str] = Query(None, description="Case-insensitive name prefix"),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    min_charges: Optional[float] = None,
+    max_charges: Optional[float] = None,
+    min_credit: Optional[float] = None,
+    max_credit: Optional[float] = None,
+    sort: Optional[str] = Query(None, description="date_of_service, charges_amount or credit; prefix - for descending"),
+) -> ResultQuery:
+    query = ResultQuery(
+        status=status, patient_id=patient_id, patient_name=patient_name,
+        date_from=date_from, date_to=date_to,
+        min_charges=min_charges, max_charges=max_charges,
+        min_credit=min_credit, max_credit=max_credit, sort=sort,
+    )
+    try:
+        validate_query(query)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return query
+
+
 @router.get("/reconciliation")
-async def get_reconciliation(skip: int = 0, limit: int = 100):
-    service = get_service()
-    if not service.results_cache:
-        # If cache is empty, try to reconcile (or return empty list if no data)
-        if service.claims and service.invoices:
-            service.reconcile()
-        else:
-            return []
-    
-    results = service.get_results(skip=skip, limit=limit)
-    return {
-        "data": results,
-        "total": len(service.results_cache),
-        "skip": skip,
-        "limit": limit
-    }
+@sampled
+def get_reconciliation(
+    request: Request,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=10000),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    query: ResultQuery = Depends(result_query),
+    dataset: str = Query(DEFAULT_DATASET),
+    service: ReconciliationService = Depends(get_service),
+):
+    view = service.current  # pin one published version for the whole request
+    if view is None:
+        return []
+
+    after = None
+    if cursor:
+        try:
+            version, after = decode_cursor(cursor, query, dataset)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if version != view.version:
+            raise HTTPException(status_code=410, detail="Results changed since this cursor was issued; start over.")
+
+    def render() -> bytes:
+        records, total, last = view.records(query, skip=skip, limit=limit, after=after)
+        return dumps({
+            "data": records,
+            "total": total,
+            "skip": skip,
+            "limit": limit,
+            "version": view.version,
+            "next_cursor": encode_cursor(view.version, query, last, dataset) if last is not None else None,
+        })
+
+    # first pages are what dashboards re-fetch; keep them rendered
+    key = ("reconciliation", dataset, view.version, query.model_dump_json(), limit) \
+        if skip == 0 and after is None else None
+    return get_renders().respond(request, dataset, view, key, render)
+
+
+@router.get("/reconciliation/orphans")
+@sampled
+def get_orphan_invoices(
+    request: Request,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=10000),
+    dataset: str = Query(DEFAULT_DATASET),
+    service: ReconciliationService = Depends(get_service),
+):
+    """Invoices whose claim_id matches no claim, so no result accounts for them."""
+    view = service.current
+    if view is None:
+        return []
+
+    def render() -> bytes:
+        records, total, cents = view.orphan_invoices(skip, limit)
+        return dumps({"data": records, "total": total, "total_value": cents / 100, "skip": skip, "limit": limit,
+                      "version": view.version})
+
+    key = ("orphans", dataset, view.version, limit) if skip == 0 else None
+    return get_renders().respond(request, dataset, view, key, render)
+
+
+@router.get("/reconciliation/diff")
+@sampled
+def diff_reconciliation(
+    from_version: int = Query(..., ge=0),
+    to_version: Optional[int] = Query(None, ge=0, description="Defaults to the current version"),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=10000),
+    dataset: str = Query(DEFAULT_DATASET),
+    service: ReconciliationService = Depends(get_service),
+):
+    """
+    Claims whose status or credit changed between two published versions, with
+    their state before and after (null where the claim did not exist). Recent
+    versions only; an older one is answered 410.
+    """
+    view = service.current
+    if view is None:
+        raise HTTPException(status_code=404, detail="No results cached. Please upload data first.")
+    to_version = view.version if to_version is None else to_version
+    try:
+        diff = view.history.diff(from_version, to_version)  # as of the pinned version, not the writer's
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except KeyError as e:
+        raise HTTPException(status_code=410, detail=e.args[0])
+    return {"from_version": from_version, "to_version": to_version, "total": len(diff),
+            "data": diff.records(skip, limit), "skip": skip, "limit": limit}
+
+
+@router.get("/reconciliation/export")
+@sampled
+def export_reconciliation(
+    request: Request,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    query: ResultQuery = Depends(result_query),
+    dataset: str = Query(DEFAULT_DATASET),
+    service: ReconciliationService = Depends(get_service),
+):
+    """Stream every matching result as CSV or NDJSON, serialized batch by batch."""
+    view = service.current  # the stream keeps serving this version even if a new one is published
+    if view is None:
+        raise HTTPException(status_code=404, detail="No results cached. Please upload data first.")
+    headers = validators(dataset, view)
+    if not_modified(request, view, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    batches = view.iter_rows(query, EXPORT_BATCH_ROWS)
+    if format == "csv":
+        body, media_type = iter_csv(batches), "text/csv"
+    else:
+        body, media_type = iter_ndjson(batches), "application/x-ndjson"
+    filename = f"reconciliation-{dataset}-v{view.version}.{format}"
+    headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return StreamingResponse(profiled(body), media_type=media_type, headers=headers)
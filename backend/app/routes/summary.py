@@ -1,10 +1,46 @@
-from fastapi import APIRouter
-from app.routes.upload import get_service
+from datetime import date
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from app.config import DEFAULT_DATASET
+from app.routes.upload import get_renders, get_service
+from app.utils.analytics import GRANULARITIES
+from app.utils.export import dumps
+from app.utils.profiler import sampled
+from app.utils.reconciliation import ReconciliationService
+from app.utils.store import STATUS_LABELS
 
 router = APIRouter()
 
 @router.get("/summary")
-async def get_summary():
-    service = get_service()
-    analytics = service.get_analytics()
-    return analytics if analytics else {"detail": "No results cached. Please upload data first."}
+@sampled
+def get_summary(
+    request: Request,
+    granularity: str = Query("day", pattern=f"^({'|'.join(GRANULARITIES)})$"),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    status: Optional[List[str]] = Query(None, description="Repeat for several statuses"),
+    dataset: str = Query(DEFAULT_DATASET),
+    service: ReconciliationService = Depends(get_service),
+):
+    """
+    Summary charts. Trends have one point per `granularity` period; date range and
+    status filters are answered from the published rollup cube. A plain route:
+    rendering runs in the threadpool, off the event loop.
+    """
+    unknown = [s for s in status or [] if s not in STATUS_LABELS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown status: {', '.join(unknown)}")
+    view = service.current
+    if view is None:
+        return {"detail": "No results cached. Please upload data first."}
+
+    def render() -> bytes:
+        if granularity == "day" and date_from is None and date_to is None and status is None:
+            analytics = view.summary
+        else:
+            analytics = view.rollup.summary(view.patient_name, granularity, date_from, date_to, status)
+        return dumps(analytics or {"detail": "No results cached. Please upload data first."})
+
+    key = ("summary", dataset, view.version, granularity, date_from, date_to, tuple(status) if status else None)
+    return get_renders().respond(request, dataset, view, key, render)
@@ -1,59 +1,222 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from typing import Optional
+import asyncio
+import shutil
+import tempfile
 
-from app.utils.csv_loader import load_claims, load_invoices
+from fastapi import APIRouter, UploadFile, File, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from typing import Dict, List, Optional
+
+from app.config import DATASET_NAME_PATTERN, DEFAULT_DATASET, SHARED_STORE, SNAPSHOT_DIR
+from app.logger import get_logger
+from app.utils.datasets import DatasetRegistry
+from app.utils.jobs import Job, JobFailed, JobManager
+from app.utils.patients import PatientDirectory, get_patients
 from app.utils.reconciliation import ReconciliationService
+from app.utils.render_cache import RenderCache
+
+logger = get_logger(__name__)
 
 router = APIRouter()
-service = ReconciliationService()
+datasets = DatasetRegistry()
+jobs = JobManager()
+renders = RenderCache()
 
 
-@router.post("/upload")
-async def upload_files(
-    claims: Optional[UploadFile] = File(None),
-    invoices: Optional[UploadFile] = File(None),
-):
-    if not claims and not invoices:
-        raise HTTPException(status_code=400, detail="Upload requires at least one CSV file.")
+def _detach(upload: Optional[UploadFile]) -> Optional[UploadFile]:
+    """Copy an upload into a file the job owns; the request's own file is closed once we respond."""
+    if upload is None:
+        return None
+    upload.file.seek(0)
+    copy = tempfile.TemporaryFile()
+    shutil.copyfileobj(upload.file, copy)
+    copy.seek(0)
+    return UploadFile(copy, filename=upload.filename)
+
 
+def _run_upload(job: Job, service: ReconciliationService, claims: List[UploadFile],
+                invoices: List[UploadFile], mode: str, on_error: str) -> Dict:
+    """The upload itself, on the job thread: parse both sides' files, then apply them and reconcile."""
     errors = []
     response = {}
+    claims_data = invoices_data = None
 
-    # --- Process claims file if provided ---
-    if claims:
-        try:
-            claims_data = load_claims(claims)
-            service.load_claims(claims_data)
-            response["claims"] = f"{len(claims_data)} claims loaded"
-        except Exception as e:
-            errors.append(f"Claims CSV error: {str(e)}")
-
-    # --- Process invoices file if provided ---
-    if invoices:
-        try:
-            invoices_data = load_invoices(invoices)
-            service.load_invoices(invoices_data)
-            response["invoices"] = f"{len(invoices_data)} invoices loaded"
-        except Exception as e:
-            errors.append(f"Invoices CSV error: {str(e)}")
+    # --- Parse every file first, so a bad file leaves the loaded data untouched ---
+    job.enter("parse")
+    try:
+        if claims:
+            try:
+                claims_data = service.read_claims(
+                    claims, progress=lambda r: job.update(claims_parsed=r.rows_loaded), on_error=on_error)
+            except Exception as e:
+                errors.append(f"Claims CSV error: {str(e)}")
+        if invoices:
+            try:
+                invoices_data = service.read_invoices(
+                    invoices, progress=lambda r: job.update(invoices_parsed=r.rows_loaded), on_error=on_error)
+            except Exception as e:
+                errors.append(f"Invoices CSV error: {str(e)}")
+    finally:
+        for f in claims + invoices:
+            f.file.close()
 
     # Return *all* errors at once
     if errors:
-        raise HTTPException(status_code=400, detail=errors)
+        raise JobFailed(errors)
+
+    incremental = mode == "upsert" and service.current is not None
+    changed = 0
+    if claims_data is not None:
+        if mode == "upsert":
+            job.enter("index")
+            service.ensure_indexes()
+            job.enter("reconcile")
+            changed += service.upsert_claims(claims_data)
+        else:
+            service.load_claims(claims_data)
+        response["claims"] = f"{len(claims_data)} claims loaded"
+        response.setdefault("ingest", {})["claims"] = claims_data.report.to_dict()
+    if invoices_data is not None:
+        if mode == "upsert":
+            job.enter("index")
+            service.ensure_indexes()
+            job.enter("reconcile")
+            changed += service.upsert_invoices(invoices_data)
+        else:
+            service.load_invoices(invoices_data)
+        response["invoices"] = f"{len(invoices_data)} invoices loaded"
+        response.setdefault("ingest", {})["invoices"] = invoices_data.report.to_dict()
 
     # --- Perform reconciliation if both datasets exist ---
     if service.claims is not None and service.invoices is not None:
-        service.reconcile()
+        if not incremental:
+            changed = len(service.reconcile(progress=job.enter))
+        job.enter("analytics")
         analytics = service.get_analytics()
         response["summary"] = analytics
         response["total_records"] = analytics.get("summary", {}).get("total", 0)
+        if mode == "upsert":
+            response["changed_results"] = changed
+        response["orphan_invoices"] = service.current.orphan_invoices(0, 0)[1]
+        job.update(results=len(service.current), changed_results=changed)
     else:
         response["reconciliation"] = (
             "Not performed — both claims and invoices are required."
         )
 
+    job.enter("snapshot")
+    try:
+        if SNAPSHOT_DIR or SHARED_STORE:  # in shared mode the snapshot is how other workers see it
+            service.save_snapshot()
+    except Exception:
+        # the new version is already published and served; only restart recovery and
+        # other workers' view are affected, so the job still succeeds
+        logger.exception("snapshot write failed")
+
     return response
 
 
-def get_service():
-    return service
+@router.post("/upload")
+async def upload_files(
+    claims: Optional[List[UploadFile]] = File(None),
+    invoices: Optional[List[UploadFile]] = File(None),
+    mode: str = Query("replace", pattern="^(replace|upsert)$"),
+    dataset: str = Query(DEFAULT_DATASET, pattern=DATASET_NAME_PATTERN),
+    on_error: str = Query("fail", pattern="^(fail|skip)$"),
+    wait: bool = Query(False, description="Block until the job finishes and return its result"),
+):
+    """
+    Queue the upload as a background job and return its id (202); poll
+    /api/jobs/{job_id} for progress. `wait=true` returns the finished result instead.
+
+    `mode=replace` (default) swaps in the uploaded files and reconciles from scratch.
+    `mode=upsert` merges them into the loaded data by claim_id / invoice_id and
+    recomputes only the claims the delta touches.
+    `dataset` names the dataset to load into; it is created on first upload.
+
+    Each side may be sent as several files (repeat the form field), plain or
+    gzip/zstd-compressed; they are parsed concurrently and merged. Ids found on
+    more than one row are reported under `ingest`.
+
+    A row with a missing or malformed field fails the upload (`on_error=fail`,
+    the default) and every such row is listed in the errors. `on_error=skip`
+    drops those rows instead and reports them under `ingest`.
+    """
+    if not claims and not invoices:
+        raise HTTPException(status_code=400, detail="Upload requires at least one CSV file.")
+
+    claims_files = [await run_in_threadpool(_detach, f) for f in claims or []]
+    invoices_files = [await run_in_threadpool(_detach, f) for f in invoices or []]
+    def work(job: Job) -> Dict:
+        with datasets.writer(dataset) as service:
+            return _run_upload(job, service, claims_files, invoices_files, mode, on_error)
+
+    job = jobs.submit("upload", work)
+
+    if not wait:
+        return JSONResponse(status_code=202, content={"job_id": job.id, "status": job.status})
+
+    await asyncio.wrap_future(job.future)
+    if job.status == "failed":
+        raise HTTPException(status_code=400, detail=job.errors)
+    return job.result
+
+
+@router.post("/patients")
+async def upload_patients(
+    patients: UploadFile = File(...),
+    wait: bool = Query(False, description="Block until the job finishes and return its result"),
+):
+    """
+    Replace the patient directory (shared by every dataset) with a patient_id,name CSV,
+    as a background job like /upload. Nothing is reconciled again: names are looked
+    up for the rows each response returns, so the next read shows the new names.
+    """
+    patients_file = await run_in_threadpool(_detach, patients)
+
+    def work(job: Job) -> Dict:
+        job.enter("parse")
+        try:
+            directory = PatientDirectory.from_csv(
+                patients_file, progress=lambda r: job.update(patients_parsed=r.rows_loaded))
+        except Exception as e:
+            raise JobFailed([f"Patients CSV error: {str(e)}"])
+        finally:
+            patients_file.file.close()
+        job.enter("snapshot")
+        report = directory.report
+        directory = get_patients().replace(directory)
+        datasets.sync_patients()  # re-renders summaries; SQLite datasets also filter names in SQL
+        renders.clear()  # bodies rendered with the old names; their keys are stale anyway
+        return {"patients": f"{len(directory)} patients loaded", "generation": directory.generation,
+                **report.to_dict()}
+
+    job = jobs.submit("patients", work)
+
+    if not wait:
+        return JSONResponse(status_code=202, content={"job_id": job.id, "status": job.status})
+
+    await asyncio.wrap_future(job.future)
+    if job.status == "failed":
+        raise HTTPException(status_code=400, detail=job.errors)
+    return job.result
+
+
+def get_service(dataset: str = Query(DEFAULT_DATASET, pattern=DATASET_NAME_PATTERN)) -> ReconciliationService:
+    """Route dependency: the requested dataset's service (the default one always exists)."""
+    try:
+        return datasets.get(dataset, create=dataset == DEFAULT_DATASET)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset: {dataset}")
+
+
+def get_datasets():
+    return datasets
+
+
+def get_jobs():
+    return jobs
+
+
+def get_renders():
+    return renders
@@ -0,0 +1,303 @@
+"""
+Materialized aggregates behind /api/summary.
+
+AnalyticsState is built once from a full result set and then updated with
+the before/after state of whichever rows change, so serving the summary
+never rescans results.
+
+Besides per-patient sums it keeps a rollup cube: count, charges, invoices and
+credit per (period, status, charge bin) at day, week, month and quarter
+granularity. A summary for any granularity, date range and set of statuses
+is answered from the cube alone (see Rollup).
+
+With ANALYTICS_MODE=sketch the per-patient sums are replaced by bounded
+sketches (app.utils.sketches), which also add percentiles.
+"""
+from datetime import date
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from app.config import ANALYTICS_MODE, SKETCH_COUNTERS, SKETCH_RELATIVE_ERROR
+from app.utils.sketches import AnalyticsSketches
+from app.utils.store import (
+    BALANCED, EPOCH_ORDINAL, OVERPAID, UNDERPAID, STATUS_LABELS, ClaimStore, GroupedSums, ResultStore,
+)
+
+TOP_PATIENTS = 20
+
+# rows of the matrix returned by row_state()
+STATE_FIELDS = ("patient_id", "date_of_service", "charges_cents", "invoice_cents",
+                "invoice_count", "status", "credit_cents")
+
+
+def row_state(claims: ClaimStore, results: ResultStore, rows: np.ndarray) -> np.ndarray:
+    """Result-visible fields of the given rows, one column per row (see STATE_FIELDS)."""
+    return np.stack([
+        claims.patient_id[rows], claims.date_of_service[rows], claims.charges_cents[rows],
+        results.invoice_cents[rows], results.invoice_count[rows], results.status[rows], results.credit_cents[rows],
+    ]).astype(np.int64)
+
+
+def top_n(keys: np.ndarray, values: np.ndarray, n: int) -> np.ndarray:
+    """Positions of the n largest values (ties by key), via partial selection rather than a full sort."""
+    cand = np.arange(len(values))
+    if len(values) > n:
+        kth = np.partition(values, len(values) - n)[len(values) - n]
+        cand = np.flatnonzero(values >= kth)
+    return cand[np.lexsort((keys[cand], -values[cand]))[:n]]
+
+
+GRANULARITIES = ("day", "week", "month", "quarter")
+CHARGE_BIN_CENTS = 10000  # $100 charge bins
+
+# cube keys pack (period start ordinal, status, charge bin) into one sortable int64
+_BIN_BITS = 34
+_STATUS_SHIFT = _BIN_BITS
+_PERIOD_SHIFT = _BIN_BITS + 2
+_BIN_OFFSET = 1 << (_BIN_BITS - 1)
+_PERIOD_DAYS = {"week": 7, "month": 31, "quarter": 92}  # longest period: start + this lands in the next one
+
+
+def cube_keys(periods: np.ndarray, status: np.ndarray, bins: np.ndarray) -> np.ndarray:
+    return ((periods.astype(np.int64) << _PERIOD_SHIFT) | (status.astype(np.int64) << _STATUS_SHIFT)
+            | (bins.astype(np.int64) + _BIN_OFFSET))
+
+
+def split_cube_keys(keys: np.ndarray):
+    """(period start ordinals, status codes, charge bins) of cube keys."""
+    return (keys >> _PERIOD_SHIFT, (keys >> _STATUS_SHIFT) & 3,
+            (keys & ((1 << _BIN_BITS) - 1)) - _BIN_OFFSET)
+
+
+def period_start(ordinals: np.ndarray, granularity: str) -> np.ndarray:
+    """Ordinal of the first day of the week (Monday), month or quarter holding each date ordinal."""
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    if granularity == "day":
+        return ordinals
+    if granularity == "week":
+        return ordinals - (ordinals - 1) % 7  # ordinal 1 (0001-01-01) is a Monday
+    months = (ordinals - EPOCH_ORDINAL).astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+    if granularity == "quarter":
+        months -= months % 3
+    return months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64) + EPOCH_ORDINAL
+
+
+def _roll_up(day: "GroupedSums", granularity: str) -> "GroupedSums":
+    """A day-level cube (or part of one) regrouped by the granularity's periods."""
+    periods, status, bins = split_cube_keys(day.keys)
+    cube = GroupedSums(len(day.sums))
+    cube.add(cube_keys(period_start(periods, granularity), status, bins), list(day.sums))
+    return cube
+
+
+class AnalyticsState:
+    def __init__(self, mode: Optional[str] = None):
+        mode = mode or ANALYTICS_MODE
+        if mode not in ("exact", "sketch"):
+            raise ValueError(f"Unknown analytics mode: {mode}")
+        self.mode = mode
+        self.status_counts = np.zeros(len(STATUS_LABELS), dtype=np.int64)
+        self.patients = GroupedSums(4)  # count, overpaid, underpaid, charges (cents); exact mode only
+        self.sketches = AnalyticsSketches(SKETCH_RELATIVE_ERROR, SKETCH_COUNTERS) if mode == "sketch" else None
+        # count, charges, invoices, credit (cents) per (period, status, charge bin), per granularity
+        self.cubes = {g: GroupedSums(4) for g in GRANULARITIES}
+        self._payload: Optional[Dict] = None
+        self._rollup: Optional["Rollup"] = None
+
+    @classmethod
+    def from_results(cls, results: ResultStore) -> "AnalyticsState":
+        state = cls()
+        c = results.claims
+        state.add_columns(c.patient_id, c.date_of_service, c.charges_cents,
+                          results.invoice_cents, results.status, results.credit_cents)
+        return state
+
+    def add_columns(self, patient_id, date_of_service, charges_cents, invoice_cents, status, credit_cents,
+                    sign: int = 1):
+        ones = np.ones(len(status), dtype=np.int64)
+        overpaid = np.where(status == OVERPAID, credit_cents, 0)
+        underpaid = np.where(status == UNDERPAID, -credit_cents, 0)
+
+        self.status_counts += sign * np.bincount(status, minlength=len(STATUS_LABELS))
+        if self.sketches is not None:
+            self.sketches.add(patient_id, status, charges_cents, invoice_cents, credit_cents, sign)
+        else:
+            self.patients.add(patient_id, [ones, overpaid, underpaid, charges_cents], sign)
+        # group the rows once at day level; coarser cubes fold in that (much smaller) partial
+        day = GroupedSums(4)
+        day.add(cube_keys(date_of_service, status, charges_cents // CHARGE_BIN_CENTS),
+                [ones, charges_cents, invoice_cents, credit_cents], sign)
+        self.add_cube(day)
+
+    def add_cube(self, day: "GroupedSums"):
+        """Fold a day-level cube partial into every granularity."""
+        for granularity, cube in self.cubes.items():
+            cube.merge(day if granularity == "day" else _roll_up(day, granularity))
+        self._payload = self._rollup = None
+
+    def add_state(self, state: np.ndarray, sign: int = 1):
+        """Apply a row_state() matrix: sign=-1 before rows change, +1 after."""
+        patient_id, dos, charges, invoices, _count, status, credit = state
+        self.add_columns(patient_id, dos, charges, invoices, status, credit, sign)
+
+    def merge(self, other: "AnalyticsState"):
+        """Fold in the partial state of a disjoint set of rows (e.g. one reconcile shard)."""
+        self.status_counts += other.status_counts
+        self.patients.merge(other.patients)
+        if self.sketches is not None:
+            self.sketches.merge(other.sketches)
+        self.add_cube(other.cubes["day"])
+
+    def rollup(self) -> "Rollup":
+        """A frozen copy of the aggregates for readers; rebuilt only after the state changed."""
+        if self._rollup is None:
+            self._rollup = Rollup(self)
+        return self._rollup
+
+    def payload(self, patient_name: Callable[[int], str]) -> Dict:
+        """The default /api/summary document (daily, unfiltered); rebuilt only after the state changed."""
+        if self._payload is None:
+            self._payload = self.rollup().summary(patient_name)
+        return self._payload
+
+
+class Rollup:
+    """
+    Immutable copy of an AnalyticsState, published with each result version.
+    summary() slices and regroups the cube; it never looks at result rows.
+    """
+
+    def __init__(self, state: AnalyticsState):
+        self.patients = GroupedSums(4)
+        self.patients.keys, self.patients.sums = state.patients.keys.copy(), state.patients.sums.copy()
+        self.sketches = state.sketches.copy() if state.sketches is not None else None
+        self.cubes = {}
+        for granularity, cube in state.cubes.items():
+            live = cube.present()
+            self.cubes[granularity] = (cube.keys[live], cube.sums[:, live])
+
+    def _slice(self, granularity: str, lo: Optional[int], hi: Optional[int]):
+        """Cube entries whose period starts in [lo, hi) (ordinals, None = unbounded)."""
+        keys, sums = self.cubes[granularity]
+        start = np.searchsorted(keys, lo << _PERIOD_SHIFT) if lo is not None else 0
+        stop = np.searchsorted(keys, hi << _PERIOD_SHIFT) if hi is not None else len(keys)
+        return keys[start:stop], sums[:, start:stop]
+
+    def _select(self, granularity: str, date_from: Optional[date], date_to: Optional[date]):
+        """
+        Cube entries of the granularity covering [date_from, date_to]: whole
+        periods from its own cube, partial periods at either edge from the day cube.
+        """
+        lo = date_from.toordinal() if date_from else None
+        hi = date_to.toordinal() + 1 if date_to else None  # exclusive
+        if granularity == "day" or (lo is None and hi is None):
+            return self._slice(granularity, lo, hi)
+
+        def start(o):
+            return int(period_start(np.array([o]), granularity)[0])
+
+        # whole periods: starting at or after lo, ending before hi
+        first = lo if lo is None or start(lo) == lo else start(start(lo) + _PERIOD_DAYS[granularity])
+        last = hi if hi is None or start(hi) == hi else start(hi)
+        if first is not None and last is not None and first >= last:
+            parts = [self._slice("day", lo, hi)]
+        else:
+            parts = [self._slice(granularity, first, last)]
+            if lo is not None and lo < first:
+                parts.append(self._slice("day", lo, first))
+            if hi is not None and last < hi:
+                parts.append(self._slice("day", last, hi))
+        keys = np.concatenate([k for k, _ in parts])
+        sums = np.concatenate([s for _, s in parts], axis=1)
+        periods, status, bins = split_cube_keys(keys)
+        return cube_keys(period_start(periods, granularity), status, bins), sums
+
+    def summary(self, patient_name: Callable[[int], str], granularity: str = "day",
+                date_from: Optional[date] = None, date_to: Optional[date] = None,
+                statuses: Optional[Sequence[str]] = None) -> Dict:
+        """
+        The /api/summary document with trends per `granularity` period (dated by
+        the period's first day), restricted to a date range and statuses. Top
+        patients are not broken down by date and, except in sketch mode, not by
+        status either. Sketch mode adds percentiles and per-status top patients.
+        """
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"Unknown granularity: {granularity}")
+        keys, sums = self._select(granularity, date_from, date_to)
+        periods, status, bins = split_cube_keys(keys)
+        if statuses is not None:
+            keep = np.isin(status, [STATUS_LABELS.index(s) for s in statuses])
+            periods, status, bins, sums = periods[keep], status[keep], bins[keep], sums[:, keep]
+        count, charges, invoices, credit = sums
+
+        counts = np.bincount(status, weights=count, minlength=len(STATUS_LABELS)).astype(np.int64)
+        total = int(counts.sum())
+        if not total:
+            return {}
+        counts = dict(zip(STATUS_LABELS, counts.tolist()))
+
+        p = self.patients
+        live = p.present()
+        pid, (p_count, p_over, p_under, _) = p.keys[live], p.sums[:, live]
+
+        def top(values, key, in_cents):
+            picked = top_n(pid, values, TOP_PATIENTS)
+            return [
+                {"name": patient_name(int(pid[i])), key: int(values[i]) / 100 if in_cents else int(values[i])}
+                for i in picked if not in_cents or values[i] > 0
+            ]
+
+        def grouped(by: np.ndarray, *measures: np.ndarray):
+            uniq, inverse = np.unique(by, return_inverse=True)
+            return uniq, [np.bincount(inverse, weights=m, minlength=len(uniq)).astype(np.int64) for m in measures]
+
+        balanced = np.where(status == BALANCED, count, 0)
+        days, (d_count, d_charges, d_invoices, d_balanced) = grouped(periods, count, charges, invoices, balanced)
+        trend = [(date.fromordinal(k), *s) for k, s in zip(days.tolist(), zip(
+            d_count.tolist(), d_charges.tolist(), d_invoices.tolist(), d_balanced.tolist()))]
+        bin_keys, (bin_counts,) = grouped(bins, count)
+        overpaid = int(credit[status == OVERPAID].sum())
+        underpaid = -int(credit[status == UNDERPAID].sum())
+
+        payload = {
+            "status_distribution": [
+                {"status": s, "count": counts[s]} for s in ("BALANCED", "OVERPAID", "UNDERPAID", "N/A")
+            ],
+            "top_patients_volume": top(p_count, "count", False),
+            "top_patients_overpaid": top(p_over, "amount", True),
+            "top_patients_underpaid": top(p_under, "amount", True),
+            "daily_volume_trend": [
+                {"date": day, "count": count} for day, count, _, _, _ in trend
+            ],
+            "financial_trend": [
+                {"date": day, "charges": charges / 100, "invoices": invoices / 100}
+                for day, _, charges, invoices, _ in trend
+            ],
+            "accuracy_trend": [
+                {"date": day, "accuracy": balanced / count * 100} for day, count, _, _, balanced in trend
+            ],
+            "status_area_trend": [
+                {"date": day, "balanced": balanced, "others": count - balanced} for day, count, _, _, balanced in trend
+            ],
+            "financial_impact_by_status": [
+                {"status": "OVERPAID", "amount": overpaid / 100},
+                {"status": "UNDERPAID", "amount": underpaid / 100},
+            ],
+            "charge_distribution": [
+                {"bin": b * CHARGE_BIN_CENTS // 100, "count": c}
+                for b, c in zip(bin_keys.tolist(), bin_counts.tolist()) if c
+            ],
+            "summary": {
+                "total": total,
+                "balanced": counts["BALANCED"],
+                "overpaid": counts["OVERPAID"],
+                "underpaid": counts["UNDERPAID"],
+                "no_invoices": counts["N/A"],
+            },
+        }
+        if self.sketches is not None:
+            selected = range(len(STATUS_LABELS)) if statuses is None else sorted(
+                {STATUS_LABELS.index(s) for s in statuses})
+            payload.update(self.sketches.summary(selected, patient_name, TOP_PATIENTS))
+        return payload
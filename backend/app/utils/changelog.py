@@ -0,0 +1,234 @@
+"""
+Run-to-run diffs: the claims whose status or credit changed between two
+published versions of a dataset.
+
+Each publish records an entry in the dataset's Changelog. A claim's state is
+one int64 fingerprint, credit_cents * 8 + status, which is exact and can be
+decoded again. A full reconcile records the version's fingerprint table: one
+row per distinct claim_id, in the order of the claim_id hashes the KeyTable
+already holds. The writer builds it when it publishes the version, so a diff
+never builds anything. An upsert records only the claims it touched, with
+their fingerprints before and after.
+
+When only upserts lie between the two versions, the diff reads those upsert
+entries and nothing else, so its cost grows with the change rather than with
+the dataset. When a full reconcile lies between them, the two fingerprint
+tables are compared as arrays.
+
+History lives in memory and covers the last DIFF_HISTORY versions this
+process published; versions from before a restart cannot be diffed. Every
+publish makes a new immutable History, and each published version holds the
+one it was published with, so a reader diffs from the version it pinned while
+the writer records the next one.
+"""
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.config import DIFF_HISTORY
+from app.utils.store import NO_INVOICES, STATUS_LABELS, ClaimStore, ResultStore, _hash
+
+ABSENT = np.iinfo(np.int64).min  # fingerprint of a claim the version does not hold
+
+
+def fingerprints(status: np.ndarray, credit_cents: np.ndarray) -> np.ndarray:
+    """Status and credit packed into one int64 per claim."""
+    return np.asarray(credit_cents, dtype=np.int64) * 8 + np.asarray(status, dtype=np.int64)
+
+
+def _state(fp: int) -> Optional[Dict]:
+    if fp == ABSENT:
+        return None
+    status = fp & 7
+    return {"status": STATUS_LABELS[status], "credit": (fp >> 3) / 100 if status != NO_INVOICES else None}
+
+
+class _Table:
+    """Fingerprints of every claim of a fully reconciled version, sorted by claim_id hash."""
+
+    def __init__(self, version: int, hashes: np.ndarray, fps: np.ndarray, codes: np.ndarray, values: np.ndarray):
+        self.version = version
+        self.hashes = hashes  # uint64, sorted
+        self.fps = fps        # int64
+        self.codes = codes    # int32 claim code of each row, into `values`
+        self.values = values  # the claim KeyTable's values (append-only, so safe to share)
+
+    @property
+    def nbytes(self) -> int:
+        return self.hashes.nbytes + self.fps.nbytes + self.codes.nbytes
+
+    def find(self, hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(position, found) of each hash."""
+        pos = np.minimum(np.searchsorted(self.hashes, hashes), max(len(self.hashes) - 1, 0))
+        found = self.hashes[pos] == hashes if len(self.hashes) else np.zeros(len(hashes), dtype=bool)
+        return pos, found
+
+    def ids(self, pos: np.ndarray) -> np.ndarray:
+        return self.values[self.codes[pos]]
+
+
+class _Delta:
+    """The claims one upsert touched: before and after fingerprints, sorted by claim_id hash."""
+
+    def __init__(self, version: int, ids: np.ndarray, before: np.ndarray, after: np.ndarray):
+        hashes = _hash(ids)
+        # a claim_id on several rows: its last row stands for it, as in the fingerprint table
+        _, last_from_end = np.unique(hashes[::-1], return_index=True)
+        keep = len(hashes) - 1 - last_from_end  # np.unique returns them in hash order
+        self.version = version
+        self.hashes, self.ids, self.before, self.after = hashes[keep], ids[keep], before[keep], after[keep]
+
+    @property
+    def nbytes(self) -> int:
+        return self.hashes.nbytes + self.ids.nbytes + self.before.nbytes + self.after.nbytes
+
+
+def full_table(version: int, claims: ClaimStore, results: ResultStore) -> _Table:
+    """The fingerprint table of a fully reconciled version; claim_id hashes come from the KeyTable."""
+    values, hashes, codes = claims.keys.parts()
+    row_of_code = np.full(len(values), -1, dtype=np.int64)
+    row_of_code[claims.key] = np.arange(len(claims.key))  # last row of a repeated claim_id wins
+    rows = row_of_code[codes]
+    held = rows >= 0  # codes interned only by invoices have no claim
+    rows = rows[held]
+    return _Table(version, hashes[held], fingerprints(results.status[rows], results.credit_cents[rows]), codes[held],
+                  values)
+
+
+class ClaimDiff:
+    """Claims whose fingerprint differs between two versions, ordered by claim_id."""
+
+    def __init__(self, ids: np.ndarray, before: np.ndarray, after: np.ndarray):
+        order = np.argsort(ids, kind="stable")
+        self.ids, self.before, self.after = ids[order], before[order], after[order]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def records(self, skip: int = 0, limit: int = 100) -> List[Dict]:
+        part = slice(skip, skip + limit)
+        return [{"claim_id": i.decode("utf-8"), "before": _state(b), "after": _state(a)}
+                for i, b, a in zip(self.ids[part].tolist(), self.before[part].tolist(), self.after[part].tolist())]
+
+
+class History:
+    """Changelog entries as of one published version, oldest first; never changed once made."""
+
+    def __init__(self, entries: Tuple[object, ...] = ()):
+        self.entries = entries  # _Table, _Delta, or a bare version (full, but not kept)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(e.nbytes for e in self.entries if not isinstance(e, int))
+
+    def diff(self, old: int, new: int) -> ClaimDiff:
+        """
+        ValueError unless old <= new; KeyError when either version is not
+        retained (or cannot be reconstructed).
+        """
+        if old > new:
+            raise ValueError(f"Version {old} is newer than version {new}")
+        entries = self.entries
+        versions = [_version(e) for e in entries]
+        for v in (old, new):
+            if v not in versions:
+                oldest = f"; diffs reach back to version {versions[0]}" if versions else ""
+                raise KeyError(f"Version {v} is not retained{oldest}")
+        between = entries[versions.index(old) + 1: versions.index(new) + 1]
+        if not between:
+            return ClaimDiff(np.empty(0, dtype="S1"), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        if all(isinstance(e, _Delta) for e in between):
+            return _delta_diff(between)
+        return _table_diff(self._table_at(entries, versions, old), self._table_at(entries, versions, new))
+
+    @staticmethod
+    def _table_at(entries, versions, version: int) -> _Table:
+        """The full fingerprint table of a version: its last full table with later upserts applied."""
+        at = versions.index(version)
+        base = next((i for i in range(at, -1, -1) if not isinstance(entries[i], _Delta)), None)
+        if base is None or isinstance(entries[base], int):
+            raise KeyError(f"Version {version} cannot be diffed against a full reconcile")
+        table = entries[base]
+        deltas = entries[base + 1: at + 1]
+        if not deltas:
+            return table
+        changes = _merge(deltas)
+        pos, found = table.find(changes.hashes)
+        fps = table.fps.copy()
+        fps[pos[found]] = changes.after[found]
+        # claims new since the table: appended with their ids, then everything re-sorted by hash
+        new = ~found
+        hashes = np.concatenate([table.hashes, changes.hashes[new]])
+        fps = np.concatenate([fps, changes.after[new]])
+        values = np.concatenate([table.ids(np.arange(len(table.hashes))), changes.ids[new]])
+        order = np.argsort(hashes, kind="stable")
+        return _Table(version, hashes[order], fps[order], order.astype(np.int64), values)
+
+
+class Changelog:
+    """
+    The writer's record of the last `keep` published versions. Each record
+    replaces `history` with a new History, which the published version keeps.
+    """
+
+    def __init__(self, keep: int = DIFF_HISTORY):
+        self.keep = keep
+        self.history = History()
+
+    @property
+    def nbytes(self) -> int:
+        return self.history.nbytes
+
+    def _record(self, entry):
+        entries = (self.history.entries + (entry,))[-self.keep:] if self.keep > 0 else ()
+        self.history = History(entries)
+
+    def record_full(self, version: int, table: Optional[_Table] = None):
+        """A version published by a full reconcile (or mapped from disk); without a table it cannot be diffed across."""
+        self._record(table if table is not None else version)
+
+    def record_delta(self, version: int, ids: np.ndarray, before: np.ndarray, after: np.ndarray):
+        """A version published by an upsert: the touched claim_ids and their fingerprints before and after."""
+        self._record(_Delta(version, ids, before, after))
+
+    def diff(self, old: int, new: int) -> ClaimDiff:
+        """History.diff() on the latest history."""
+        return self.history.diff(old, new)
+
+
+def _version(entry) -> int:
+    return entry if isinstance(entry, int) else entry.version
+
+
+class _Changes:
+    def __init__(self, hashes, ids, before, after):
+        self.hashes, self.ids, self.before, self.after = hashes, ids, before, after
+
+
+def _merge(deltas: List[_Delta]) -> _Changes:
+    """Consecutive upserts as one: per claim, the first `before` and the last `after`, sorted by hash."""
+    hashes = np.concatenate([d.hashes for d in deltas])
+    order = np.argsort(hashes, kind="stable")  # stable: each claim's entries stay in version order
+    hashes = hashes[order]
+    starts = np.flatnonzero(np.r_[True, hashes[1:] != hashes[:-1]])
+    ends = np.r_[starts[1:], len(hashes)] - 1
+    ids = np.concatenate([d.ids for d in deltas])[order]
+    before = np.concatenate([d.before for d in deltas])[order]
+    after = np.concatenate([d.after for d in deltas])[order]
+    return _Changes(hashes[starts], ids[ends], before[starts], after[ends])
+
+
+def _delta_diff(deltas: List[_Delta]) -> ClaimDiff:
+    changes = _merge(deltas)
+    changed = changes.before != changes.after
+    return ClaimDiff(changes.ids[changed], changes.before[changed], changes.after[changed])
+
+
+def _table_diff(old: _Table, new: _Table) -> ClaimDiff:
+    pos, found = old.find(new.hashes)
+    before = np.where(found, old.fps[pos], ABSENT)
+    changed = np.flatnonzero(before != new.fps)
+    gone = np.flatnonzero(~new.find(old.hashes)[1])  # claims the new version no longer holds
+    ids = np.concatenate([new.ids(changed), old.ids(gone)])
+    return ClaimDiff(ids, np.concatenate([before[changed], old.fps[gone]]),
+                     np.concatenate([new.fps[changed], np.full(len(gone), ABSENT, dtype=np.int64)]))
@@ -0,0 +1,55 @@
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+from app.utils.store import ClaimStore, InvoiceIndex, InvoiceStore, ResultStore, classify
+
+
+def reconcile_rows(claims: ClaimStore, index: InvoiceIndex, rows: Optional[np.ndarray] = None):
+    """
+    Invoice total, invoice count, status and credit for the given claim rows
+    (all rows when `rows` is None), looked up from the per-claim invoice index.
+    """
+    keys = claims.key if rows is None else claims.key[rows]
+    charges = claims.charges_cents if rows is None else claims.charges_cents[rows]
+    return settle(keys, charges, index.totals, index.counts)
+
+
+def settle(keys: np.ndarray, charges_cents: np.ndarray, totals: np.ndarray, counts: np.ndarray):
+    """(invoice_cents, invoice_count, status, credit_cents) of claims given per-key invoice totals and counts."""
+    invoice_cents = totals[keys]
+    invoice_count = counts[keys]
+    credit_cents = np.where(invoice_count > 0, invoice_cents - charges_cents, 0)
+    return invoice_cents, invoice_count, classify(credit_cents, invoice_count), credit_cents
+
+
+def reconcile_columnar(claims: ClaimStore, invoices: InvoiceStore, patient_name: Callable[[int], str],
+                       index: Optional[InvoiceIndex] = None) -> ResultStore:
+    """Vectorized reconcile; both stores must share one KeyTable (see InvoiceStore.rekey)."""
+    # hash join on interned claim codes: grouped sum and count per claim id
+    if index is None:
+        index = InvoiceIndex.build(invoices, len(claims.keys))
+    return ResultStore(claims, *reconcile_rows(claims, index), patient_name)
+
+
+def reconcile_python(claims: ClaimStore, invoices: InvoiceStore,
+                     patient_name: Callable[[int], str]) -> ResultStore:
+    """Reference per-row implementation of reconcile_columnar."""
+    sums: Dict[int, int] = {}
+    counts: Dict[int, int] = {}
+    for key, cents in zip(invoices.key.tolist(), invoices.amount_cents.tolist()):
+        sums[key] = sums.get(key, 0) + cents
+        counts[key] = counts.get(key, 0) + 1
+
+    n = len(claims)
+    invoice_cents = np.zeros(n, dtype=np.int64)
+    invoice_count = np.zeros(n, dtype=np.int32)
+    credit_cents = np.zeros(n, dtype=np.int64)
+    for i, (key, charge) in enumerate(zip(claims.key.tolist(), claims.charges_cents.tolist())):
+        if key in counts:
+            invoice_cents[i] = sums[key]
+            invoice_count[i] = counts[key]
+            credit_cents[i] = sums[key] - charge
+
+    return ResultStore(claims, invoice_cents, invoice_count, classify(credit_cents, invoice_count),
+                       credit_cents, patient_name)
@@ -1,33 +1,361 @@
-import csv
-from io import StringIO
-from typing import List
-from app.models.claim import Claim
-from app.models.invoice import Invoice
-
-def load_claims(file) -> List[Claim]:
-    text = file.file.read().decode("utf-8")
-    reader = csv.DictReader(StringIO(text))
-
-    return [
-        Claim(
-            claim_id=row["claim_id"],
-            patient_id=int(row["patient_id"]),
-            date_of_service=row["date_of_service"],
-            charges_amount=float(row["charges_amount"])
-        )
-        for row in reader
-    ]
-
-
-def load_invoices(file) -> List[Invoice]:
-    text = file.file.read().decode("utf-8")
-    reader = csv.DictReader(StringIO(text))
-
-    return [
-        Invoice(
-            invoice_id=row["invoice_id"],
-            claim_id=row["claim_id"],
-            transaction_value=float(row["transaction_value"])
-        )
-        for row in reader
-    ]
+import gzip
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from app.config import (CLAIMS_REQUIRED_COLUMNS, INVOICES_REQUIRED_COLUMNS, CSV_CHUNK_ROWS, CSV_MAX_REPORTED_ERRORS,
+                        INGEST_WORKERS)
+from app.logger import get_logger
+from app.utils.metrics import metrics
+from app.utils.store import ClaimStore, InvoiceStore, KeyTable
+
+try:
+    import zstandard
+except ImportError:  # plain and gzip uploads only
+    zstandard = None
+
+logger = get_logger(__name__)
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+MAX_AMOUNT = 2 ** 53 / 100  # largest amount whose cents are still exact in float64 and fit in int64
+
+
+class IngestReport:
+    """Throughput and rejected-row details for one streamed CSV file."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.rows_loaded = 0
+        self.rows_rejected = 0
+        self.errors: List[str] = []  # first CSV_MAX_REPORTED_ERRORS messages only
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.read_seconds = 0.0  # decoding and tokenizing (pandas)
+        self.validate_seconds = 0.0  # type conversion, row checks, building the columns
+        self.duplicates = 0  # distinct ids held by more than one row (rows are kept)
+        self.duplicate_ids: List[str] = []  # first CSV_MAX_REPORTED_ERRORS of them
+
+    @property
+    def rows_per_sec(self) -> float:
+        total = self.rows_loaded + self.rows_rejected
+        return total / self.seconds if self.seconds > 0 else 0.0
+
+    def reject(self, line_numbers: np.ndarray, column: str, values: np.ndarray):
+        self.rows_rejected += len(line_numbers)
+        room = CSV_MAX_REPORTED_ERRORS - len(self.errors)
+        for line, value in zip(line_numbers[:room], values[:room]):
+            self.errors.append(f"line {line}: invalid {column} {value!r}")
+
+    def duplicated(self, ids: np.ndarray):
+        self.duplicates = len(ids)
+        self.duplicate_ids = [i.decode("utf-8") for i in ids[:CSV_MAX_REPORTED_ERRORS].tolist()]
+        if len(ids):
+            metrics.inc("ingest_duplicate_ids_total", len(ids), kind=self.kind)
+            logger.warning("%d duplicate %s ids, e.g. %s", len(ids), self.kind, ", ".join(self.duplicate_ids[:5]))
+
+    def merge(self, other: "IngestReport", source: Optional[str] = None):
+        """Add another file's counts; its error messages are prefixed with `source`."""
+        self.rows_loaded += other.rows_loaded
+        self.rows_rejected += other.rows_rejected
+        self.bytes_read += other.bytes_read
+        self.read_seconds += other.read_seconds
+        self.validate_seconds += other.validate_seconds
+        room = CSV_MAX_REPORTED_ERRORS - len(self.errors)
+        self.errors += [f"{source} {e}" if source else e for e in other.errors[:room]]
+
+    def to_dict(self) -> dict:
+        return {
+            "rows_loaded": self.rows_loaded,
+            "rows_rejected": self.rows_rejected,
+            "rows_per_sec": round(self.rows_per_sec, 1),
+            "errors": self.errors,
+            "duplicates": self.duplicates,
+            "duplicate_ids": self.duplicate_ids,
+        }
+
+
+def as_files(files) -> list:
+    """One upload or a list of them, as a list."""
+    return list(files) if isinstance(files, (list, tuple)) else [files]
+
+
+def _source(file, i: int) -> str:
+    return getattr(file, "filename", None) or f"file {i + 1}"
+
+
+def _open(file):
+    """The upload's bytes, decompressed as they are read when it is gzip or zstd (told by its magic bytes)."""
+    raw = file.file
+    try:
+        start = raw.tell()
+        head = raw.read(4)
+        raw.seek(start)
+    except (AttributeError, OSError, ValueError):  # unseekable: read as plain CSV
+        return raw
+    if head.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=raw, mode="rb")
+    if head == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError("zstd-compressed file, but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=False)
+    return raw
+
+
+def _iter_chunks(file, required: set, chunk_rows: int):
+    """Stream the (spooled, possibly compressed) upload through pandas in fixed-size row chunks."""
+    reader = pd.read_csv(
+        _open(file), chunksize=chunk_rows, dtype=str, keep_default_na=False, encoding="utf-8",
+    )
+    with reader:
+        for chunk in reader:
+            missing = required - set(chunk.columns)
+            if missing:
+                raise ValueError(f"Missing required columns: {', '.join(sorted(missing))}")
+            yield chunk
+
+
+def _line_numbers(chunk: pd.DataFrame) -> np.ndarray:
+    # +2: one for the header line, one because CSV lines are 1-based
+    return chunk.index.to_numpy() + 2
+
+
+def _bytes_read(file) -> int:
+    """Bytes read from the upload itself, compressed or not."""
+    try:
+        return file.file.tell()
+    except (AttributeError, OSError, ValueError):  # unseekable or closed stream
+        return 0
+
+
+def _parsed(file, report: IngestReport, required: set, parse_chunk: Callable, chunk_rows: int,
+            progress: Optional[Callable[[IngestReport], None]] = None, keys: Optional[KeyTable] = None,
+            on_error: str = "fail"):
+    """
+    Parsed chunks in file order; each gets a fresh KeyTable unless `keys` is
+    shared by all. Invalid rows fail the file once it is read, so every one
+    of them is reported, unless `on_error` is "skip": then they are dropped.
+    """
+    start = time.perf_counter()
+    chunks = _iter_chunks(file, required, chunk_rows)
+    while True:
+        read_start = time.perf_counter()
+        chunk = next(chunks, None)
+        validate_start = time.perf_counter()
+        report.read_seconds += validate_start - read_start
+        if chunk is None:
+            break
+        part = parse_chunk(chunk, report, keys if keys is not None else KeyTable())
+        report.validate_seconds += time.perf_counter() - validate_start
+        report.rows_loaded += len(part)
+        if progress:
+            progress(report)
+        yield part  # time spent by the consumer counts towards report.seconds only
+    report.seconds = time.perf_counter() - start
+    report.bytes_read = _bytes_read(file)
+    _record(report)
+
+    if report.rows_rejected and not report.rows_loaded:
+        raise ValueError(f"No valid {report.kind} rows: " + "; ".join(report.errors))
+    if report.rows_rejected and on_error != "skip":
+        raise ValueError(f"{report.rows_rejected} invalid {report.kind} rows: " + "; ".join(report.errors))
+
+    fields = {"kind": report.kind, "rows": report.rows_loaded, "rejected": report.rows_rejected,
+              "bytes": report.bytes_read, "seconds": round(report.seconds, 3),
+              "read_seconds": round(report.read_seconds, 3), "validate_seconds": round(report.validate_seconds, 3),
+              "rows_per_sec": round(report.rows_per_sec)}
+    logger.info("ingest %s", " ".join(f"{k}={v}" for k, v in fields.items()), extra={"fields": fields})
+
+
+def _record(report: IngestReport):
+    metrics.inc("ingest_rows_total", report.rows_loaded, kind=report.kind, outcome="loaded")
+    metrics.inc("ingest_rows_total", report.rows_rejected, kind=report.kind, outcome="rejected")
+    metrics.inc("ingest_bytes_total", report.bytes_read, kind=report.kind)
+    metrics.observe("stage_seconds", report.read_seconds, stage="csv_read")
+    metrics.observe("stage_seconds", report.validate_seconds, stage="csv_validate")
+
+
+def _stream(file, kind: str, required: set, parse_chunk: Callable, chunk_rows: int,
+            progress: Optional[Callable[[IngestReport], None]] = None, on_error: str = "fail"):
+    report = IngestReport(kind)
+    keys = KeyTable()  # shared by every chunk of the file
+    parts = list(_parsed(file, report, required, parse_chunk, chunk_rows, progress, keys, on_error))
+    return parts, report
+
+
+def _check(chunk: pd.DataFrame, report: IngestReport, ok: np.ndarray, column: str, valid: np.ndarray) -> np.ndarray:
+    """Reject rows that are still ok but fail `valid` for `column`; returns the narrowed mask."""
+    bad = ok & ~valid
+    if bad.any():
+        report.reject(_line_numbers(chunk)[bad], column, chunk[column].to_numpy()[bad])
+    return ok & valid
+
+
+def _parse_ids(column: pd.Series):
+    """
+    Integer ids as int64, plus a mask of the rows that hold one. Ids above
+    2**53 are re-read from their digits: float64 would round them.
+    """
+    text = column.str.strip()
+    ids = pd.to_numeric(text, errors="coerce")
+    if ids.dtype.kind == "i":  # every row is a plain integer that fits int64
+        return ids.to_numpy(dtype=np.int64), np.ones(len(ids), dtype=bool)
+    values = ids.to_numpy(dtype=np.float64)
+    valid = np.isfinite(values) & (values == np.round(values)) & (np.abs(values) < 2 ** 53)
+    parsed = np.where(valid, values, 0).astype(np.int64)
+    rest = np.flatnonzero(~valid)
+    if len(rest):
+        digits = text.iloc[rest].str.extract(r"^([+-]?\d{1,18})(?:\.0*)?$", expand=False)
+        found = digits.notna().to_numpy()
+        parsed[rest[found]] = pd.to_numeric(digits[found]).to_numpy(dtype=np.int64)
+        valid[rest[found]] = True
+    return parsed, valid
+
+
+def _amounts_ok(values: np.ndarray) -> np.ndarray:
+    """Finite amounts small enough to convert to int64 cents; NaN, inf and -inf are rejected."""
+    return np.isfinite(values) & (np.abs(values) < MAX_AMOUNT)
+
+
+def _parse_claims(chunk: pd.DataFrame, report: IngestReport, keys: KeyTable) -> ClaimStore:
+    claim_id = chunk["claim_id"].to_numpy(dtype=object)
+    patient_id, patient_id_ok = _parse_ids(chunk["patient_id"])
+    dos = pd.to_datetime(chunk["date_of_service"], format="%Y-%m-%d", errors="coerce").to_numpy(dtype="datetime64[D]")
+    charges = pd.to_numeric(chunk["charges_amount"], errors="coerce").to_numpy(dtype=np.float64)
+
+    ok = np.ones(len(chunk), dtype=bool)
+    ok = _check(chunk, report, ok, "claim_id", claim_id != "")
+    ok = _check(chunk, report, ok, "patient_id", patient_id_ok)
+    ok = _check(chunk, report, ok, "date_of_service", ~np.isnat(dos))
+    ok = _check(chunk, report, ok, "charges_amount", _amounts_ok(charges))
+
+    return ClaimStore.from_columns(
+        claim_id=claim_id[ok],
+        patient_id=patient_id[ok],
+        date_of_service=dos[ok],
+        charges_amount=charges[ok],
+        keys=keys,
+    )
+
+
+def _parse_invoices(chunk: pd.DataFrame, report: IngestReport, keys: KeyTable) -> InvoiceStore:
+    invoice_id = chunk["invoice_id"].to_numpy(dtype=object)
+    claim_id = chunk["claim_id"].to_numpy(dtype=object)
+    value = pd.to_numeric(chunk["transaction_value"], errors="coerce").to_numpy(dtype=np.float64)
+
+    ok = np.ones(len(chunk), dtype=bool)
+    ok = _check(chunk, report, ok, "invoice_id", invoice_id != "")
+    ok = _check(chunk, report, ok, "claim_id", claim_id != "")
+    ok = _check(chunk, report, ok, "transaction_value", _amounts_ok(value))
+
+    return InvoiceStore.from_columns(
+        invoice_id=invoice_id[ok], claim_id=claim_id[ok], transaction_value=value[ok], keys=keys,
+    )
+
+
+def _load(files, kind: str, required: set, parse_chunk: Callable, store, chunk_rows: int,
+          progress: Optional[Callable[[IngestReport], None]] = None, on_error: str = "fail"):
+    """
+    Parse one or several files into one store. Several files are parsed
+    concurrently, each with its own key table, and merged once all are done.
+    """
+    files = as_files(files)
+    if len(files) == 1:
+        parts, report = _stream(files[0], kind, required, parse_chunk, chunk_rows, progress, on_error)
+        return store.concat(parts), report
+
+    start = time.perf_counter()
+    running = IngestReport(kind)  # what `progress` sees: rows loaded so far across all files
+    loaded = [0] * len(files)
+    lock = threading.Lock()
+
+    def parse(i: int):
+        def tick(part: IngestReport):
+            with lock:
+                loaded[i] = part.rows_loaded
+                running.rows_loaded = sum(loaded)
+                if progress:
+                    progress(running)
+        try:
+            parts, part_report = _stream(files[i], kind, required, parse_chunk, chunk_rows, tick, on_error)
+        except (ValueError, OSError, EOFError) as e:  # bad CSV, corrupt or truncated archive
+            raise ValueError(f"{_source(files[i], i)}: {e}") from e
+        return store.concat(parts), part_report
+
+    # pandas' tokenizer and zlib release the GIL, so threads parse files side by side
+    with ThreadPoolExecutor(min(INGEST_WORKERS, len(files)), thread_name_prefix=f"ingest-{kind}") as pool:
+        parsed = list(pool.map(parse, range(len(files))))
+    report = IngestReport(kind)
+    for i, (_, part_report) in enumerate(parsed):
+        report.merge(part_report, _source(files[i], i))
+    report.seconds = time.perf_counter() - start
+    return store.merge([part for part, _ in parsed]), report
+
+
+def load_claims(files, chunk_rows: int = CSV_CHUNK_ROWS,
+                progress: Optional[Callable[[IngestReport], None]] = None, on_error: str = "fail") -> ClaimStore:
+    """
+    Claims from one upload or a list of them (plain, gzip or zstd CSV). Any
+    invalid row fails the load; with `on_error="skip"` it is dropped and reported.
+    """
+    claims, report = _load(files, "claims", CLAIMS_REQUIRED_COLUMNS, _parse_claims, ClaimStore, chunk_rows, progress,
+                           on_error)
+    report.duplicated(claims.duplicate_ids())
+    claims.report = report
+    return claims
+
+
+def load_invoices(files, chunk_rows: int = CSV_CHUNK_ROWS,
+                  progress: Optional[Callable[[IngestReport], None]] = None, on_error: str = "fail") -> InvoiceStore:
+    invoices, report = _load(files, "invoices", INVOICES_REQUIRED_COLUMNS, _parse_invoices, InvoiceStore,
+                             chunk_rows, progress, on_error)
+    report.duplicated(invoices.duplicate_ids())
+    invoices.report = report
+    return invoices
+
+
+def _iter_files(files, report: IngestReport, required: set, parse_chunk: Callable, chunk_rows: int,
+                progress: Optional[Callable[[IngestReport], None]] = None, on_error: str = "fail"):
+    """Parsed chunks of each file in turn; every file is reported on its own, then merged into `report`."""
+    files = as_files(files)
+    start = time.perf_counter()
+    for i, file in enumerate(files):
+        part = IngestReport(report.kind)
+        done = report.rows_loaded
+
+        def tick(r: IngestReport):
+            report.rows_loaded = done + r.rows_loaded
+            progress(report)
+
+        try:
+            yield from _parsed(file, part, required, parse_chunk, chunk_rows, tick if progress else None,
+                               on_error=on_error)
+        except (ValueError, OSError, EOFError) as e:
+            if len(files) == 1:
+                raise
+            raise ValueError(f"{_source(file, i)}: {e}") from e
+        report.rows_loaded = done
+        report.merge(part, _source(file, i) if len(files) > 1 else None)
+    report.seconds = time.perf_counter() - start
+
+
+def iter_claims(files, report: IngestReport, chunk_rows: int = CSV_CHUNK_ROWS,
+                progress: Optional[Callable[[IngestReport], None]] = None,
+                on_error: str = "fail") -> Iterator[ClaimStore]:
+    """
+    Claims one parsed chunk at a time, each with its own key table, for sinks
+    that never hold the file; several files are read one after another. With
+    invalid rows the iterator raises after a file's last chunk unless `on_error="skip"`.
+    """
+    return _iter_files(files, report, CLAIMS_REQUIRED_COLUMNS, _parse_claims, chunk_rows, progress, on_error)
+
+
+def iter_invoices(files, report: IngestReport, chunk_rows: int = CSV_CHUNK_ROWS,
+                  progress: Optional[Callable[[IngestReport], None]] = None,
+                  on_error: str = "fail") -> Iterator[InvoiceStore]:
+    """Invoices one parsed chunk at a time (see iter_claims)."""
+    return _iter_files(files, report, INVOICES_REQUIRED_COLUMNS, _parse_invoices, chunk_rows, progress, on_error)
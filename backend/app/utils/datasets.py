@@ -0,0 +1,253 @@
+"""
+Named datasets, each with its own ReconciliationService.
+
+Resident datasets are kept in least-recently-used order within a memory
+budget. When the budget is exceeded, the coldest unpinned datasets are
+dropped; one without an up-to-date snapshot is first written to its snapshot
+directory by a background thread, outside the registry lock, and stays
+resident (and served) until that succeeds. The next request for a dropped
+dataset memory-maps it back.
+
+With SHARED_STORE several API processes share DATASET_DIR. A watcher thread
+catches the resident datasets (and the patient directory) up with what other
+processes published every SHARED_REFRESH_SECONDS, outside the registry lock;
+reads keep serving the version they find until the new one is published.
+Writers take an exclusive file lock per dataset, catch up to the newest
+snapshot, apply their change and snapshot the result before releasing the lock.
+
+With STORAGE_BACKEND=sqlite each dataset is a database file instead
+(SqliteReconciliationService); it holds next to nothing in memory, so the
+budget never spills it.
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process writer lock, single-process use only
+    fcntl = None
+
+from app.config import DATASET_DIR, DATASET_MEMORY_BUDGET_MB, SHARED_REFRESH_SECONDS, SHARED_STORE, STORAGE_BACKEND
+from app.logger import get_logger
+from app.utils.patients import get_patients
+from app.utils.reconciliation import ReconciliationService
+from app.utils.snapshot import LATEST
+from app.utils.sqlite_backend import DATABASE, SqliteReconciliationService
+from app.utils.versions import render_summary
+
+logger = get_logger(__name__)
+
+
+class DatasetRegistry:
+    def __init__(self, root: str = DATASET_DIR, budget_bytes: int = DATASET_MEMORY_BUDGET_MB * 1024 * 1024,
+                 shared: bool = SHARED_STORE, backend: str = STORAGE_BACKEND):
+        if backend not in ("memory", "sqlite"):
+            raise ValueError(f"Unknown storage backend: {backend}")
+        self.root = Path(root)
+        self.backend = backend
+        self.budget_bytes = budget_bytes
+        self.shared = shared
+        self._resident: "OrderedDict[str, ReconciliationService]" = OrderedDict()
+        self._pins: Dict[str, int] = {}
+        self._write_locks: Dict[str, threading.Lock] = {}  # one writer per dataset in this process
+        self._spilling: Dict[str, Future] = {}  # datasets being saved before they are dropped
+        self._saver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spill")
+        self._watcher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.RLock()
+
+    def _on_disk(self, name: str) -> bool:
+        path = self.root / name
+        return (path / LATEST).exists() or (path / DATABASE).exists()
+
+    def _open(self, name: str) -> ReconciliationService:
+        path = str(self.root / name)
+        if self.backend == "sqlite":
+            return SqliteReconciliationService(snapshot_dir=path)
+        return ReconciliationService(snapshot_dir=path)
+
+    def get(self, name: str, create: bool = False) -> ReconciliationService:
+        """The dataset's service, reloaded from disk if it was spilled; KeyError if unknown."""
+        with self._lock:
+            service = self._resident.get(name)
+            if service is not None:
+                self._resident.move_to_end(name)
+                return service
+            if not create and not self._on_disk(name):
+                raise KeyError(name)
+            service = self._open(name)
+            service.load_snapshot()
+            self._resident[name] = service
+            self._enforce_budget()
+            return service
+
+    def pin(self, name: str) -> ReconciliationService:
+        """get(create=True), and keep the dataset resident until unpin() (e.g. while a job writes to it)."""
+        with self._lock:
+            service = self.get(name, create=True)
+            self._pins[name] = self._pins.get(name, 0) + 1
+            return service
+
+    def unpin(self, name: str):
+        with self._lock:
+            self._pins[name] -= 1
+            if not self._pins[name]:
+                del self._pins[name]
+            self._enforce_budget()
+
+    @contextmanager
+    def writer(self, name: str) -> Iterator[ReconciliationService]:
+        """
+        Exclusive write access to a dataset: pinned, and in shared mode locked
+        against other processes and caught up with their latest snapshot.
+        """
+        service = self.pin(name)
+        with self._lock:
+            local = self._write_locks.setdefault(name, threading.Lock())
+        lock = None
+        local.acquire()
+        try:
+            if self.shared and fcntl is not None:
+                (self.root / name).mkdir(parents=True, exist_ok=True)
+                lock = open(self.root / name / ".writer.lock", "w")
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.shared:
+                service.refresh()
+            yield service
+        finally:
+            if lock is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
+            local.release()
+            self.unpin(name)
+
+    def render_summaries(self):
+        """Re-render the resident datasets' default summaries with a replaced patient directory's names."""
+        for service in list(self._resident.values()):
+            if service.current is not None:
+                render_summary(service.current)
+
+    def refresh(self):
+        """
+        Shared mode: catch the patient directory and every resident dataset up
+        with other processes' publishes. Each dataset is refreshed under its
+        writer lock but outside the registry lock; one a local writer holds is
+        skipped, as the writer catches up itself.
+        """
+        if get_patients().refresh():
+            self.render_summaries()
+        with self._lock:
+            resident = list(self._resident.items())
+        for name, service in resident:
+            with self._lock:
+                local = self._write_locks.setdefault(name, threading.Lock())
+            if not local.acquire(blocking=False):
+                continue
+            try:
+                service.refresh()
+            except Exception:
+                logger.exception("dataset %s could not be refreshed", name)
+            finally:
+                local.release()
+
+    def start_watcher(self, interval: float = SHARED_REFRESH_SECONDS):
+        """Shared mode: refresh() every `interval` seconds on a background thread until stop_watcher()."""
+        if not self.shared or self._watcher is not None:
+            return
+        self._stop.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), name="shared-refresh", daemon=True)
+        self._watcher.start()
+
+    def stop_watcher(self):
+        if self._watcher is not None:
+            self._stop.set()
+            self._watcher.join()
+            self._watcher = None
+
+    def _watch(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("shared store refresh failed")
+
+    def sync_patients(self):
+        """
+        Bring the datasets up to a replaced patient directory, so no read
+        renders or writes anything for it: summaries are re-rendered, and every
+        SQLite dataset's patients table (read by name filters) is rewritten.
+        """
+        self.render_summaries()
+        if self.backend != "sqlite":
+            return  # the in-memory engine filters on the directory itself
+        names = set(self._resident)
+        if self.root.exists():
+            names |= {p.name for p in self.root.iterdir() if (p / DATABASE).exists()}
+        for name in sorted(names):
+            with self.writer(name) as service:
+                service.sync_patients()
+
+    def resident_bytes(self) -> int:
+        return sum(s.nbytes for s in list(self._resident.values()))
+
+    def _enforce_budget(self):
+        total = self.resident_bytes()
+        for name in list(self._resident)[:-1]:  # never the most recently used one
+            if total <= self.budget_bytes:
+                break
+            if name in self._pins or name in self._spilling:
+                continue
+            service = self._resident[name]
+            size = service.nbytes
+            if service.claims and service.saved_version != service.version:
+                self._spilling[name] = self._saver.submit(self._save, name, service)
+            else:
+                del self._resident[name]
+                logger.info("dataset %s spilled bytes=%d", name, size)
+            total -= size
+
+    def _save(self, name: str, service: ReconciliationService):
+        """Spill thread: write the dataset's snapshot, then drop it if it is still cold and unpinned."""
+        with self._lock:
+            local = self._write_locks.setdefault(name, threading.Lock())
+        try:
+            with local:  # never while a writer edits it
+                if service.saved_version != service.version:
+                    service.save_snapshot()
+        except Exception:
+            logger.exception("dataset %s could not be spilled; it stays resident", name)
+            return
+        finally:
+            with self._lock:
+                del self._spilling[name]
+        with self._lock:
+            self._enforce_budget()  # drops it now, without writing, unless it was used or changed meanwhile
+
+    def drain(self):
+        """Wait for the spills in flight, and the ones they trigger (tests, shutdown)."""
+        while True:
+            with self._lock:
+                pending = list(self._spilling.values())
+            if not pending:
+                return
+            wait(pending)
+
+    def stats(self) -> List[Dict]:
+        """Per-dataset residency, size and version, for /api/datasets."""
+        with self._lock:
+            rows = [
+                {"name": name, "resident": True, "resident_bytes": s.nbytes, "version": s.version,
+                 "claims": len(s.claims), "results": len(s.current) if s.current else 0}
+                for name, s in self._resident.items()
+            ]
+            if self.root.exists():
+                rows += [
+                    {"name": p.name, "resident": False, "resident_bytes": 0}
+                    for p in sorted(self.root.iterdir())
+                    if p.name not in self._resident and self._on_disk(p.name)
+                ]
+            return rows
@@ -0,0 +1,98 @@
+"""
+Row-by-row CSV / NDJSON / JSON serialization straight from the result store.
+
+Rows are formatted one bounded batch of row tuples at a time (see
+column_rows), so neither Pydantic models nor a full JSON document are ever
+built. JSON is encoded with orjson when it is installed.
+"""
+import csv
+import io
+import json
+from datetime import date
+from typing import Any, Callable, Dict, Iterable, Iterator
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # the standard library encoder is several times slower, same output
+    orjson = None
+
+from app.utils.store import STATUS_LABELS, ResultStore
+
+EXPORT_COLUMNS = ("claim_id", "patient_id", "patient_name", "date_of_service",
+                  "charges_amount", "invoice_total", "status", "credit")
+
+
+def _money(cents: int) -> str:
+    sign = "-" if cents < 0 else ""
+    whole, frac = divmod(abs(cents), 100)
+    return f"{sign}{whole}.{frac:02d}"
+
+
+def column_rows(results: ResultStore, rows: np.ndarray, patient_name: Callable[[int], str]):
+    """
+    Export tuples of the given rows: claim_id, patient_id, patient_name, ISO date,
+    charges, invoice total and credit (cents), status label, matched flag.
+    """
+    claims = results.claims
+    matched = (results.invoice_count[rows] > 0).tolist()
+    patient_ids = claims.patient_id[rows].tolist()
+    return zip(
+        (claims.keys[k] for k in claims.key[rows].tolist()),
+        patient_ids,
+        (patient_name(p) for p in patient_ids),
+        (date.fromordinal(d).isoformat() for d in claims.date_of_service[rows].tolist()),
+        claims.charges_cents[rows].tolist(),
+        results.invoice_cents[rows].tolist(),
+        (STATUS_LABELS[s] for s in results.status[rows].tolist()),
+        results.credit_cents[rows].tolist(),
+        matched,
+    )
+
+
+def dumps(content: Any) -> bytes:
+    """Compact JSON bytes, as FastAPI's JSONResponse would render `content`."""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    from fastapi.encoders import jsonable_encoder
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def json_record(row: tuple) -> Dict:
+    """A column_rows tuple as the JSON object of a ReconciliationResult."""
+    claim_id, pid, name, dos, charges, invoices, status, credit, matched = row
+    return {
+        "claim_id": claim_id,
+        "patient_id": str(pid),
+        "patient_name": name,
+        "date_of_service": dos,
+        "charges_amount": charges / 100,
+        "invoice_total": invoices / 100 if matched else None,
+        "status": status,
+        "credit": credit / 100 if matched else None,
+    }
+
+
+def iter_csv(batches: Iterable[Iterable[tuple]]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in batches:
+        for claim_id, pid, name, dos, charges, invoices, status, credit, matched in rows:
+            writer.writerow((
+                claim_id, pid, name, dos, _money(charges),
+                _money(invoices) if matched else "", status, _money(credit) if matched else "",
+            ))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_ndjson(batches: Iterable[Iterable[tuple]]) -> Iterator[bytes]:
+    for rows in batches:
+        lines = [dumps(json_record(row)) for row in rows]
+        if lines:
+            yield b"\n".join(lines) + b"\n"
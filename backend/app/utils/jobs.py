@@ -0,0 +1,177 @@
+"""
+Background jobs for uploads.
+
+Parsing and reconciliation run on a single worker thread so the event loop
+keeps serving reads; jobs are serialized because they all mutate the one
+ReconciliationService. Each job reports which stage it is in, how long each
+finished stage took, running counts and, once done, its result.
+
+With a store directory (SHARED_STORE), every change of a job is also written
+there as JSON, so any API process can answer for jobs another one runs.
+"""
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from app.config import DATASET_DIR, JOB_HISTORY, SHARED_STORE
+from app.logger import get_logger
+from app.utils.metrics import metrics
+
+logger = get_logger(__name__)
+
+STAGES = ("parse", "index", "reconcile", "analytics", "snapshot")
+
+
+class JobFailed(Exception):
+    """Raised inside a job to fail it with user-facing error messages."""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+class Job:
+    def __init__(self, kind: str, store: Optional[Path] = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"  # queued -> running -> done | failed
+        self.stage: Optional[str] = None
+        self.stages = {name: {"status": "pending", "seconds": None} for name in STAGES}
+        self.counts: Dict[str, int] = {}
+        self.result: Optional[Dict] = None
+        self.errors: List[str] = []
+        self.created_at = time.time()
+        self.future: Optional[Future] = None
+        self._stage_started = 0.0
+        self._lock = threading.Lock()
+        self._store = store
+
+    def _save(self):
+        if self._store is None:
+            return
+        tmp = self._store / f".{self.id}.tmp"
+        tmp.write_text(json.dumps(self.to_dict(), default=str))
+        os.replace(tmp, self._store / f"{self.id}.json")
+
+    def enter(self, stage: str):
+        """Finish the current stage and start `stage`; a no-op if `stage` is already running."""
+        with self._lock:
+            if stage == self.stage and self.stages[stage]["status"] == "running":
+                return
+            self._finish_stage()
+            self.stage = stage
+            self.stages[stage]["status"] = "running"
+            self._stage_started = time.perf_counter()
+        self._save()
+
+    def update(self, **counts: int):
+        with self._lock:
+            self.counts.update(counts)
+        self._save()
+
+    def _finish_stage(self):
+        if self.stage is not None and self.stages[self.stage]["status"] == "running":
+            seconds = time.perf_counter() - self._stage_started
+            self.stages[self.stage].update(status="done", seconds=round(seconds, 4))
+            metrics.observe("job_stage_seconds", seconds, kind=self.kind, stage=self.stage)
+
+    def _run(self, work: Callable[["Job"], Dict]):
+        self.status = "running"
+        self._save()
+        start = time.perf_counter()
+        try:
+            result = work(self)
+        except JobFailed as e:
+            self._end("failed", errors=e.errors)
+        except Exception as e:  # surfaced through /api/jobs, not lost in the pool
+            logger.exception("job %s failed", self.id)
+            self._end("failed", errors=[str(e)])
+        else:
+            self._end("done", result=result)
+        metrics.inc("jobs_total", kind=self.kind, status=self.status)
+        logger.info("job %s kind=%s status=%s seconds=%.3f", self.id, self.kind, self.status,
+                    time.perf_counter() - start)
+        return self
+
+    def _end(self, status: str, result: Optional[Dict] = None, errors: Optional[List[str]] = None):
+        with self._lock:
+            if status == "done":
+                self._finish_stage()
+            elif self.stage is not None:
+                self.stages[self.stage]["status"] = "failed"
+            self.status, self.result, self.errors = status, result, errors or []
+        self._save()
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "kind": self.kind,
+                "status": self.status,
+                "stage": self.stage,
+                "stages": {name: dict(s) for name, s in self.stages.items()},
+                "counts": dict(self.counts),
+                "result": self.result,
+                "errors": list(self.errors),
+                "created_at": self.created_at,
+            }
+
+
+class JobManager:
+    """Runs jobs one at a time on a worker thread and remembers the last JOB_HISTORY of them."""
+
+    def __init__(self, history: int = JOB_HISTORY,
+                 store: Optional[str] = os.path.join(DATASET_DIR, ".jobs") if SHARED_STORE else None):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job")
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._history = history
+        self._lock = threading.Lock()
+        self._store = Path(store) if store else None
+        if self._store is not None:
+            self._store.mkdir(parents=True, exist_ok=True)
+
+    def submit(self, kind: str, work: Callable[[Job], Dict]) -> Job:
+        job = Job(kind, self._store)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self._history:
+                oldest = next(iter(self._jobs.values()))
+                if oldest.status in ("queued", "running"):
+                    break
+                self._jobs.popitem(last=False)
+        job._save()
+        self._prune_store()
+        job.future = self._executor.submit(job._run, work)
+        return job
+
+    def _prune_store(self):
+        if self._store is None:
+            return
+        files = sorted(self._store.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        for path in files[:max(len(files) - self._history, 0)]:
+            path.unlink(missing_ok=True)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def status(self, job_id: str) -> Optional[Dict]:
+        """to_dict() of a job run by this process or, with a store, by any other."""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if self._store is None or not re.fullmatch(r"[0-9a-f]{32}", job_id):
+            return None
+        try:
+            return json.loads((self._store / f"{job_id}.json").read_text())
+        except FileNotFoundError:
+            return None
+
+    def active(self) -> bool:
+        return any(job.status in ("queued", "running") for job in list(self._jobs.values()))
@@ -0,0 +1,132 @@
+"""
+Process-wide counters, gauges and latency histograms, rendered for /metrics
+in the Prometheus text format.
+
+Hot paths record into the module-level `metrics` registry: CSV reading and
+validation, reconcile stages, job stages, HTTP requests. Values that already
+live elsewhere (render cache counters, dataset sizes, peak RSS) are read
+when /metrics is scraped. `timed()` also writes each stage as a structured
+log line, so a slow upload can be broken down from the logs alone.
+"""
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple
+
+from app.logger import get_logger
+
+logger = get_logger(__name__)
+
+PREFIX = "recon_"
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# name -> (type, help); every recorded metric is declared here
+DEFINITIONS = {
+    "ingest_rows_total": ("counter", "CSV rows read from uploads, by file kind and outcome (loaded/rejected)."),
+    "ingest_bytes_total": ("counter", "Bytes of uploaded CSV read (compressed size for gzip/zstd), by file kind."),
+    "ingest_duplicate_ids_total": ("counter", "Distinct ids found on more than one row of an upload, by file kind."),
+    "stage_seconds": ("histogram", "Duration of pipeline stages (csv_read, csv_validate, index, reconcile, "
+                                   "analytics, publish, upsert)."),
+    "job_stage_seconds": ("histogram", "Duration of upload job stages as reported by /api/jobs."),
+    "jobs_total": ("counter", "Finished jobs, by kind and status."),
+    "http_requests_total": ("counter", "HTTP requests, by route and status code."),
+    "http_request_seconds": ("histogram", "HTTP request latency until the response starts, by route."),
+    "render_cache_hits_total": ("counter", "Pre-rendered response cache hits."),
+    "render_cache_misses_total": ("counter", "Pre-rendered response cache misses."),
+    "render_cache_bytes": ("gauge", "Bytes held by the pre-rendered response cache."),
+    "dataset_results": ("gauge", "Results in the published version, per resident dataset."),
+    "dataset_resident_bytes": ("gauge", "Resident bytes per dataset."),
+    "process_peak_rss_bytes": ("gauge", "Peak resident set size of this process."),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    def __init__(self):
+        self._values: Dict[str, Dict[Labels, float]] = {name: {} for name in DEFINITIONS}
+        self._histograms: Dict[str, Dict[Labels, list]] = {}  # name -> labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels: Dict[str, object]) -> Labels:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._values[name][self._labels(labels)] = value
+
+    def clear(self, name: str):
+        with self._lock:
+            self._values[name].clear()
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    counts[i] += 1
+            counts[-2] += seconds
+            counts[-1] += 1
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in DEFINITIONS.items():
+                full = PREFIX + name
+                lines += [f"# HELP {full} {help_text}", f"# TYPE {full} {kind}"]
+                if kind == "histogram":
+                    for labels, counts in self._histograms.get(name, {}).items():
+                        for bound, count in zip(BUCKETS, counts):
+                            lines.append(f"{full}_bucket{_format(labels + (('le', repr(bound)),))} {count}")
+                        lines.append(f"{full}_bucket{_format(labels + (('le', '+Inf'),))} {counts[-1]}")
+                        lines.append(f"{full}_sum{_format(labels)} {counts[-2]!r}")
+                        lines.append(f"{full}_count{_format(labels)} {counts[-1]}")
+                else:
+                    for labels, value in self._values[name].items():
+                        lines.append(f"{full}{_format(labels)} {value!r}")
+        return "\n".join(lines) + "\n"
+
+
+def _format(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def timed(stage: str, **fields) -> Iterator[Dict]:
+    """
+    Time a pipeline stage into stage_seconds{stage} and log it as one structured
+    line; fields added to the yielded dict inside the block are logged too.
+    """
+    start = time.perf_counter()
+    extra = dict(fields)
+    try:
+        yield extra
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe("stage_seconds", seconds, stage=stage)
+        extra.update(stage=stage, seconds=round(seconds, 4))
+        logger.info("stage %s", " ".join(f"{k}={v}" for k, v in extra.items()), extra={"fields": extra})
+
+
+def peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # bytes on macOS, KiB on Linux
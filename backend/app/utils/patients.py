@@ -0,0 +1,322 @@
+"""
+The patient directory: patient names by integer patient_id.
+
+Ids are one sorted int64 array and names one UTF-8 byte blob with offsets,
+so tens of millions of patients cost the bytes of their names plus 16 per
+patient, and a saved directory is memory-mapped instead of parsed. A
+case-folded copy of the names, kept in sorted order, answers patient-name
+prefix filters with two binary searches. Names are decoded one at a time,
+only for the rows a response returns; results never store them.
+
+A directory is replaced whole (POST /api/patients): the new one is written
+to PATIENT_DIR under a new generation and swapped in with one reference
+assignment, without reconciling anything again. Until the first upload the
+bundled app/data/patients.csv is used.
+"""
+import bisect
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from app.config import CSV_CHUNK_ROWS, PATIENT_DIR
+from app.logger import get_logger
+from app.utils.csv_loader import IngestReport, _check, _parse_ids, _parsed
+
+logger = get_logger(__name__)
+
+BUNDLED_CSV = Path(__file__).parent.parent / "data" / "patients.csv"
+PATIENTS_REQUIRED_COLUMNS = {"patient_id", "name"}
+ARRAYS = ("ids", "offsets", "blob", "folded_rows", "folded_offsets", "folded_blob")
+SORT_KEY_BYTES = 24  # leading bytes of each folded name sorted with NumPy; longer ties are sorted in Python
+GATHER_ROWS = 1_000_000  # names copied per step when reordering, bounding the temporary index arrays
+
+
+def default_name(patient_id: int) -> str:
+    return f"Patient {patient_id}"
+
+
+def _pack(names: List[pd.Series], fold: bool = False):
+    """Names (case-folded if `fold`) as one UTF-8 (blob, offsets) pair."""
+    # one NUL-terminated string for all names: encoding and folding run once, not per name
+    text = "".join("\0".join(s) + "\0" for s in names)
+    if text.count("\0") != sum(len(s) for s in names):  # a name holds a NUL itself: drop those
+        text = "".join("\0".join(s.str.replace("\0", "", regex=False)) + "\0" for s in names)
+    data = np.frombuffer((text.casefold() if fold else text).encode("utf-8"), dtype=np.uint8)
+    ends = np.flatnonzero(data == 0)
+    offsets = np.zeros(len(ends) + 1, dtype=np.int64)
+    offsets[1:] = ends - np.arange(len(ends))
+    return data[data != 0], offsets
+
+
+def _gather(blob: np.ndarray, offsets: np.ndarray, rows: np.ndarray):
+    """The byte strings at `rows`, in that order, as a new (blob, offsets) pair."""
+    lengths = offsets[rows + 1] - offsets[rows]
+    new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    out = np.empty(int(new_offsets[-1]), dtype=np.uint8)
+    for start in range(0, len(rows), GATHER_ROWS):
+        part = slice(start, start + GATHER_ROWS)
+        lo, hi = new_offsets[start], new_offsets[min(start + GATHER_ROWS, len(rows))]
+        shift = np.repeat(offsets[rows[part]] - new_offsets[part.start:part.start + len(lengths[part])],
+                          lengths[part])
+        out[lo:hi] = blob[np.arange(lo, hi) + shift]
+    return out, new_offsets
+
+
+def _sorted_rows(blob: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Row order of the byte strings in (blob, offsets), sorted bytewise."""
+    n = len(offsets) - 1
+    lengths = np.diff(offsets)
+    keys = np.zeros((n, SORT_KEY_BYTES), dtype=np.uint8)  # zero padding sorts shorter strings first
+    columns = np.arange(SORT_KEY_BYTES)
+    for start in range(0, n, GATHER_ROWS):
+        part = slice(start, min(start + GATHER_ROWS, n))
+        present = columns < lengths[part, None]
+        source = offsets[part, None] + columns
+        block = np.zeros((part.stop - part.start, SORT_KEY_BYTES), dtype=np.uint8)
+        block[present] = blob[source[present]]
+        keys[part] = block
+    words = keys.view(">u8")
+    order = np.lexsort(tuple(words[:, i] for i in reversed(range(words.shape[1]))))
+
+    # runs sharing the whole key are only ordered once a member is longer than the key
+    sorted_words = words[order]
+    starts = np.flatnonzero(np.r_[True, (sorted_words[1:] != sorted_words[:-1]).any(axis=1)])
+    ends = np.r_[starts[1:], n]
+    long = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(lengths[order] > SORT_KEY_BYTES, out=long[1:])
+    tied = (ends - starts > 1) & (long[ends] > long[starts])
+    for lo, hi in zip(starts[tied], ends[tied]):
+        order[lo:hi] = sorted(order[lo:hi], key=lambda r: blob[offsets[r]:offsets[r + 1]].tobytes())
+    return order
+
+
+class _Folded(Sequence):
+    """The sorted case-folded names as a sequence of bytes, for bisect."""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob, self.offsets = blob, offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+
+class PatientDirectory:
+    """An immutable patient_id -> name directory (see the module docstring)."""
+
+    def __init__(self, generation: str, ids: np.ndarray, offsets: np.ndarray, blob: np.ndarray,
+                 folded_rows: np.ndarray, folded_offsets: np.ndarray, folded_blob: np.ndarray):
+        self.generation = generation
+        self.ids = ids                      # int64, sorted, unique
+        self.offsets = offsets              # int64, len(ids) + 1: name i is blob[offsets[i]:offsets[i + 1]]
+        self.blob = blob                    # uint8, UTF-8 names in id order
+        self.folded_rows = folded_rows      # int64: rows (into ids) in case-folded name order
+        self.folded_offsets = folded_offsets
+        self.folded_blob = folded_blob      # uint8, case-folded names in that order
+        self._folded = _Folded(folded_blob, folded_offsets)
+
+    @classmethod
+    def empty(cls, generation: str = "empty") -> "PatientDirectory":
+        return cls.from_names(np.empty(0, dtype=np.int64), [], generation)
+
+    @classmethod
+    def from_names(cls, ids: np.ndarray, names: List[str], generation: Optional[str] = None) -> "PatientDirectory":
+        """A directory from parallel ids and names; the last name of a repeated id wins."""
+        return cls._build([_PatientChunk(np.asarray(ids, dtype=np.int64), pd.Series(names, dtype=object))],
+                          generation)
+
+    @classmethod
+    def _build(cls, chunks: List["_PatientChunk"], generation: Optional[str] = None) -> "PatientDirectory":
+        ids = np.concatenate([c.ids for c in chunks] or [np.empty(0, dtype=np.int64)])
+        names = [c.names for c in chunks if len(c)]
+        # id order, keeping the last row of each id
+        order = np.argsort(ids, kind="stable")
+        rows = order[np.r_[ids[order][1:] != ids[order][:-1], True]] if len(ids) else order
+        blob, offsets = _gather(*_pack(names), rows)
+        folded_blob, folded_offsets = _gather(*_pack(names, fold=True), rows)
+        folded_rows = _sorted_rows(folded_blob, folded_offsets)
+        folded_blob, folded_offsets = _gather(folded_blob, folded_offsets, folded_rows)
+        return cls(generation or f"{time.time_ns():020d}", ids[rows], offsets, blob, folded_rows,
+                   folded_offsets, folded_blob)
+
+    @classmethod
+    def from_csv(cls, file, report: Optional[IngestReport] = None, chunk_rows: int = CSV_CHUNK_ROWS,
+                 generation: Optional[str] = None,
+                 progress: Optional[Callable[[IngestReport], None]] = None) -> "PatientDirectory":
+        """
+        Stream a patient_id,name CSV (an UploadFile or anything with .file) into a
+        directory. Rows without an integer id are rejected and reported.
+        """
+        report = report or IngestReport("patients")
+        chunks = list(_parsed(file, report, PATIENTS_REQUIRED_COLUMNS, _parse_patients, chunk_rows, progress,
+                              keys=_NO_KEYS, on_error="skip"))
+        directory = cls._build(chunks, generation)
+        directory.report = report
+        return directory
+
+    # --- lookups -------------------------------------------------------------------------------
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    def _row(self, patient_id: int) -> int:
+        i = int(np.searchsorted(self.ids, patient_id))
+        return i if i < len(self.ids) and self.ids[i] == patient_id else -1
+
+    def name(self, patient_id: int) -> str:
+        i = self._row(patient_id)
+        if i < 0:
+            return default_name(patient_id)
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def known(self, patient_ids: np.ndarray) -> np.ndarray:
+        """Per id, whether the directory names it."""
+        i = np.minimum(np.searchsorted(self.ids, patient_ids), max(len(self.ids) - 1, 0))
+        return self.ids[i] == patient_ids if len(self.ids) else np.zeros(len(patient_ids), dtype=bool)
+
+    def matching(self, prefix: str) -> np.ndarray:
+        """Sorted ids of the listed patients whose case-folded name starts with `prefix` (case-folded)."""
+        key = prefix.casefold().encode("utf-8")
+        lo = bisect.bisect_left(self._folded, key)
+        hi = bisect.bisect_left(self._folded, key + b"\xff", lo)  # no UTF-8 byte is 0xff
+        return np.sort(self.ids[self.folded_rows[lo:hi]])
+
+    # --- persistence ---------------------------------------------------------------------------
+
+    def save(self, root: Path) -> Path:
+        """Write the arrays to root/<generation>/, via a temporary directory renamed into place."""
+        root.mkdir(parents=True, exist_ok=True)
+        tmp = root / f".{self.generation}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir()
+        for name in ARRAYS:
+            np.save(tmp / f"{name}.npy", getattr(self, name))
+        path = root / self.generation
+        os.replace(tmp, path)
+        return path
+
+    @classmethod
+    def load(cls, path: Path) -> "PatientDirectory":
+        """Memory-map a saved directory."""
+        arrays = {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in ARRAYS}
+        return cls(path.name, **arrays)
+
+
+class _PatientChunk:
+    """The ids and names of one parsed CSV chunk."""
+
+    def __init__(self, ids: np.ndarray, names: pd.Series):
+        self.ids, self.names = ids, names
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+_NO_KEYS = object()  # csv_loader hands every chunk parser a key table; patients intern nothing
+
+
+def _parse_patients(chunk: pd.DataFrame, report: IngestReport, keys) -> _PatientChunk:
+    patient_id, patient_id_ok = _parse_ids(chunk["patient_id"])
+    ok = np.ones(len(chunk), dtype=bool)
+    ok = _check(chunk, report, ok, "patient_id", patient_id_ok)
+    return _PatientChunk(patient_id[ok], chunk["name"][ok].reset_index(drop=True))
+
+
+def latest(root: Path) -> Optional[Path]:
+    """The newest complete saved directory under root, if any."""
+    if not root.exists():
+        return None
+    saved = sorted(p for p in root.iterdir() if p.is_dir() and not p.name.startswith("."))
+    return saved[-1] if saved else None
+
+
+class Patients:
+    """
+    The process's current PatientDirectory. Readers take `directory` once per
+    use; replace() saves a new one and swaps it in.
+    """
+
+    def __init__(self, root: Optional[str] = PATIENT_DIR, directory: Optional[PatientDirectory] = None):
+        self.root = Path(root) if root else None
+        self.replaced_at = 0.0  # when the directory last changed under published results
+        self._directory = directory
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self) -> PatientDirectory:
+        directory = self._directory
+        if directory is None:
+            with self._lock:
+                if self._directory is None:
+                    self._directory = self._initial()
+                directory = self._directory
+        return directory
+
+    def _initial(self) -> PatientDirectory:
+        saved = latest(self.root) if self.root else None
+        if saved is not None:
+            logger.info("patients mapped from %s", saved)
+            return PatientDirectory.load(saved)
+        if BUNDLED_CSV.exists():
+            with open(BUNDLED_CSV, "rb") as f:
+                return PatientDirectory.from_csv(SimpleNamespace(file=f), generation="bundled")
+        return PatientDirectory.empty()
+
+    @property
+    def generation(self) -> str:
+        return self.directory.generation
+
+    def name(self, patient_id: int) -> str:
+        return self.directory.name(patient_id)
+
+    def replace(self, directory: PatientDirectory) -> PatientDirectory:
+        """Persist `directory` (with a root) and make it current; older saved generations are removed."""
+        if self.root is not None:
+            path = directory.save(self.root)
+            directory = PatientDirectory.load(path)
+            for old in self.root.iterdir():
+                if old.is_dir() and old.name != path.name and not old.name.startswith("."):
+                    shutil.rmtree(old, ignore_errors=True)  # mapped files stay readable until unmapped
+        with self._lock:
+            self._directory = directory
+            self.replaced_at = time.time()
+        logger.info("patients replaced generation=%s patients=%d", directory.generation, len(directory))
+        return directory
+
+    def refresh(self) -> bool:
+        """Map a newer directory saved by another process (SHARED_STORE); True if it changed."""
+        if self.root is None:
+            return False
+        saved = latest(self.root)
+        if saved is None or saved.name == self.directory.generation:
+            return False
+        with self._lock:
+            self._directory = PatientDirectory.load(saved)
+            self.replaced_at = time.time()
+        return True
+
+    def stats(self) -> Dict:
+        directory = self.directory
+        return {"generation": directory.generation, "patients": len(directory), "bytes": directory.nbytes}
+
+
+patients = Patients()  # loaded on first use
+
+
+def get_patients() -> Patients:
+    """The process-wide patient directory, shared by every dataset."""
+    return patients
@@ -0,0 +1,136 @@
+"""
+Opt-in sampling profiler for single requests.
+
+While a profiled request runs, a background thread snapshots the Python
+stacks (sys._current_frames) of the threads working on that request each
+PROFILE_INTERVAL_MS and counts identical stacks. Those are the thread that
+started the profile (the event loop, which runs the async routes) and any
+threadpool thread while it runs a sampled() route or advances an iterator
+wrapped in profiled(), such as a streamed export body. The middleware keeps sampling until the last
+chunk of the response body is sent. The result is written in the
+collapsed-stack format ("thread;outer;...;inner count" per line) read by
+flamegraph.pl and speedscope.
+"""
+import functools
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+from app.config import PROFILE_INTERVAL_MS
+
+T = TypeVar("T")
+
+# the profiler of the request this context belongs to; threadpool calls inherit the context
+_active: ContextVar[Optional["SamplingProfiler"]] = ContextVar("profiler", default=None)
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._threads: Counter = Counter()  # ident -> how many attached() blocks it is in
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+
+    def start(self) -> "SamplingProfiler":
+        """Sample the calling thread until stop(), and make this the profiler of the calling context."""
+        self._threads[threading.get_ident()] += 1
+        _active.set(self)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    @contextmanager
+    def attached(self):
+        """Sample the calling thread too while the block runs."""
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._threads[ident] -= 1
+                if not self._threads[ident]:
+                    del self._threads[ident]
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                idents = list(self._threads)
+            frames = sys._current_frames()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    @staticmethod
+    def path(directory: str, label: str) -> Path:
+        """A new file name in `directory` for a profile named after `label`."""
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9_-]+", "_", label).strip("_")
+        return path / f"{int(time.time() * 1000)}-{slug}.folded"
+
+    def write(self, path: Path) -> Path:
+        """Write the collapsed stacks to `path` (see path())."""
+        path.write_text(self.collapsed())
+        return path
+
+
+def sampled(func: Callable[..., T]) -> Callable[..., T]:
+    """
+    `func`, with the calling thread sampled by the request's profiler while it
+    runs; for plain `def` routes, which FastAPI calls in its threadpool.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs) -> T:
+        profiler = _active.get()
+        if profiler is None:
+            return func(*args, **kwargs)
+        with profiler.attached():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def profiled(items: Iterable[T]) -> Iterator[T]:
+    """
+    `items`, with whichever thread advances them sampled by the request's
+    profiler while it does; for response bodies Starlette iterates in its threadpool.
+    """
+    profiler = _active.get()
+    if profiler is None:
+        yield from items
+        return
+    items = iter(items)
+    while True:
+        with profiler.attached():
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+        yield item
@@ -0,0 +1,428 @@
+"""
+Secondary indexes over a ResultStore for filtered, sorted result pages.
+
+Built once per reconcile: per-status position lists, per-patient position
+lists and date/charges/credit sort permutations. An upsert patches the
+previous version's index (see ResultIndex.patched) instead of sorting again. Patient-name prefixes are
+looked up in the current patient directory, so replacing it needs no rebuild. A query starts from the smallest indexed candidate set, masks
+it with the remaining filters and orders only the survivors.
+"""
+import base64
+import hashlib
+import json
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.models.schemas import ResultQuery
+from app.utils.patients import Patients, default_name
+from app.utils.store import STATUS_LABELS, ResultStore, to_cents
+
+SORT_FIELDS = ("date_of_service", "charges_amount", "credit")
+
+_FENCE = 64
+_NO_CREDIT = np.iinfo(np.int64).max  # sort key of rows without invoices: after every real credit
+
+
+class ResultIndex:
+    def __init__(self, results: ResultStore, patients: Patients):
+        claims = results.claims
+        self.results = results
+        self.patients = patients
+        n = len(results)
+        pos_dtype = np.int32 if n < np.iinfo(np.int32).max else np.int64
+
+        self.by_status = [np.flatnonzero(results.status == k).astype(pos_dtype) for k in range(len(STATUS_LABELS))]
+
+        # per-patient position lists, as one permutation grouped by patient_id
+        self.patient_order = np.argsort(claims.patient_id, kind="stable").astype(pos_dtype)
+        self.patient_ids, starts = np.unique(claims.patient_id[self.patient_order], return_index=True)
+        self.patient_bounds = np.append(starts, n)
+
+        credit_key = np.where(results.invoice_count > 0, results.credit_cents, _NO_CREDIT)
+        self._set_sort_state(credit_key, {
+            field: np.argsort(key, kind="stable").astype(pos_dtype)
+            for field, key in self._sort_keys(credit_key).items()
+        })
+
+    def patched(self, results: ResultStore, rows: np.ndarray) -> "ResultIndex":
+        """
+        The index of `results`, the next version of this index's results in
+        which only `rows` were rewritten or appended. Every order is carried
+        over; only the rows whose key changed are taken out and merged back in
+        at their new place, so an upsert costs a few O(n) copies, not a sort.
+        """
+        old, claims = self.results, results.claims
+        n, old_n = len(results), len(old)
+        pos_dtype = np.int32 if n < np.iinfo(np.int32).max else np.int64
+        rows = np.unique(rows)
+        kept, added = rows[rows < old_n], np.arange(old_n, n)
+
+        index = ResultIndex.__new__(ResultIndex)
+        index.results = results
+        index.patients = self.patients
+
+        changed = kept[old.status[kept] != results.status[kept]]
+        moved = np.concatenate([changed, added])
+        index.by_status = [
+            _inserted(_deleted(self.by_status[k], changed[old.status[changed] == k]), moved[results.status[moved] == k], pos_dtype)
+            for k in range(len(STATUS_LABELS))
+        ]
+
+        old_pid, pid = old.claims.patient_id, claims.patient_id
+        changed = kept[old_pid[kept] != pid[kept]]
+        index.patient_order = _reordered(self.patient_order, old_pid, pid, changed, added, pos_dtype)
+        index.patient_ids, index.patient_bounds = self.patient_ids, self.patient_bounds
+        if len(changed) or len(added):
+            # regroup by counting rows per patient instead of scanning the new order
+            leaving, arriving = old_pid[changed], pid[np.concatenate([changed, added])]
+            ids = np.union1d(self.patient_ids, arriving)
+            counts = np.zeros(len(ids), dtype=np.int64)
+            counts[np.searchsorted(ids, self.patient_ids)] = np.diff(self.patient_bounds)
+            np.subtract.at(counts, np.searchsorted(ids, leaving), 1)
+            np.add.at(counts, np.searchsorted(ids, arriving), 1)
+            index.patient_ids, counts = ids[counts > 0], counts[counts > 0]
+            index.patient_bounds = np.concatenate([[0], np.cumsum(counts)])
+
+        credit_key = np.concatenate([self.credit_key, np.empty(n - old_n, dtype=np.int64)])
+        credit_key[rows] = np.where(results.invoice_count[rows] > 0, results.credit_cents[rows], _NO_CREDIT)
+        keys = index._sort_keys(credit_key)
+        permutations = {}
+        for field, key in self.sort_keys.items():
+            changed = kept[key[kept] != keys[field][kept]]
+            permutations[field] = _reordered(self.permutations[field], key, keys[field], changed, added, pos_dtype)
+        index._set_sort_state(credit_key, permutations)
+        return index
+
+    def _sort_keys(self, credit_key: np.ndarray):
+        claims = self.results.claims
+        return {"date_of_service": claims.date_of_service, "charges_amount": claims.charges_cents, "credit": credit_key}
+
+    def _set_sort_state(self, credit_key: np.ndarray, permutations):
+        self.credit_key = credit_key
+        self.sort_keys = self._sort_keys(credit_key)
+        self.permutations = permutations
+        # every _FENCE-th sorted value, so range bounds are found without touching the full permutation
+        self.fences = {field: self.sort_keys[field][perm[::_FENCE]] for field, perm in self.permutations.items()}
+        # built here, with the version, so a query never builds one
+        self._descending_permutations = {field: self._descending(perm, field) for field, perm in permutations.items()}
+
+    def parts(self) -> Dict[str, np.ndarray]:
+        """The index arrays by name, for snapshots (see from_parts)."""
+        parts = {f"by_status.{k}": rows for k, rows in enumerate(self.by_status)}
+        parts.update(patient_order=self.patient_order, patient_ids=self.patient_ids,
+                     patient_bounds=self.patient_bounds, credit_key=self.credit_key)
+        parts.update({f"permutation.{field}": perm for field, perm in self.permutations.items()})
+        return parts
+
+    @classmethod
+    def from_parts(cls, results: ResultStore, parts: Dict[str, np.ndarray], patients: Patients) -> "ResultIndex":
+        """Rebuild an index over `results` from parts() output without sorting anything."""
+        index = cls.__new__(cls)
+        index.results = results
+        index.patients = patients
+        index.by_status = [parts[f"by_status.{k}"] for k in range(len(STATUS_LABELS))]
+        index.patient_order, index.patient_ids = parts["patient_order"], parts["patient_ids"]
+        index.patient_bounds = parts["patient_bounds"]
+        index._set_sort_state(parts["credit_key"], {field: parts[f"permutation.{field}"] for field in SORT_FIELDS})
+        return index
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [*self.by_status, self.patient_order, self.patient_ids, self.patient_bounds, self.credit_key, *self.permutations.values(), *self.fences.values(),
+                  self._descending_permutations["credit"]]  # the others are views
+        return sum(a.nbytes for a in arrays)
+
+    # --- candidate sets from single indexes -------------------------------------------------
+
+    def _status_rows(self, statuses: List[str]) -> np.ndarray:
+        parts = [self.by_status[STATUS_LABELS.index(s)] for s in set(statuses)]
+        return np.sort(np.concatenate(parts)) if len(parts) > 1 else parts[0]
+
+    def _patient_rows(self, patient_slots: np.ndarray) -> np.ndarray:
+        parts = [self.patient_order[self.patient_bounds[i]:self.patient_bounds[i + 1]] for i in patient_slots]
+        return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=self.patient_order.dtype)
+
+    def _bound(self, field: str, value: int, side: str) -> int:
+        """searchsorted() into the field's sorted order: fences first, then one block."""
+        block = int(np.searchsorted(self.fences[field], value, side=side))
+        start = max(block - 1, 0) * _FENCE
+        segment = self.sort_keys[field][self.permutations[field][start:block * _FENCE + 1]]
+        return start + int(np.searchsorted(segment, value, side=side))
+
+    def _range_rows(self, field: str, lo: Optional[int], hi: Optional[int]) -> np.ndarray:
+        perm = self.permutations[field]
+        start = self._bound(field, lo, "left") if lo is not None else 0
+        stop = self._bound(field, hi, "right") if hi is not None else len(perm)
+        if field == "credit":
+            stop = min(stop, self._bound(field, _NO_CREDIT, "left"))
+        return perm[start:stop]
+
+    def _patient_slots(self, q: ResultQuery) -> Optional[np.ndarray]:
+        slots = None
+        if q.patient_id is not None:
+            i = np.searchsorted(self.patient_ids, q.patient_id)
+            found = i < len(self.patient_ids) and self.patient_ids[i] == q.patient_id
+            slots = np.array([i] if found else [], dtype=np.int64)
+        if q.patient_name:
+            by_name = self._name_slots(q.patient_name)
+            slots = by_name if slots is None else np.intersect1d(slots, by_name)
+        return slots
+
+    def _name_slots(self, prefix: str) -> np.ndarray:
+        """Slots of the patients present whose name starts with `prefix`, case-insensitively."""
+        directory = self.patients.directory
+        ids = directory.matching(prefix)
+        i = np.minimum(np.searchsorted(self.patient_ids, ids), max(len(self.patient_ids) - 1, 0))
+        slots = i[self.patient_ids[i] == ids] if len(self.patient_ids) else i[:0]
+        folded = prefix.casefold()
+        placeholder = default_name(0)[:-1].casefold()  # unlisted patients are named "Patient <id>"
+        if placeholder.startswith(folded) or folded.startswith(placeholder):
+            unlisted = np.flatnonzero(~directory.known(self.patient_ids))
+            digits = folded[len(placeholder):]
+            if digits:
+                unlisted = unlisted[np.char.startswith(self.patient_ids[unlisted].astype(str), digits)]
+            slots = np.union1d(slots, unlisted)
+        return slots.astype(np.int64)
+
+    # --- query -------------------------------------------------------------------------------
+
+    def ordered(self, q: ResultQuery) -> Optional[np.ndarray]:
+        """
+        Every matching row in the requested order; None stands for all rows in
+        position order. Unfiltered sorts return a presorted permutation as is.
+        """
+        field, descending = _parse_sort(q.sort)
+        if not q.is_filtered():
+            return None if field is None else self._permutation(field, descending)
+        return self._filtered(q, field, descending)[0]
+
+    def query(self, q: ResultQuery, skip: int = 0, limit: int = 100,
+              after: Optional[Tuple[int, int]] = None) -> Tuple[np.ndarray, int]:
+        """
+        Positions of one page of matching rows in the requested order, and the
+        total match count. `after` is the cursor() of the previous page's last
+        row (keyset pagination): the page starts right behind it, found by binary
+        search, and only the matches behind it are ordered.
+        """
+        field, descending = _parse_sort(q.sort)
+        if q.is_filtered():
+            order, total = self._filtered(q, field, descending, after)
+            return order[skip:skip + limit], total
+        n = len(self.results)
+        if field is None:
+            start = skip if after is None else after[1] + 1 + skip
+            return np.arange(start, min(n, start + limit)), n
+        start = skip if after is None else self._seek(field, descending, after) + skip
+        return self._permutation(field, descending)[start:start + limit], n
+
+    def cursor(self, q: ResultQuery, row: int) -> Tuple[int, int]:
+        """(sort key, row) of a served row, for query()'s `after`."""
+        field, _ = _parse_sort(q.sort)
+        return (int(self.sort_keys[field][row]) if field is not None else row), row
+
+    def iter_batches(self, q: ResultQuery, batch_size: int):
+        """Matching row positions in order, a bounded batch at a time."""
+        order = self.ordered(q)
+        total = len(self.results) if order is None else len(order)
+        for start in range(0, total, batch_size):
+            stop = min(total, start + batch_size)
+            yield np.arange(start, stop) if order is None else order[start:stop]
+
+    def _filtered(self, q: ResultQuery, field: Optional[str], descending: bool,
+                  after: Optional[Tuple[int, int]] = None) -> Tuple[np.ndarray, int]:
+        """The matches behind `after` (all of them without it) in order, and the total match count."""
+        rows = self._candidates(q)
+        if field is not None and len(rows) * np.log2(max(len(rows), 2)) > len(self.results):
+            # most rows survive: filtering the presorted permutation beats sorting the survivors
+            perm = self._permutation(field, descending)
+            keep = self._mask(q, perm)
+            start = 0 if after is None else self._seek(field, descending, after)
+            return perm[start:][keep[start:]], int(np.count_nonzero(keep))
+
+        rows = rows[self._mask(q, rows)]
+        total = len(rows)
+        if after is not None:
+            rows = rows[self._behind(field, descending, rows, after)]
+        if field is None:
+            return np.sort(rows), total
+        rows = rows[np.lexsort((rows, self.sort_keys[field][rows]))]
+        return (self._descending(rows, field) if descending else rows), total
+
+    def _seek(self, field: str, descending: bool, after: Tuple[int, int]) -> int:
+        """Index in the field's (descending) permutation just behind the cursor."""
+        key, row = after
+        perm = self.permutations[field]
+        lo, hi = self._bound(field, key, "left"), self._bound(field, key, "right")
+        ties = perm[lo:hi]  # rows sharing the cursor's key, in position order
+        if not descending or (field == "credit" and key == _NO_CREDIT):
+            return lo + int(np.searchsorted(ties, row, side="right"))
+        ahead = lo + int(np.searchsorted(ties, row, side="left"))  # rows behind the cursor, counted ascending
+        end = self._bound(field, _NO_CREDIT, "left") if field == "credit" else len(perm)
+        return end - ahead
+
+    def _behind(self, field: Optional[str], descending: bool, rows: np.ndarray,
+                after: Tuple[int, int]) -> np.ndarray:
+        """Mask of the rows ordered behind the cursor."""
+        key, row = after
+        if field is None:
+            return rows > row
+        keys, positions = self.sort_keys[field][rows].astype(np.int64), rows.astype(np.int64)
+        if descending:
+            # negated, the descending order is ascending; rows without a credit stay last in position order
+            kept = keys == _NO_CREDIT if field == "credit" else np.zeros(len(rows), dtype=bool)
+            keys, positions = np.where(kept, keys, -keys), np.where(kept, positions, -positions)
+            if not (field == "credit" and key == _NO_CREDIT):
+                key, row = -key, -row
+        return (keys > key) | ((keys == key) & (positions > row))
+
+    def _permutation(self, field: str, descending: bool) -> np.ndarray:
+        return self._descending_permutations[field] if descending else self.permutations[field]
+
+    def _descending(self, ordered: np.ndarray, field: str) -> np.ndarray:
+        """Reverse an ascending order, keeping rows without a credit last."""
+        if field != "credit":
+            return ordered[::-1]  # a view
+        split = np.searchsorted(self.credit_key[ordered], _NO_CREDIT, side="left")
+        return np.concatenate([ordered[:split][::-1], ordered[split:]])
+
+    def _candidates(self, q: ResultQuery) -> np.ndarray:
+        """The smallest row set any single index can produce for this query."""
+        options = []
+        if q.status:
+            options.append((sum(len(self.by_status[STATUS_LABELS.index(s)]) for s in set(q.status)),
+                            lambda: self._status_rows(q.status)))
+        slots = self._patient_slots(q)
+        if slots is not None:
+            size = int(np.sum(self.patient_bounds[slots + 1] - self.patient_bounds[slots]))
+            options.append((size, lambda: self._patient_rows(slots)))
+        for field, lo, hi in self._ranges(q):
+            rows = self._range_rows(field, lo, hi)  # a view; its size is known up front
+            options.append((len(rows), lambda rows=rows: rows))
+        return min(options, key=lambda o: o[0])[1]()
+
+    def _ranges(self, q: ResultQuery):
+        if q.date_from is not None or q.date_to is not None:
+            yield ("date_of_service",
+                   q.date_from.toordinal() if q.date_from else None,
+                   q.date_to.toordinal() if q.date_to else None)
+        if q.min_charges is not None or q.max_charges is not None:
+            yield "charges_amount", _cents(q.min_charges), _cents(q.max_charges)
+        if q.min_credit is not None or q.max_credit is not None:
+            yield "credit", _cents(q.min_credit), _cents(q.max_credit)
+
+    def _mask(self, q: ResultQuery, rows: np.ndarray) -> np.ndarray:
+        """Every filter of the query, evaluated on the candidate rows only."""
+        claims, results = self.results.claims, self.results
+        keep = np.ones(len(rows), dtype=bool)
+        if q.status:
+            keep &= np.isin(results.status[rows], [STATUS_LABELS.index(s) for s in q.status])
+        slots = self._patient_slots(q)
+        if slots is not None:
+            keep &= np.isin(claims.patient_id[rows], self.patient_ids[slots])
+        for field, lo, hi in self._ranges(q):
+            values = self.sort_keys[field][rows]
+            if lo is not None:
+                keep &= values >= lo
+            if hi is not None:
+                keep &= values <= hi
+            if field == "credit":
+                keep &= values != _NO_CREDIT
+        return keep
+
+
+def _deleted(positions: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Sorted `positions` without `rows`, which must all be in it."""
+    return np.delete(positions, np.searchsorted(positions, rows)) if len(rows) else positions
+
+
+def _inserted(positions: np.ndarray, rows: np.ndarray, dtype) -> np.ndarray:
+    """Sorted `positions` with the sorted `rows` merged in."""
+    if len(rows):
+        positions = np.insert(positions, np.searchsorted(positions, rows), rows)
+    return positions.astype(dtype, copy=False)
+
+
+def _rank(perm: np.ndarray, key: np.ndarray, keys: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """
+    For each (keys[i], rows[i]), how many entries of `perm` (ordered by key,
+    then row) sort before it: one vectorised binary search for all of them.
+    """
+    lo = np.zeros(len(rows), dtype=np.int64)
+    hi = np.full(len(rows), len(perm), dtype=np.int64)
+    while True:
+        active = lo < hi
+        if not active.any():
+            return lo
+        mid = (lo + hi) // 2
+        row = perm[np.minimum(mid, len(perm) - 1)]
+        before = (key[row] < keys) | ((key[row] == keys) & (row < rows))
+        lo = np.where(active & before, mid + 1, lo)
+        hi = np.where(active & ~before, mid, hi)
+
+
+def _reordered(perm: np.ndarray, old_key: np.ndarray, key: np.ndarray, changed: np.ndarray, added: np.ndarray, dtype) -> np.ndarray:
+    """
+    The stable order of `key` from `perm`, the stable order of `old_key`,
+    given that only the `changed` rows' keys differ and `added` rows follow.
+    """
+    if not len(changed) and not len(added):
+        return perm
+    dropped = _rank(perm, old_key, old_key[changed], changed)
+    moved = np.concatenate([changed, added])
+    moved = moved[np.lexsort((moved, key[moved]))]
+    at = _rank(perm, old_key, key[moved], moved)
+    at -= np.searchsorted(np.sort(dropped), at)  # the dropped entries that sorted before each insertion point
+    return np.insert(np.delete(perm, dropped), at, moved).astype(dtype, copy=False)
+
+
+def _cents(amount: Optional[float]) -> Optional[int]:
+    return None if amount is None else int(to_cents(np.array([amount]))[0])
+
+
+def _parse_sort(sort: Optional[str]) -> Tuple[Optional[str], bool]:
+    if not sort:
+        return None, False
+    descending = sort.startswith("-")
+    field = sort.lstrip("-")
+    if field not in SORT_FIELDS:
+        raise ValueError(f"Unknown sort field: {field}")
+    return field, descending
+
+
+def validate_query(q: ResultQuery):
+    """Raise ValueError for a status label or sort field the index does not know."""
+    unknown = [s for s in q.status or [] if s not in STATUS_LABELS]
+    if unknown:
+        raise ValueError(f"Unknown status: {', '.join(unknown)}")
+    _parse_sort(q.sort)
+
+
+def query_fingerprint(q: ResultQuery, scope: str = "") -> str:
+    """Short hash of the query's filters and sort, plus `scope` (e.g. the dataset name)."""
+    return hashlib.sha1(f"{scope}\0{q.model_dump_json()}".encode("utf-8")).hexdigest()[:12]
+
+
+def encode_cursor(version: int, q: ResultQuery, last: Tuple[Optional[int], int], scope: str = "") -> str:
+    """
+    Opaque keyset cursor: dataset version, query fingerprint and the (sort key,
+    row) of the last row served. The SQLite backend looks the key up by row and
+    leaves it None.
+    """
+    key, row = last
+    raw = json.dumps({"v": version, "q": query_fingerprint(q, scope), "k": key, "r": row}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, q: ResultQuery, scope: str = "") -> Tuple[int, Tuple[Optional[int], int]]:
+    """(version, (sort key, row)) of a cursor; ValueError if it is malformed or belongs to another query."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        version, fingerprint, row = int(data["v"]), data["q"], int(data["r"])
+        key = None if data["k"] is None else int(data["k"])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Malformed cursor")
+    if fingerprint != query_fingerprint(q, scope):
+        raise ValueError("Cursor was issued for different filters or sort order")
+    return version, (key, row)
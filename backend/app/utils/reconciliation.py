@@ -1,79 +1,416 @@
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional, Sequence, Tuple
+import numpy as np
+from app.config import (
+    RECONCILIATION_ENGINE, RECONCILE_SHARD_MIN_ROWS, RECONCILE_WORKERS, SNAPSHOT_DIR, SNAPSHOT_KEEP, SNAPSHOT_MAX_DELTAS,
+)
 from app.models.claim import Claim
 from app.models.invoice import Invoice
-from app.models.schemas import ReconciliationResult, SummaryStats
-from collections import defaultdict
-import csv
+from app.models.schemas import ReconciliationResult, ResultQuery, SummaryStats
+from app.utils.analytics import STATE_FIELDS, AnalyticsState, row_state
+from app.utils import csv_loader
+from app.utils.changelog import ABSENT, Changelog, fingerprints, full_table
+from app.utils.csv_loader import IngestReport
+from app.utils.columnar import reconcile_columnar, reconcile_python, reconcile_rows
+from app.utils.metrics import timed
+from app.utils.patients import get_patients
+from app.utils.sharded import reconcile_sharded
+from app.utils.query import ResultIndex
+from app.utils.snapshot import Delta, append_deltas, delta_count, latest_snapshot, read_deltas, read_snapshot, write_snapshot
+from app.utils.versions import Orphans, ResultVersion
+from app.utils.store import (
+    ClaimStore, InvoiceStore, ResultStore, InvoiceIndex, KeyTable, RowIndex, last_occurrence, grow_array,
+)
 from pathlib import Path
 
 class ReconciliationService:
-    def __init__(self):
-        self.claims: List[Claim] = []
-        self.invoices: List[Invoice] = []
-        self.patient_map: Dict[str, str] = self._load_patients()
-        self.results_cache: List[ReconciliationResult] = []
-
-    def _load_patients(self) -> Dict[str, str]:
-       
-        patient_csv = Path(__file__).parent.parent / "data" / "patients.csv"
-        mapping = {}
-        if patient_csv.exists():
-            with open(patient_csv, newline="", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    mapping[row["patient_id"]] = row["name"]
-        return mapping
-
-    def load_claims(self, claims: List[Claim]):
-        self.claims = claims
-        self.results_cache = [] # Clear cache on new data load
+    def __init__(self, engine: str = RECONCILIATION_ENGINE, workers: int = RECONCILE_WORKERS,
+                 snapshot_dir: str = SNAPSHOT_DIR):
+        if engine not in ("python", "columnar"):
+            raise ValueError(f"Unknown reconciliation engine: {engine}")
+        self.engine = engine
+        self.workers = max(1, workers)
+        self.snapshot_dir = snapshot_dir
+        self.saved_version: Optional[int] = None  # version of the newest snapshot on disk
+        self.snapshot_name: Optional[str] = None  # snapshot last written or mapped by this process
+        # upserts since then, saved as delta segments of that snapshot; None when the next save must be full
+        self._unsaved: Optional[List[Delta]] = None
+        self.claims = ClaimStore.empty()
+        self.invoices = InvoiceStore.empty()
+        self.patients = get_patients()  # shared by every dataset; names are resolved per returned row
+        # writer-side working state; readers only ever see `current`
+        self.results_cache: Sequence[ReconciliationResult] = []
+        self.analytics = AnalyticsState()
+        self.current: Optional[ResultVersion] = None  # the published version, swapped whole
+        self.version = 0  # bumped on every publish; cursors are tied to it
+        self.changelog = Changelog()  # per-claim fingerprints of recent versions, for diffs
+        self._shared = False  # claims/results arrays are referenced by `current`: copy before writing
+        # persistent indexes for incremental upserts, built by reconcile() (or read from a snapshot)
+        self._invoice_index: Optional[InvoiceIndex] = None  # claim code -> invoice total/count
+        self._claim_rows: Optional[RowIndex] = None         # claim code -> claim row(s)
+        self._invoice_ids: Optional[KeyTable] = None        # invoice_id intern table
+        self._invoice_row: Optional[np.ndarray] = None      # invoice_id code -> invoice row
+        self._orphans: Optional[Orphans] = None             # kept up to date by upserts, None after a load
 
-    def load_invoices(self, invoices: List[Invoice]):
-        self.invoices = invoices
-        self.results_cache = [] # Clear cache on new data load
+    def read_claims(self, files, progress: Optional[Callable[[IngestReport], None]] = None,
+                    on_error: str = "fail") -> ClaimStore:
+        """
+        Parse uploaded claims CSV file(s); the result is applied with load_claims/upsert_claims.
+        Invalid rows fail the parse unless `on_error` is "skip".
+        """
+        return csv_loader.load_claims(files, progress=progress, on_error=on_error)
 
-    def reconcile(self) -> List[ReconciliationResult]:
-        inv_map: Dict[str, List[Invoice]] = defaultdict(list)
-        for inv in self.invoices:
-            inv_map[inv.claim_id].append(inv)
+    def read_invoices(self, files, progress: Optional[Callable[[IngestReport], None]] = None,
+                      on_error: str = "fail") -> InvoiceStore:
+        return csv_loader.load_invoices(files, progress=progress, on_error=on_error)
 
-        results: List[ReconciliationResult] = []
+    def load_claims(self, claims: Sequence[Claim]):
+        if not isinstance(claims, ClaimStore):
+            claims = ClaimStore.from_models(claims)
+        self.claims = claims
+        # invoices reference claims through the claims' key table
+        self.invoices = self.invoices.rekey(claims.keys)
+        self._invoice_index = self._claim_rows = self._orphans = self._unsaved = None
+        self.results_cache = [] # readers keep the published version until the next reconcile
 
-        for c in self.claims:
-            related_invoices = inv_map.get(c.claim_id, [])
-            invoice_total = sum(i.transaction_value for i in related_invoices)
+    def load_invoices(self, invoices: Sequence[Invoice]):
+        if not isinstance(invoices, InvoiceStore):
+            invoices = InvoiceStore.from_models(invoices)
+        self.invoices = invoices.rekey(self.claims.keys)
+        self._invoice_index = self._invoice_ids = self._invoice_row = self._orphans = self._unsaved = None
+        self.results_cache = [] # readers keep the published version until the next reconcile
 
-            if not related_invoices:
-                status = "N/A"
-                invoice_total = None
-                credit = None
-            else:
-                credit = invoice_total - c.charges_amount
-                if credit == 0:
-                    status = "BALANCED"
-                elif credit > 0:
-                    status = "OVERPAID"
-                else:
-                    status = "UNDERPAID"
-
-            results.append(
-                ReconciliationResult(
-                    claim_id=c.claim_id,
-                    patient_id=str(c.patient_id),
-                    patient_name=self.patient_map.get(str(c.patient_id), f"Patient {c.patient_id}"),
-                    date_of_service=c.date_of_service,
-                    charges_amount=c.charges_amount,
-                    invoice_total=invoice_total,
-                    status=status,
-                    credit=credit
+    def reconcile(self, progress: Optional[Callable[[str], None]] = None) -> ResultStore:
+        """Full reconciliation; `progress` is told each stage (index, reconcile, analytics) as it starts."""
+        stage = progress or (lambda name: None)
+        if self.engine == "columnar" and self.workers > 1 and len(self.claims) >= RECONCILE_SHARD_MIN_ROWS:
+            # shards build the invoice index and analytics partials alongside the results
+            stage("reconcile")
+            with timed("reconcile", claims=len(self.claims), workers=self.workers):
+                self.results_cache, self._invoice_index, self.analytics = reconcile_sharded(
+                    self.claims, self.invoices, self._patient_name, self.workers,
                 )
-            )
+            stage("index")
+            with timed("index", invoices=len(self.invoices)):
+                self.ensure_indexes()
+            stage("analytics")
+            return self._publish()
+        if self.engine == "columnar":
+            stage("index")
+            with timed("index", invoices=len(self.invoices)):
+                self.ensure_indexes()
+            stage("reconcile")
+            with timed("reconcile", claims=len(self.claims)):
+                self.results_cache = reconcile_columnar(self.claims, self.invoices, self._patient_name,
+                                                        self._invoice_index)
+        else:
+            stage("reconcile")
+            with timed("reconcile", claims=len(self.claims), engine=self.engine):
+                self.results_cache = reconcile_python(self.claims, self.invoices, self._patient_name)
+        stage("analytics")
+        with timed("analytics", results=len(self.results_cache)):
+            self.analytics = AnalyticsState.from_results(self.results_cache)
+        return self._publish()
 
-        self.results_cache = results
+    def _publish(self, version: Optional[int] = None, index: Optional[ResultIndex] = None,
+                 changes: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None) -> ResultStore:
+        """
+        Build the next immutable ResultVersion and swap it in with one reference
+        assignment. `changes` (claim ids, fingerprints before and after) comes
+        from an upsert, which has also brought the orphan invoices up to date.
+        Without it, the version's fingerprint table and orphans are built here,
+        so readers find everything computed.
+        """
+        results = self.results_cache
+        with timed("publish", results=len(results)):
+            self.version = self.version + 1 if version is None else version
+            if changes is None:
+                table = full_table(self.version, self.claims, results) if self.changelog.keep else None
+                self.changelog.record_full(self.version, table)
+                self._orphans = Orphans.find(self.claims.key, self.invoices)
+                self._unsaved = None
+            else:
+                self.changelog.record_delta(self.version, *changes)
+            self.current = ResultVersion(self.version, results, self.patients,
+                                         self.analytics.payload(self._patient_name), index, self.analytics.rollup(),
+                                         self._orphans, self.changelog.history)
+        self._shared = True
         return results
 
+    def _orphan_rows(self) -> np.ndarray:
+        """Invoice rows of the orphans, found by an anti-join if no version holds them yet."""
+        if self._orphans is None:
+            self._orphans = Orphans.find(self.claims.key, self.invoices)
+        return self._orphans.rows
+
+    def _detach(self):
+        """
+        Copy-on-write, part one: the writer gets its own store objects before
+        an upsert, still sharing every column with the published version.
+        Appends replace columns anyway; _writable() copies the ones written in place.
+        """
+        if not self._shared:
+            return
+        c = self.claims
+        self.claims = ClaimStore(KeyTable.from_parts(*c.keys.parts()), c.key, c.patient_id,
+                                 c.date_of_service, c.charges_cents)
+        self.invoices.keys = self.claims.keys
+        r = self.results_cache
+        if isinstance(r, ResultStore):
+            self.results_cache = ResultStore(self.claims, r.invoice_cents, r.invoice_count,
+                                             r.status, r.credit_cents, self._patient_name)
+        self._shared = False
+
+    def _writable(self, store, *columns: str):
+        """Copy-on-write, part two: private copies of the `columns` of `store` the published version still reads."""
+        published = self.current.results if self.current is not None else None
+        if published is not None and isinstance(store, ClaimStore):
+            published = published.claims
+        for name in columns:
+            if published is not None and getattr(store, name) is getattr(published, name):
+                setattr(store, name, getattr(store, name).copy())
+
+    def ensure_indexes(self):
+        n_keys = len(self.claims.keys)
+        if self._invoice_index is None:
+            self._invoice_index = InvoiceIndex.build(self.invoices, n_keys)
+        if self._claim_rows is None:
+            self._claim_rows = RowIndex(self.claims.key, n_keys)
+        if self._invoice_ids is None:
+            self._invoice_ids = KeyTable()
+            codes = self._invoice_ids.intern(self.invoices.invoice_id)
+            self._invoice_row = np.full(len(self._invoice_ids), -1, dtype=np.int64)
+            self._invoice_row[codes] = np.arange(len(codes))  # a repeated invoice_id: its last row
+        self._invoice_index.grow(n_keys)
+        self._claim_rows.grow(n_keys)
+
+    def _row_state(self, rows: np.ndarray) -> Optional[np.ndarray]:
+        """Result-visible fields of the given claim rows, one column per row."""
+        if not self.results_cache:
+            return None
+        return row_state(self.claims, self.results_cache, rows)
+
+    def _refresh_results(self, rows: np.ndarray, before: Optional[np.ndarray], new_rows: np.ndarray) -> int:
+        """
+        Recompute status and credit for the touched rows only, and move their
+        contribution in the analytics from `before` to the new values.
+        Returns how many results changed.
+        """
+        if not self.results_cache:
+            return 0  # nothing reconciled yet; the next reconcile() covers everything
+        results = self.results_cache
+        results.resize(len(self.claims))
+        self._writable(results, "invoice_cents", "invoice_count", "status", "credit_cents")
+        touched = np.concatenate([rows, new_rows])
+        (results.invoice_cents[touched], results.invoice_count[touched],
+         results.status[touched], results.credit_cents[touched]) = reconcile_rows(self.claims, self._invoice_index, touched)
+
+        after = self._row_state(touched)
+        self.analytics.add_state(before, sign=-1)
+        self.analytics.add_state(after)
+        changed = np.count_nonzero((before != after[:, :len(rows)]).any(axis=0))
+        status, credit = STATE_FIELDS.index("status"), STATE_FIELDS.index("credit_cents")
+        before_fps = np.concatenate([fingerprints(before[status], before[credit]),
+                                     np.full(len(new_rows), ABSENT, dtype=np.int64)])
+        claims = self.claims
+        # the previous version holds these results as they were before this upsert
+        index = self.current.index.patched(results, touched)
+        self._publish(index=index, changes=(claims.keys.values[claims.key[touched]], before_fps,
+                                            fingerprints(after[status], after[credit])))
+        return int(changed) + len(new_rows)
+
+    @timed("upsert", kind="claims")
+    def upsert_claims(self, claims: Sequence[Claim]) -> int:
+        """Insert or replace claims by claim_id; returns how many results changed."""
+        if not isinstance(claims, ClaimStore):
+            claims = ClaimStore.from_models(claims)
+        self._detach()
+        orphans = self._orphan_rows()
+        keys = self.claims.keys.intern(claims.keys.values)[claims.key]
+        self.ensure_indexes()
+        src = last_occurrence(keys)  # a claim_id repeated in the delta: last row wins
+        keys = keys[src]
+        current = self.claims
+
+        # existing claim ids: overwrite every row holding them
+        exists = self._claim_rows.lookup(keys) >= 0
+        rows = self._claim_rows.rows_for(keys[exists])
+        order = np.argsort(keys)
+        from_rows = src[order[np.searchsorted(keys[order], current.key[rows])]]
+        before = self._row_state(rows)
+        if len(rows):
+            self._writable(current, "patient_id", "date_of_service", "charges_cents")
+        current.patient_id[rows] = claims.patient_id[from_rows]
+        current.date_of_service[rows] = claims.date_of_service[from_rows]
+        current.charges_cents[rows] = claims.charges_cents[from_rows]
+
+        # new claim ids: append
+        new_src = src[~exists]
+        new_rows = np.arange(len(current), len(current) + len(new_src))
+        current.key = np.concatenate([current.key, keys[~exists]])
+        current.patient_id = np.concatenate([current.patient_id, claims.patient_id[new_src]])
+        current.date_of_service = np.concatenate([current.date_of_service, claims.date_of_service[new_src]])
+        current.charges_cents = np.concatenate([current.charges_cents, claims.charges_cents[new_src]])
+        self._claim_rows.add(keys[~exists], new_rows)
+
+        # invoices waiting for one of the new claim ids are no longer orphans
+        adopted = np.isin(self.invoices.key[orphans], keys[~exists])
+        self._orphans = Orphans(self.invoices, orphans[~adopted])
+
+        changed = self._refresh_results(rows, before, new_rows)
+        self._record_upsert(claims)
+        return changed
+
+    @timed("upsert", kind="invoices")
+    def upsert_invoices(self, invoices: Sequence[Invoice]) -> int:
+        """Insert or replace invoices by invoice_id; returns how many results changed."""
+        if not isinstance(invoices, InvoiceStore):
+            invoices = InvoiceStore.from_models(invoices)
+        self._detach()
+        orphans = self._orphan_rows()
+        claim_keys = self.claims.keys.intern(invoices.keys.values)[invoices.key]
+        self.ensure_indexes()
+        current = self.invoices
+        ids = self._invoice_ids.intern(invoices.invoice_id)
+        src = last_occurrence(ids)  # an invoice_id repeated in the delta: last row wins
+        ids, claim_keys, cents = ids[src], claim_keys[src], invoices.amount_cents[src]
+        self._invoice_row = grow_array(self._invoice_row, len(self._invoice_ids), -1)
+        inv_rows = self._invoice_row[ids]
+        exists = inv_rows >= 0
+        old_rows = inv_rows[exists]
+        old_keys = current.key[old_rows]
+
+        rows = self._claim_rows.rows_for(np.unique(np.concatenate([old_keys, claim_keys])))
+        before = self._row_state(rows)
+
+        # move replaced invoices out of their old claim's totals, then write the new values
+        self._invoice_index.add(old_keys, current.amount_cents[old_rows], sign=-1)
+        current.key[old_rows] = claim_keys[exists]
+        current.amount_cents[old_rows] = cents[exists]
+
+        new = ~exists
+        self._invoice_row[ids[new]] = np.arange(len(current), len(current) + np.count_nonzero(new))
+        current.invoice_id = np.concatenate([current.invoice_id, invoices.invoice_id[src[new]]])
+        current.key = np.concatenate([current.key, claim_keys[new]])
+        current.amount_cents = np.concatenate([current.amount_cents, cents[new]])
+        self._invoice_index.add(claim_keys, cents)
+
+        # only the replaced and added invoices can have become or stopped being orphans
+        touched = np.concatenate([old_rows, self._invoice_row[ids[new]]])
+        orphaned = touched[self._claim_rows.lookup(current.key[touched]) < 0]
+        self._orphans = Orphans(current, np.union1d(np.setdiff1d(orphans, touched), orphaned))
+
+        changed = self._refresh_results(rows, before, np.empty(0, dtype=np.int64))
+        self._record_upsert(invoices)
+        return changed
+
+    def _record_upsert(self, data):
+        """Keep an upsert's input for the next save_snapshot(), which appends it to the snapshot."""
+        if self._unsaved is None or not self.results_cache:
+            return
+        self._unsaved.append(Delta(self.version, data))
+        if len(self._unsaved) > SNAPSHOT_MAX_DELTAS:
+            self._unsaved = None  # the next save is a full snapshot anyway
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the data, results and indexes (memory-mapped columns included)."""
+        parts = [self.claims, self.invoices, self._invoice_index, self._claim_rows]
+        if isinstance(self.results_cache, ResultStore):
+            parts.append(self.results_cache)
+        if self.current is not None:
+            parts.append(self.current.index)
+            if self.current.results is not self.results_cache:
+                parts.append(self.current.results)
+        total = sum(p.nbytes for p in parts if p is not None) + self.changelog.nbytes
+        if self._invoice_ids is not None:
+            total += self._invoice_ids.nbytes + self._invoice_row.nbytes
+        return total
+
+    def save_snapshot(self, root: Optional[str] = None) -> Optional[Path]:
+        """
+        Persist the loaded data, results and aggregates; no-op without a snapshot
+        directory. When only upserts happened since the snapshot this process
+        wrote or mapped, they are appended to it instead of rewriting it.
+        """
+        root = root or self.snapshot_dir
+        if not root:
+            return None
+        base = Path(root) / self.snapshot_name if self.snapshot_name else None
+        if self._unsaved is not None and base is not None and latest_snapshot(Path(root)) == self.snapshot_name:
+            if not self._unsaved:
+                return base  # nothing new to write
+            if delta_count(base) + len(self._unsaved) <= SNAPSHOT_MAX_DELTAS:
+                append_deltas(base, self._unsaved)
+                self.saved_version, self._unsaved = self.version, []
+                return base
+        view = self.current
+        index = view.index if view is not None and view.results is self.results_cache else None
+        path = write_snapshot(Path(root), self.claims, self.invoices, self.results_cache or None,
+                              self._invoice_index, self.analytics, self.version, keep=SNAPSHOT_KEEP,
+                              result_index=index,
+                              invoice_ids=(self._invoice_ids, self._invoice_row) if self._invoice_ids is not None else None)
+        self.saved_version, self.snapshot_name, self._unsaved = self.version, path.name, []
+        return path
+
+    def load_snapshot(self, root: Optional[str] = None) -> bool:
+        """Memory-map the latest snapshot in place of the current data; False if there is none."""
+        root = root or self.snapshot_dir
+        snapshot = read_snapshot(Path(root), self._patient_name) if root else None
+        if snapshot is None:
+            return False
+        self.claims, self.invoices = snapshot.claims, snapshot.invoices
+        self.results_cache = snapshot.results if snapshot.results is not None else []
+        self.analytics = snapshot.analytics
+        self._invoice_index = snapshot.invoice_index
+        self._invoice_ids, self._invoice_row = snapshot.invoice_ids or (None, None)
+        self._claim_rows = self._orphans = None
+        self.saved_version, self.snapshot_name = snapshot.version, snapshot.path.name
+        if snapshot.results is not None:
+            index = (ResultIndex.from_parts(snapshot.results, snapshot.result_index, self.patients)
+                     if snapshot.result_index else None)
+            self._publish(version=snapshot.version, index=index)
+            self._replay(snapshot.deltas)
+            self.saved_version, self._unsaved = self.version, []
+        else:
+            self.version, self.current = snapshot.version, None
+        return True
+
+    def _replay(self, deltas: List[Delta]):
+        for delta in deltas:
+            if isinstance(delta.data, ClaimStore):
+                self.upsert_claims(delta.data)
+            else:
+                self.upsert_invoices(delta.data)
+
+    def refresh(self) -> bool:
+        """
+        Catch up with what another process published: replay the upserts it
+        appended to the snapshot this one has mapped, or map its newer snapshot.
+        True if anything changed.
+        """
+        latest = latest_snapshot(Path(self.snapshot_dir)) if self.snapshot_dir else None
+        if latest is None:
+            return False
+        if latest != self.snapshot_name:
+            return self.load_snapshot()
+        if self._unsaved != []:
+            return False  # changes of this process's own are not saved yet
+        deltas = read_deltas(Path(self.snapshot_dir) / latest, after=self.saved_version)
+        if not deltas:
+            return False
+        self._replay(deltas)
+        self.saved_version, self._unsaved = self.version, []
+        return True
+
     def get_results(self, skip: int = 0, limit: int = 100) -> List[ReconciliationResult]:
-        return self.results_cache[skip: skip + limit]
+        view = self.current
+        return view.page(skip, limit) if view is not None else []
+
+    def query_results(self, query: ResultQuery, skip: int = 0, limit: int = 100,
+                      after: Optional[Tuple[int, int]] = None) -> Tuple[List[ReconciliationResult], int, Optional[Tuple]]:
+        """ResultVersion.query() on the published version; nothing before the first reconcile."""
+        view = self.current
+        return view.query(query, skip, limit, after) if view is not None else ([], 0, None)
 
     def summary(self, results: List[ReconciliationResult]) -> SummaryStats:
         return SummaryStats(
@@ -85,85 +422,8 @@ class ReconciliationService:
         )
 
     def get_analytics(self) -> Dict:
-        if not self.results_cache:
-            return {}
-
-        # 1. Status Overview
-        status_counts = defaultdict(int)
-        # 2. Top Patients logic
-        patient_stats = defaultdict(lambda: {"count": 0, "overpaid": 0, "underpaid": 0, "total_charges": 0})
-        # 3. Trends logic
-        daily_trends = defaultdict(lambda: {"count": 0, "charges": 0, "invoices": 0, "balanced": 0})
-        # 4. Distribution
-        charge_bins = defaultdict(int)
-
-        for r in self.results_cache:
-            status_counts[r.status] += 1
-            
-            p = patient_stats[r.patient_name]
-            p["count"] += 1
-            if r.status == "OVERPAID": p["overpaid"] += (r.credit or 0)
-            if r.status == "UNDERPAID": p["underpaid"] += abs(r.credit or 0)
-            p["total_charges"] += r.charges_amount
-
-            ds = r.date_of_service or "Unknown"
-            dt = daily_trends[ds]
-            dt["count"] += 1
-            dt["charges"] += r.charges_amount
-            dt["invoices"] += (r.invoice_total or 0)
-            if r.status == "BALANCED": dt["balanced"] += 1
-
-            # Binning for distribution (e.g., bits of 100)
-            bin_idx = int(r.charges_amount // 100) * 100
-            charge_bins[bin_idx] += 1
-
-        # Process results
-        top_by_count = sorted(patient_stats.items(), key=lambda x: x[1]["count"], reverse=True)[:20]
-        top_by_overpaid = sorted(patient_stats.items(), key=lambda x: x[1]["overpaid"], reverse=True)[:20]
-        top_by_underpaid = sorted(patient_stats.items(), key=lambda x: x[1]["underpaid"], reverse=True)[:20]
-
-        sorted_trends = sorted(daily_trends.items(), key=lambda x: x[0])
-
-        return {
-            "status_distribution": [
-                {"status": "BALANCED", "count": status_counts["BALANCED"]},
-                {"status": "OVERPAID", "count": status_counts["OVERPAID"]},
-                {"status": "UNDERPAID", "count": status_counts["UNDERPAID"]},
-                {"status": "N/A", "count": status_counts["N/A"]},
-            ],
-            "top_patients_volume": [
-                {"name": name, "count": s["count"]} for name, s in top_by_count
-            ],
-            "top_patients_overpaid": [
-                {"name": name, "amount": s["overpaid"]} for name, s in top_by_overpaid if s["overpaid"] > 0
-            ],
-            "top_patients_underpaid": [
-                {"name": name, "amount": s["underpaid"]} for name, s in top_by_underpaid if s["underpaid"] > 0
-            ],
-            "daily_volume_trend": [
-                {"date": d, "count": s["count"]} for d, s in sorted_trends
-            ],
-            "financial_trend": [
-                {"date": d, "charges": s["charges"], "invoices": s["invoices"]} for d, s in sorted_trends
-            ],
-            "accuracy_trend": [
-                {"date": d, "accuracy": (s["balanced"] / s["count"] * 100) if s["count"] > 0 else 0} for d, s in sorted_trends
-            ],
-            "status_area_trend": [
-                {"date": d, "balanced": s["balanced"], "others": s["count"] - s["balanced"]} for d, s in sorted_trends
-            ],
-            "financial_impact_by_status": [
-                {"status": "OVERPAID", "amount": sum(p["overpaid"] for p in patient_stats.values())},
-                {"status": "UNDERPAID", "amount": sum(p["underpaid"] for p in patient_stats.values())},
-            ],
-            "charge_distribution": sorted([
-                {"bin": b, "count": c} for b, c in charge_bins.items()
-            ], key=lambda x: x["bin"]),
-            "summary": {
-                "total": len(self.results_cache),
-                "balanced": status_counts["BALANCED"],
-                "overpaid": status_counts["OVERPAID"],
-                "underpaid": status_counts["UNDERPAID"],
-                "no_invoices": status_counts["N/A"],
-            }
-        }
+        view = self.current
+        return view.summary if view is not None else {}
+
+    def _patient_name(self, patient_id: int) -> str:
+        return self.patients.name(patient_id)
@@ -0,0 +1,152 @@
+"""
+Pre-rendered, pre-compressed response bodies and conditional GETs.
+
+Popular reads (the first page of a result query, summaries) are encoded to
+JSON bytes once per dataset version, compressed once per content encoding,
+and kept in a least-recently-used cache within a byte budget. Keys include
+the dataset, its version and the patient directory generation, so neither a
+new publish nor a replaced directory serves stale bytes; old entries just
+age out.
+
+Every read of a published version carries an ETag and Last-Modified derived
+from the same three. A matching If-None-Match (or, without one, If-Modified-Since) is
+answered 304 before anything is queried or serialized.
+"""
+import gzip
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Callable, Dict, Hashable, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from app.config import COMPRESS_MIN_BYTES, RENDER_CACHE_MB
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """The best content encoding the client accepts: br (if available), then gzip; None for identity."""
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.strip())
+    if brotli is not None and ("br" in accepted or "*" in accepted):
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+class RenderCache:
+    def __init__(self, budget_bytes: int = RENDER_CACHE_MB * 1024 * 1024, min_compress: int = COMPRESS_MIN_BYTES):
+        self.budget_bytes = budget_bytes
+        self.min_compress = min_compress
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, render: Callable[[], bytes], encoding: Optional[str] = None) -> bytes:
+        """
+        The cached body for `key` in `encoding` (None: uncompressed). On a miss
+        it is rendered, or compressed from the cached uncompressed body, and cached.
+        """
+        with self._lock:
+            body = self._entries.get((key, encoding))
+            if body is not None:
+                self._entries.move_to_end((key, encoding))
+                self.hits += 1
+                return body
+            self.misses += 1
+        if encoding is None:
+            body = render()  # outside the lock; two concurrent misses both render, the last one is kept
+        else:
+            body = _compress(self.get(key, render), encoding)
+        self._put((key, encoding), body)
+        return body
+
+    def _put(self, key: Hashable, body: bytes):
+        if len(body) > self.budget_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            self.nbytes += len(body) - (len(old) if old is not None else 0)
+            self._entries[key] = body
+            while self.nbytes > self.budget_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.nbytes, "budget_bytes": self.budget_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+    def respond(self, request: Request, dataset: str, view, key: Optional[Hashable],
+                render: Callable[[], bytes]) -> Response:
+        """
+        A JSON response for a read of `view`: 304 if the client's copy is current,
+        otherwise the (compressed, when worthwhile and accepted) body, cached under
+        `key` unless it is None.
+        """
+        headers = validators(dataset, view)
+        if not_modified(request, view, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        headers["Vary"] = "Accept-Encoding"
+        if key is not None:
+            key = (key, view.patients.generation)  # names in the body come from the directory
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+        body = self.get(key, render) if key is not None else render()
+        if encoding is not None and len(body) >= self.min_compress:
+            body = self.get(key, render, encoding) if key is not None else _compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+        return Response(body, media_type="application/json", headers=headers)
+
+
+def validators(dataset: str, view) -> Dict[str, str]:
+    """ETag and Last-Modified of everything read from a published version."""
+    published_ms = int(view.published_at * 1000)
+    return {
+        # weak: the same version may be sent with different content encodings
+        "ETag": f'W/"{dataset}-{view.version}-{published_ms:x}-{view.patients.generation}"',
+        "Last-Modified": formatdate(_modified_at(view), usegmt=True),
+        "Cache-Control": "no-cache",  # always revalidate; a 304 costs nothing
+    }
+
+
+def not_modified(request: Request, view, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        return "*" in tags or etag.removeprefix("W/") in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(_modified_at(view)) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _modified_at(view) -> float:
+    return max(view.published_at, view.patients.replaced_at)
@@ -0,0 +1,161 @@
+"""
+Sharded reconcile across a process pool.
+
+Claims and invoices partition perfectly by claim code, so shard s owns every
+code with code % n_shards == s. The parent groups both sides by shard once
+(a stable sort on the shard number) and copies the columns into shared
+memory in that order, with each shard's start and end. A worker reads only
+its own slice, writes its results back into the same slice and its invoice
+totals straight into shared per-code arrays (shards never touch the same
+row or code), and returns only its small analytics partial.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.utils.analytics import AnalyticsState
+from app.utils.columnar import settle
+from app.utils.store import ClaimStore, InvoiceIndex, InvoiceStore, ResultStore
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None:
+            _pool.shutdown()
+        # spawn: forking a process that runs the event loop and job threads is not safe
+        _pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        _pool_workers = workers
+    return _pool
+
+
+class SharedArrays:
+    """Named NumPy arrays backed by shared memory blocks; unlinked on exit."""
+
+    def __init__(self):
+        self.spec: Dict[str, Tuple[str, str, int]] = {}
+        self.arrays: Dict[str, np.ndarray] = {}
+        self._blocks: List[shared_memory.SharedMemory] = []
+
+    def add(self, name: str, dtype, n: int, source: Optional[np.ndarray] = None) -> np.ndarray:
+        dtype = np.dtype(dtype)
+        block = shared_memory.SharedMemory(create=True, size=max(n * dtype.itemsize, 1))
+        self._blocks.append(block)
+        array = np.ndarray(n, dtype=dtype, buffer=block.buf)
+        if source is not None:
+            array[:] = source
+        self.spec[name] = (block.name, dtype.str, n)
+        self.arrays[name] = array
+        return array
+
+    def __enter__(self) -> "SharedArrays":
+        return self
+
+    def __exit__(self, *exc):
+        self.arrays.clear()  # drop the views before the buffers go away
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+
+
+def _attach(spec: Dict[str, Tuple[str, str, int]]):
+    blocks, arrays = [], {}
+    for name, (block_name, dtype, n) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(n, dtype=np.dtype(dtype), buffer=block.buf)
+    return arrays, blocks
+
+
+def _by_shard(key: np.ndarray, n_shards: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Positions of `key` grouped by shard (position order within each), and each shard's bounds in it."""
+    shard = (key % n_shards).astype(np.uint16)  # a stable sort of 16-bit values is a radix sort
+    order = np.argsort(shard, kind="stable")
+    bounds = np.zeros(n_shards + 1, dtype=np.int64)
+    np.cumsum(np.bincount(shard, minlength=n_shards), out=bounds[1:])
+    return order, bounds
+
+
+def _reconcile_shard(spec, shard: int, n_shards: int, n_keys: int, analytics_mode: str) -> AnalyticsState:
+    """Worker: reconcile every claim code owned by `shard` and return its analytics partial."""
+    a, blocks = _attach(spec)
+    try:
+        # invoice totals per owned code, indexed locally by code // n_shards
+        lo, hi = a["invoice_bounds"][shard:shard + 2]
+        local = a["invoice_key"][lo:hi] // n_shards
+        n_local = (n_keys - shard + n_shards - 1) // n_shards
+        totals = np.bincount(local, weights=a["invoice_cents_in"][lo:hi], minlength=n_local).astype(np.int64)
+        counts = np.bincount(local, minlength=n_local).astype(np.int32)
+        a["totals"][shard::n_shards] = totals
+        a["counts"][shard::n_shards] = counts
+
+        lo, hi = a["claim_bounds"][shard:shard + 2]
+        charges = a["charges_cents"][lo:hi]
+        invoice_cents, invoice_count, status, credit_cents = settle(
+            a["claim_key"][lo:hi] // n_shards, charges, totals, counts,
+        )
+        a["invoice_cents"][lo:hi] = invoice_cents
+        a["invoice_count"][lo:hi] = invoice_count
+        a["status"][lo:hi] = status
+        a["credit_cents"][lo:hi] = credit_cents
+
+        partial = AnalyticsState(analytics_mode)
+        partial.add_columns(a["patient_id"][lo:hi], a["date_of_service"][lo:hi], charges,
+                            invoice_cents, status, credit_cents)
+        return partial
+    finally:
+        a.clear()
+        for block in blocks:
+            block.close()
+
+
+def reconcile_sharded(claims: ClaimStore, invoices: InvoiceStore, patient_name: Callable[[int], str],
+                      workers: int) -> Tuple[ResultStore, InvoiceIndex, AnalyticsState]:
+    """
+    Same results as reconcile_columnar, computed in `workers` processes.
+    Also returns the invoice index and analytics it builds along the way.
+    """
+    n, n_keys = len(claims), len(claims.keys)
+    claim_order, claim_bounds = _by_shard(claims.key, workers)
+    invoice_order, invoice_bounds = _by_shard(invoices.key, workers)
+    with SharedArrays() as shared:
+        # both sides grouped by shard: claim and invoice columns in claim_order / invoice_order
+        shared.add("claim_bounds", np.int64, workers + 1, claim_bounds)
+        shared.add("claim_key", np.int32, n, claims.key[claim_order])
+        shared.add("charges_cents", np.int64, n, claims.charges_cents[claim_order])
+        shared.add("patient_id", np.int64, n, claims.patient_id[claim_order])
+        shared.add("date_of_service", np.int32, n, claims.date_of_service[claim_order])
+        shared.add("invoice_bounds", np.int64, workers + 1, invoice_bounds)
+        shared.add("invoice_key", np.int32, len(invoices), invoices.key[invoice_order])
+        shared.add("invoice_cents_in", np.int64, len(invoices), invoices.amount_cents[invoice_order])
+        by_shard = {
+            "invoice_cents": shared.add("invoice_cents", np.int64, n),
+            "invoice_count": shared.add("invoice_count", np.int32, n),
+            "status": shared.add("status", np.int8, n),
+            "credit_cents": shared.add("credit_cents", np.int64, n),
+        }
+        per_code = {
+            "totals": shared.add("totals", np.int64, n_keys),
+            "counts": shared.add("counts", np.int32, n_keys),
+        }
+
+        analytics = AnalyticsState()
+        pool = _get_pool(workers)
+        futures = [pool.submit(_reconcile_shard, shared.spec, s, workers, n_keys, analytics.mode)
+                   for s in range(workers)]
+        for future in futures:
+            analytics.merge(future.result())
+        out = {name: array.copy() for name, array in per_code.items()}
+        for name, array in by_shard.items():  # back to claim order
+            out[name] = np.empty_like(array)
+            out[name][claim_order] = array
+
+    results = ResultStore(claims, out["invoice_cents"], out["invoice_count"], out["status"],
+                          out["credit_cents"], patient_name)
+    return results, InvoiceIndex(out["totals"], out["counts"]), analytics
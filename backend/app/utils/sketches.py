@@ -0,0 +1,198 @@
+"""
+Bounded-memory, mergeable sketches for the summary (ANALYTICS_MODE=sketch).
+
+QuantileSketch keeps counts in logarithmically spaced buckets (the DDSketch
+scheme). Every quantile it reports is within `relative_error` of the true
+value, and its size grows with the log of the value range, not with the row
+count. HeavyHitters is a Misra-Gries summary with a fixed number of weighted
+counters. A key's estimate is low by at most `error`, which never exceeds
+total weight / (counters + 1).
+
+Both are mergeable by adding counts, so shard partials and incremental
+upserts fold in cheaply. Rows leaving (sign=-1) are subtracted exactly from
+quantile buckets. Heavy hitters can only subtract from keys they still track.
+"""
+import math
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+from app.utils.store import NO_INVOICES, OVERPAID, STATUS_LABELS, UNDERPAID, GroupedSums
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class QuantileSketch:
+    def __init__(self, relative_error: float):
+        if not 0 < relative_error < 1:
+            raise ValueError("relative_error must be between 0 and 1")
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self._log_gamma = math.log(self.gamma)
+        # bucket key: 0 for zero, +(k+1) for values in (gamma^(k-1), gamma^k], -(k+1) for their negatives;
+        # sorted keys are therefore in value order
+        self.buckets = GroupedSums(1)
+
+    def _keys(self, values: np.ndarray) -> np.ndarray:
+        values = np.asarray(values, dtype=np.float64)
+        magnitude = np.maximum(np.abs(values), 1.0)  # integer cents: non-zero values are at least 1
+        k = np.ceil(np.log(magnitude) / self._log_gamma).astype(np.int64) + 1
+        return np.where(values > 0, k, np.where(values < 0, -k, 0))
+
+    def add(self, values: np.ndarray, sign: int = 1):
+        self.buckets.add(self._keys(values), [np.ones(len(values), dtype=np.int64)], sign)
+
+    def merge(self, other: "QuantileSketch"):
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with different relative errors")
+        self.buckets.merge(other.buckets)
+
+    @property
+    def count(self) -> int:
+        return int(self.buckets.sums[0].sum())
+
+    def quantiles(self, qs: Sequence[float] = QUANTILES) -> List[float]:
+        """Estimated values at the given quantiles; empty when the sketch is."""
+        live = self.buckets.present()
+        keys, counts = self.buckets.keys[live], self.buckets.sums[0, live]
+        if not len(keys):
+            return []
+        cumulative = np.cumsum(counts)
+        picked = keys[np.searchsorted(cumulative, np.asarray(qs) * (cumulative[-1] - 1), side="right")]
+        k = np.abs(picked) - 1
+        estimate = 2 * self.gamma ** k / (self.gamma + 1)
+        return (np.sign(picked) * estimate).tolist()
+
+
+class HeavyHitters:
+    def __init__(self, counters: int):
+        self.counters = counters
+        self.weights = GroupedSums(1)  # tracked key -> estimated weight
+        self.error = 0  # every estimate is low by at most this much
+
+    def add(self, keys: np.ndarray, weights: np.ndarray, sign: int = 1):
+        if sign > 0:
+            self.weights.add(keys, [weights])
+            self._reduce()
+            return
+        # removals: only tracked keys can be decremented; estimates stay lower bounds
+        tracked = np.isin(keys, self.weights.keys)
+        self.weights.add(keys[tracked], [weights[tracked]], sign=-1)
+        self._drop_empty()
+
+    def merge(self, other: "HeavyHitters"):
+        self.weights.merge(other.weights)
+        self.error += other.error
+        self._reduce()
+
+    def _reduce(self):
+        """Misra-Gries step: past `counters` keys, subtract the (counters+1)-th largest weight from all."""
+        values = self.weights.sums[0]
+        if len(values) > self.counters:
+            cut = int(np.partition(values, len(values) - self.counters - 1)[len(values) - self.counters - 1])
+            self.weights.sums = self.weights.sums - cut
+            self.error += cut
+        self._drop_empty()
+
+    def _drop_empty(self):
+        keep = self.weights.sums[0] > 0
+        self.weights.keys, self.weights.sums = self.weights.keys[keep], self.weights.sums[:, keep]
+
+    def top(self, n: int) -> List[Tuple[int, int]]:
+        """(key, estimated weight) of the n heaviest tracked keys, ties by key."""
+        order = np.lexsort((self.weights.keys, -self.weights.sums[0]))[:n]
+        return list(zip(self.weights.keys[order].tolist(), self.weights.sums[0, order].tolist()))
+
+
+# measures with a quantile sketch per status; invoice totals and credits only for claims with invoices
+MEASURES = ("charges", "invoice_totals", "credits")
+
+
+class AnalyticsSketches:
+    """Per status: quantile sketches of each measure, and heavy hitters by claim count and by credit amount."""
+
+    def __init__(self, relative_error: float, counters: int):
+        self.relative_error = relative_error
+        self.counters = counters
+        self.quantiles: Dict[Tuple[str, int], QuantileSketch] = {
+            (m, s): QuantileSketch(relative_error) for m in MEASURES for s in range(len(STATUS_LABELS))
+        }
+        self.volume = [HeavyHitters(counters) for _ in STATUS_LABELS]
+        self.amount = [HeavyHitters(counters) for _ in STATUS_LABELS]  # |credit| of over/underpaid claims
+
+    def add(self, patient_id, status, charges_cents, invoice_cents, credit_cents, sign: int = 1):
+        for s in np.unique(status).tolist():
+            rows = status == s
+            self.quantiles["charges", s].add(charges_cents[rows], sign)
+            if s != NO_INVOICES:
+                self.quantiles["invoice_totals", s].add(invoice_cents[rows], sign)
+                self.quantiles["credits", s].add(credit_cents[rows], sign)
+            self.volume[s].add(patient_id[rows], np.ones(int(rows.sum()), dtype=np.int64), sign)
+            if s in (OVERPAID, UNDERPAID):
+                self.amount[s].add(patient_id[rows], np.abs(credit_cents[rows]), sign)
+
+    def merge(self, other: "AnalyticsSketches"):
+        for key, sketch in self.quantiles.items():
+            sketch.merge(other.quantiles[key])
+        for mine, theirs in zip(self.volume + self.amount, other.volume + other.amount):
+            mine.merge(theirs)
+
+    def copy(self) -> "AnalyticsSketches":
+        copy = AnalyticsSketches(self.relative_error, self.counters)
+        copy.merge(self)
+        return copy
+
+    def parts(self) -> Iterator[Tuple[str, GroupedSums]]:
+        """The sketches' GroupedSums by name, for snapshots (see errors())."""
+        for (measure, status), sketch in self.quantiles.items():
+            yield f"quantiles.{measure}.{status}", sketch.buckets
+        for status in range(len(STATUS_LABELS)):
+            yield f"volume.{status}", self.volume[status].weights
+            yield f"amount.{status}", self.amount[status].weights
+
+    def errors(self) -> np.ndarray:
+        """Heavy-hitter error offsets in volume-then-amount order, saved alongside parts()."""
+        return np.array([h.error for h in self.volume + self.amount], dtype=np.int64)
+
+    def set_errors(self, errors: np.ndarray):
+        for h, error in zip(self.volume + self.amount, errors.tolist()):
+            h.error = error
+
+    def summary(self, statuses: Sequence[int], patient_name: Callable[[int], str], top: int) -> Dict:
+        """
+        Summary entries over the given statuses, their sketches merged: top
+        patients, per-status heavy hitters, quantiles and the error bounds.
+        """
+        volume = HeavyHitters(self.counters)
+        quantiles = {}
+        for s in statuses:
+            volume.merge(self.volume[s])
+        for measure in MEASURES:
+            merged = QuantileSketch(self.relative_error)
+            for s in statuses:
+                merged.merge(self.quantiles[measure, s])
+            quantiles[measure] = {f"p{round(q * 100)}": round(v / 100, 2)
+                                  for q, v in zip(QUANTILES, merged.quantiles())}
+
+        def amounts(status: int):
+            if status not in statuses:
+                return []
+            return [{"name": patient_name(p), "amount": w / 100} for p, w in self.amount[status].top(top)]
+
+        return {
+            "top_patients_volume": [{"name": patient_name(p), "count": w} for p, w in volume.top(top)],
+            "top_patients_overpaid": amounts(OVERPAID),
+            "top_patients_underpaid": amounts(UNDERPAID),
+            "top_patients_by_status": {
+                STATUS_LABELS[s]: [{"name": patient_name(p), "count": w} for p, w in self.volume[s].top(top)]
+                for s in statuses
+            },
+            "quantiles": quantiles,
+            "sketch_error": {
+                "relative_error": self.relative_error,  # of every quantile
+                # most by which a listed count / amount may be under-estimated
+                "top_patients_volume": volume.error,
+                "top_patients_overpaid": self.amount[OVERPAID].error / 100,
+                "top_patients_underpaid": self.amount[UNDERPAID].error / 100,
+            },
+        }
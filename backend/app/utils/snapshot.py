@@ -0,0 +1,285 @@
+"""
+On-disk snapshots of the loaded dataset.
+
+A snapshot is a directory of .npy column files plus a manifest.json. It is
+written under a temporary name and renamed into place, and the LATEST file,
+which names the newest complete snapshot, is replaced atomically: a crash
+mid-write never leaves a partial snapshot current.
+
+Loading memory-maps every column copy-on-write, so only the pages a query
+touches are read from disk and upserts can modify arrays without writing
+back to the files.
+
+An upsert does not rewrite the snapshot: its delta (the uploaded claims or
+invoices) is appended to the latest snapshot as a delta-<version> segment,
+written and renamed into place the same way, and replayed on load.
+"""
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from app.logger import get_logger
+from app.utils.analytics import AnalyticsState
+from app.utils.query import ResultIndex
+from app.utils.store import ClaimStore, InvoiceIndex, InvoiceStore, KeyTable, ResultStore
+
+logger = get_logger(__name__)
+
+FORMAT = 2  # 2: analytics as rollup cubes (and sketches, in sketch mode)
+LATEST = "LATEST"
+DELTA = "delta-"
+
+
+class Delta(NamedTuple):
+    version: int  # the version the upsert published
+    data: Union[ClaimStore, InvoiceStore]
+
+
+class Snapshot(NamedTuple):
+    claims: ClaimStore
+    invoices: InvoiceStore
+    results: Optional[ResultStore]
+    invoice_index: Optional[InvoiceIndex]
+    invoice_ids: Optional[Tuple[KeyTable, np.ndarray]]  # invoice_id intern table and the row of each code
+    analytics: AnalyticsState
+    result_index: Optional[Dict[str, np.ndarray]]  # ResultIndex.parts() of the results, if saved
+    version: int
+    path: Path
+    deltas: List[Delta]  # upserts applied since, oldest first
+
+
+def _columns(claims: ClaimStore, invoices: InvoiceStore, results: Optional[ResultStore],
+             index: Optional[InvoiceIndex], analytics: AnalyticsState,
+             result_index: Optional[ResultIndex],
+             invoice_ids: Optional[Tuple[KeyTable, np.ndarray]]) -> Dict[str, np.ndarray]:
+    values, hashes, codes = claims.keys.parts()
+    columns = {
+        "claim_keys.values": values, "claim_keys.hashes": hashes, "claim_keys.codes": codes,
+        "claims.key": claims.key, "claims.patient_id": claims.patient_id,
+        "claims.date_of_service": claims.date_of_service, "claims.charges_cents": claims.charges_cents,
+        "invoices.invoice_id": invoices.invoice_id, "invoices.key": invoices.key,
+        "invoices.amount_cents": invoices.amount_cents,
+        "analytics.status_counts": analytics.status_counts,
+    }
+    for name, sums in _analytics_parts(analytics):
+        columns[f"analytics.{name}.keys"] = sums.keys
+        columns[f"analytics.{name}.sums"] = sums.sums
+    if analytics.sketches is not None:
+        columns["analytics.sketch_errors"] = analytics.sketches.errors()
+    if results is not None:
+        columns.update({
+            "results.invoice_cents": results.invoice_cents, "results.invoice_count": results.invoice_count,
+            "results.status": results.status, "results.credit_cents": results.credit_cents,
+        })
+    if index is not None:
+        columns.update({"index.totals": index.totals, "index.counts": index.counts})
+    if results is not None and result_index is not None:
+        columns.update({f"result_index.{name}": part for name, part in result_index.parts().items()})
+    if invoice_ids is not None:
+        table, rows = invoice_ids
+        values, hashes, codes = table.parts()
+        columns.update({"invoice_ids.values": values, "invoice_ids.hashes": hashes, "invoice_ids.codes": codes,
+                        "invoice_ids.row": rows})
+    return columns
+
+
+def _analytics_parts(analytics: AnalyticsState):
+    yield "patients", analytics.patients
+    for granularity, cube in analytics.cubes.items():
+        yield f"cube.{granularity}", cube
+    if analytics.sketches is not None:
+        for name, sums in analytics.sketches.parts():
+            yield f"sketch.{name}", sums
+
+
+def _analytics_params(analytics: AnalyticsState) -> Dict:
+    """What the saved aggregates were built with; a snapshot from another mode or bound is rebuilt."""
+    if analytics.sketches is None:
+        return {"mode": "exact"}
+    return {"mode": "sketch", "relative_error": analytics.sketches.relative_error,
+            "counters": analytics.sketches.counters}
+
+
+def _write_columns(directory: Path, columns: Dict[str, np.ndarray]) -> Dict[str, Dict]:
+    """One fsynced .npy file per column; returns the manifest's column entries."""
+    entries = {}
+    for column, array in columns.items():
+        with open(directory / f"{column}.npy", "wb") as f:
+            np.save(f, np.ascontiguousarray(array))
+            f.flush()
+            os.fsync(f.fileno())
+        entries[column] = {"dtype": array.dtype.str, "shape": list(array.shape)}
+    return entries
+
+
+def _fsync_dir(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_snapshot(root: Path, claims: ClaimStore, invoices: InvoiceStore, results: Optional[ResultStore],
+                   index: Optional[InvoiceIndex], analytics: AnalyticsState, version: int,
+                   keep: int = 1, result_index: Optional[ResultIndex] = None,
+                   invoice_ids: Optional[Tuple[KeyTable, np.ndarray]] = None) -> Path:
+    """Write a complete snapshot under `root`, point LATEST at it and prune older ones."""
+    if invoices.keys is not claims.keys:
+        raise ValueError("Invoices must share the claims' key table (see InvoiceStore.rekey)")
+    start = time.perf_counter()
+    root.mkdir(parents=True, exist_ok=True)
+    name = f"snapshot-{version:08d}-{time.time_ns()}"
+    tmp = root / f".{name}.tmp"
+    tmp.mkdir()
+
+    manifest = {"format": FORMAT, "version": version, "created_at": time.time(),
+                "claims": len(claims), "invoices": len(invoices), "analytics": _analytics_params(analytics),
+                "columns": {}}
+    manifest["columns"] = _write_columns(tmp, _columns(claims, invoices, results, index, analytics, result_index,
+                                                       invoice_ids))
+    (tmp / "manifest.json").write_text(json.dumps(manifest, indent=2))
+    _fsync_dir(tmp)
+
+    tmp.rename(root / name)
+    pointer = root / f".{LATEST}.tmp"
+    pointer.write_text(name)
+    os.replace(pointer, root / LATEST)
+    _fsync_dir(root)
+
+    _prune(root, name, keep)
+    logger.info("snapshot %s written claims=%d invoices=%d seconds=%.3f",
+                name, len(claims), len(invoices), time.perf_counter() - start)
+    return root / name
+
+
+def append_deltas(path: Path, deltas: Sequence[Delta]):
+    """
+    Add upsert segments to the snapshot at `path`; only their own files and
+    the snapshot directory are written and fsynced.
+    """
+    start = time.perf_counter()
+    for tmp in path.glob(f".{DELTA}*.tmp"):
+        shutil.rmtree(tmp, ignore_errors=True)
+    for delta in deltas:
+        name = f"{DELTA}{delta.version:08d}"
+        if (path / name).exists():
+            continue  # written by an earlier save that failed on a later segment
+        tmp = path / f".{name}.tmp"
+        tmp.mkdir()
+        data = delta.data
+        if isinstance(data, ClaimStore):
+            kind, columns = "claims", {
+                "claim_id": data.keys.values[data.key], "patient_id": data.patient_id,
+                "date_of_service": data.date_of_service, "charges_cents": data.charges_cents,
+            }
+        else:
+            kind, columns = "invoices", {
+                "invoice_id": data.invoice_id, "claim_id": data.keys.values[data.key],
+                "amount_cents": data.amount_cents,
+            }
+        manifest = {"version": delta.version, "kind": kind, "rows": len(data), "columns": _write_columns(tmp, columns)}
+        (tmp / "manifest.json").write_text(json.dumps(manifest, indent=2))
+        _fsync_dir(tmp)
+        tmp.rename(path / name)
+    _fsync_dir(path)
+    logger.info("snapshot %s: %d delta segment(s) appended seconds=%.3f",
+                path.name, len(deltas), time.perf_counter() - start)
+
+
+def delta_count(path: Path) -> int:
+    """Number of upsert segments appended to the snapshot at `path`."""
+    return sum(1 for _ in path.glob(f"{DELTA}*"))
+
+
+def read_deltas(path: Path, after: int = -1) -> List[Delta]:
+    """The snapshot's upsert segments newer than version `after`, oldest first, loaded into memory."""
+    deltas = []
+    for segment in sorted(path.glob(f"{DELTA}*")):
+        if int(segment.name[len(DELTA):]) <= after:
+            continue
+        manifest = json.loads((segment / "manifest.json").read_text())
+        col = {column: np.load(segment / f"{column}.npy") for column in manifest["columns"]}
+        keys = KeyTable()
+        if manifest["kind"] == "claims":
+            data = ClaimStore(keys, keys.intern(col["claim_id"]), col["patient_id"], col["date_of_service"],
+                              col["charges_cents"])
+        else:
+            data = InvoiceStore(col["invoice_id"], keys, keys.intern(col["claim_id"]), col["amount_cents"])
+        deltas.append(Delta(manifest["version"], data))
+    return deltas
+
+
+def _prune(root: Path, current: str, keep: int):
+    """Remove leftovers of interrupted writes and all but the `keep` newest older snapshots."""
+    for tmp in root.glob(".snapshot-*.tmp"):
+        shutil.rmtree(tmp, ignore_errors=True)
+    older = sorted((p for p in root.glob("snapshot-*") if p.name != current), key=lambda p: p.name)
+    for path in older[:max(len(older) - keep, 0)]:
+        shutil.rmtree(path, ignore_errors=True)  # open memory maps stay valid until unmapped
+
+
+def latest_snapshot(root: Path) -> Optional[str]:
+    """Name of the snapshot LATEST points at, or None."""
+    try:
+        return (root / LATEST).read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def read_snapshot(root: Path, patient_name: Callable[[int], str]) -> Optional[Snapshot]:
+    """Memory-map the snapshot LATEST points at; None when there is none."""
+    name = latest_snapshot(root)
+    if name is None:
+        return None
+    path = root / name
+    manifest = json.loads((path / "manifest.json").read_text())
+    if manifest["format"] not in (1, FORMAT):
+        raise ValueError(f"Unsupported snapshot format {manifest['format']} in {path}")
+    columns = manifest["columns"]
+
+    def col(column: str, mmap: bool = True) -> np.ndarray:
+        # "c": copy-on-write; reads page in lazily, writes stay in this process
+        return np.load(path / f"{column}.npy", mmap_mode="c" if mmap else None)
+
+    keys = KeyTable.from_parts(col("claim_keys.values"), col("claim_keys.hashes"), col("claim_keys.codes"))
+    claims = ClaimStore(keys, col("claims.key"), col("claims.patient_id"),
+                        col("claims.date_of_service"), col("claims.charges_cents"))
+    invoices = InvoiceStore(col("invoices.invoice_id"), keys, col("invoices.key"), col("invoices.amount_cents"))
+
+    results = None
+    if "results.status" in columns:
+        results = ResultStore(claims, col("results.invoice_cents"), col("results.invoice_count"),
+                              col("results.status"), col("results.credit_cents"), patient_name)
+    index = InvoiceIndex(col("index.totals"), col("index.counts")) if "index.totals" in columns else None
+    invoice_ids = None
+    if "invoice_ids.values" in columns:
+        invoice_ids = (KeyTable.from_parts(col("invoice_ids.values"), col("invoice_ids.hashes"), col("invoice_ids.codes")),
+                       col("invoice_ids.row"))
+
+    analytics = AnalyticsState()
+    if manifest["format"] == 1 or manifest.get("analytics", {"mode": "exact"}) != _analytics_params(analytics):
+        # format 1 predates the rollup cubes, and the saved aggregates may be from another
+        # ANALYTICS_MODE or sketch bound: rebuild them from the results
+        if results is not None:
+            analytics = AnalyticsState.from_results(results)
+    else:
+        # aggregates are small; load them outright
+        analytics.status_counts = col("analytics.status_counts", mmap=False)
+        for part, sums in _analytics_parts(analytics):
+            sums.keys = col(f"analytics.{part}.keys", mmap=False)
+            sums.sums = col(f"analytics.{part}.sums", mmap=False)
+        if analytics.sketches is not None:
+            analytics.sketches.set_errors(col("analytics.sketch_errors", mmap=False))
+
+    prefix = "result_index."
+    result_index = {c[len(prefix):]: col(c) for c in columns if c.startswith(prefix)} or None
+
+    logger.info("snapshot %s mapped claims=%d invoices=%d", name, manifest["claims"], manifest["invoices"])
+    return Snapshot(claims, invoices, results, index, invoice_ids, analytics, result_index, manifest["version"], path,
+                    read_deltas(path, after=manifest["version"]))
@@ -0,0 +1,823 @@
+"""
+Out-of-core storage: a dataset held in an on-disk SQLite database.
+
+Selected with STORAGE_BACKEND=sqlite. Uploads are streamed into staging
+tables one CSV chunk at a time, a reconcile is a single set-based
+join/aggregate into the results table, and reads are indexed queries that
+fetch one page at a time. The process holds at most a CSV chunk, a result
+page and SQLite's bounded page cache, however large the dataset is.
+
+The database runs in WAL mode, so readers never wait for the writer. Each
+published version keeps read transactions open on the state it committed
+(a _Snapshot), and every read of that version runs in one of them: pages,
+counts and exports show the version the caller pinned, whatever commits
+later.
+"""
+import sqlite3
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from datetime import date
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.config import SQLITE_CACHE_MB
+from app.logger import get_logger
+from app.models.claim import Claim
+from app.models.invoice import Invoice
+from app.models.schemas import ReconciliationResult, ResultQuery
+from app.utils.changelog import ABSENT, Changelog, History, fingerprints
+from app.utils.analytics import CHARGE_BIN_CENTS, STATE_FIELDS, AnalyticsState, GroupedSums, Rollup, cube_keys
+from app.utils.csv_loader import IngestReport, iter_claims, iter_invoices
+from app.utils.export import json_record
+from app.utils.metrics import timed
+from app.utils.patients import PatientDirectory, get_patients
+from app.utils.query import _cents, _parse_sort
+from app.utils.store import BALANCED, NO_INVOICES, OVERPAID, STATUS_LABELS, UNDERPAID, ClaimStore, InvoiceStore
+
+logger = get_logger(__name__)
+
+DATABASE = "dataset.sqlite"
+
+_TABLES = {
+    "claims": "row INTEGER PRIMARY KEY, claim_id BLOB NOT NULL, patient_id INTEGER NOT NULL, "
+              "date_of_service INTEGER NOT NULL, charges_cents INTEGER NOT NULL",
+    "invoices": "invoice_id BLOB NOT NULL, claim_id BLOB NOT NULL, amount_cents INTEGER NOT NULL",
+    # self-contained (claim fields copied in), so readers never touch claims or invoices
+    "results": "row INTEGER PRIMARY KEY, claim_id BLOB NOT NULL, patient_id INTEGER NOT NULL, "
+               "date_of_service INTEGER NOT NULL, charges_cents INTEGER NOT NULL, invoice_cents INTEGER NOT NULL, "
+               "invoice_count INTEGER NOT NULL, status INTEGER NOT NULL, credit_cents INTEGER",  # NULL: no invoices
+}
+
+_INDEXES = {
+    "claims": ("claim_id", "patient_id", "date_of_service"),
+    "invoices": ("claim_id", "invoice_id"),
+    "results": ("claim_id", "patient_id", "date_of_service", "status", "charges_cents",
+                "(credit_cents IS NULL), credit_cents"),
+}
+
+_RESULT_COLUMNS = ("row, claim_id, patient_id, date_of_service, charges_cents, "
+                   "invoice_cents, invoice_count, status, credit_cents")
+
+# serialized SQLite: one connection may run statements for several threads at once
+_SHARED_CONNECTIONS = sqlite3.threadsafety == 3
+
+# WAL frames after which a publish re-pins its version so the log can restart (SQLite's autocheckpoint default)
+_WAL_RESTART_FRAMES = 1000
+
+# rows per fetch when results are streamed into the analytics sketches (ANALYTICS_MODE=sketch)
+_SKETCH_BATCH_ROWS = 100_000
+
+# the reconcile itself: one grouped aggregate over invoices, left-joined to claims
+_RECONCILE = f"""
+    INSERT INTO results ({_RESULT_COLUMNS})
+    SELECT c.row, c.claim_id, c.patient_id, c.date_of_service, c.charges_cents,
+           COALESCE(i.total, 0), COALESCE(i.n, 0),
+           CASE WHEN i.n IS NULL THEN {NO_INVOICES}
+                WHEN i.total = c.charges_cents THEN {BALANCED}
+                WHEN i.total > c.charges_cents THEN {OVERPAID}
+                ELSE {UNDERPAID} END,
+           i.total - c.charges_cents
+    FROM claims c
+    LEFT JOIN (SELECT claim_id, SUM(amount_cents) AS total, COUNT(*) AS n
+               FROM invoices {{invoice_filter}} GROUP BY claim_id) i ON i.claim_id = c.claim_id
+    {{claim_filter}}
+    ORDER BY c.row
+"""
+
+# (expression, descending) terms of each sort order; row breaks ties like ResultIndex does
+_ORDER = {
+    None: [("row", False)],
+    "date_of_service": [("date_of_service", False), ("row", False)],
+    "charges_amount": [("charges_cents", False), ("row", False)],
+    "credit": [("(credit_cents IS NULL)", False), ("credit_cents", False), ("row", False)],
+}
+_DESCENDING = {
+    "date_of_service": [("date_of_service", True), ("row", True)],
+    "charges_amount": [("charges_cents", True), ("row", True)],
+    # rows without a credit stay last, in position order
+    "credit": [("(credit_cents IS NULL)", False), ("credit_cents", True),
+               ("(CASE WHEN credit_cents IS NULL THEN row ELSE -row END)", False)],
+}
+
+
+class Staged:
+    """Rows parsed into a staging table, waiting for load_*/upsert_*."""
+
+    def __init__(self, table: str, rows: int, report: Optional[IngestReport] = None):
+        self.table = table
+        self.rows = rows
+        self.report = report
+
+    def __len__(self) -> int:
+        return self.rows
+
+
+class Table:
+    """len() of a table, so callers can treat it like the in-memory stores."""
+
+    def __init__(self, service: "SqliteReconciliationService", name: str):
+        self._service = service
+        self.name = name
+
+    def __len__(self) -> int:
+        # kept in meta by every write: COUNT(*) would scan the whole table
+        return self._service._conn().execute(f"SELECT {self.name}_rows FROM meta").fetchone()[0]
+
+
+class _Snapshot:
+    """
+    Connections each holding a read transaction open on one committed version.
+    More are opened on demand while that version is still the newest committed
+    one. After that, readers share the ones already open, so a read never waits
+    for a stream to finish. A version that is still being read holds back WAL
+    checkpoints until it is released.
+    """
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection]):
+        self._connect = connect
+        conn, self.version = self._begin()
+        self._conns = [conn]
+        self._users = [0]  # readers currently using each connection
+        self._released = threading.Condition()
+
+    def _begin(self) -> Tuple[sqlite3.Connection, int]:
+        conn = self._connect()
+        conn.execute("BEGIN")
+        return conn, conn.execute("SELECT version FROM meta").fetchone()[0]  # the first read fixes the snapshot
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """A connection reading this version."""
+        i = self._take()
+        try:
+            yield self._conns[i]
+        finally:
+            with self._released:
+                self._users[i] -= 1
+                self._released.notify()
+
+    def _take(self) -> int:
+        with self._released:
+            if 0 in self._users:
+                i = self._users.index(0)
+                self._users[i] += 1
+                return i
+        conn, version = self._begin()
+        with self._released:
+            if version == self.version:
+                self._conns.append(conn)
+                self._users.append(1)
+                return len(self._conns) - 1
+            conn.close()  # a newer version has committed since; use one of ours
+            if not _SHARED_CONNECTIONS:
+                while 0 not in self._users:
+                    self._released.wait()
+            i = self._users.index(min(self._users))
+            self._users[i] += 1
+            return i
+
+    def close(self):
+        for conn in self._conns:
+            conn.close()
+
+
+@contextmanager
+def _transaction(conn: sqlite3.Connection, mode: str = ""):
+    conn.execute(f"BEGIN {mode}")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _patient_rows(directory: PatientDirectory) -> Iterator[tuple]:
+    """(patient_id, name, case-folded name) of every patient in the directory."""
+    ids, offsets, blob = directory.ids, directory.offsets, directory.blob
+    folded_offsets, folded_blob = directory.folded_offsets, directory.folded_blob
+    for k, row in enumerate(directory.folded_rows.tolist()):
+        yield (int(ids[row]), blob[offsets[row]:offsets[row + 1]].tobytes().decode("utf-8"),
+               folded_blob[folded_offsets[k]:folded_offsets[k + 1]].tobytes().decode("utf-8"))
+
+
+def _create(conn: sqlite3.Connection, table: str, name: Optional[str] = None):
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {name or table} ({_TABLES[table]})")
+
+
+def _create_indexes(conn: sqlite3.Connection, table: str):
+    for i, columns in enumerate(_INDEXES[table]):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_{i} ON {table} ({columns})")
+
+
+class SqliteResultVersion:
+    """
+    A published version of the results table; the SQLite counterpart of
+    ResultVersion. Pages are read straight from the database.
+    """
+
+    def __init__(self, service: "SqliteReconciliationService", version: int, summary: Dict, total: int,
+                 rollup: Optional[Rollup] = None, snapshot: Optional[_Snapshot] = None,
+                 history: Optional[History] = None):
+        self.service = service
+        self.version = version
+        self._snapshot = snapshot or _Snapshot(service._reader)
+        weakref.finalize(self, self._snapshot.close)  # the read transactions end with the last reference
+        with self._snapshot.connection() as conn:
+            row = conn.execute("SELECT generation FROM patients_source").fetchone()
+        self.patients_source = row[0] if row else None  # directory generation its name filters match
+        self._summary = (service.patients.generation, summary)
+        self.rollup = rollup
+        self.history = history if history is not None else History()
+        self.total = total
+        self.patients = service.patients
+        self.patient_name = service._patient_name
+        self.published_at = time.time()
+
+    @property
+    def summary(self) -> Dict:
+        return self._summary[1]
+
+    def __len__(self) -> int:
+        return self.total
+
+    def page(self, skip: int = 0, limit: int = 100) -> List[ReconciliationResult]:
+        return self.query(ResultQuery(), skip, limit)[0]
+
+    def query(self, query: ResultQuery, skip: int = 0, limit: int = 100,
+              after: Optional[Tuple] = None) -> Tuple[List[ReconciliationResult], int, Optional[Tuple]]:
+        """Same contract as ResultVersion.query(); only the row of the `after` cursor is used."""
+        rows, total, last = self._select(query, skip, limit, after)
+        return [self._model(r) for r in rows], total, last
+
+    def records(self, query: ResultQuery, skip: int = 0, limit: int = 100,
+                after: Optional[Tuple] = None) -> Tuple[List[Dict], int, Optional[Tuple]]:
+        """Same contract as ResultVersion.records()."""
+        rows, total, last = self._select(query, skip, limit, after)
+        return [json_record(self._export_row(r)) for r in rows], total, last
+
+    def _select(self, query: ResultQuery, skip: int, limit: int, after: Optional[Tuple]):
+        where, params = self._where(query)
+        terms = self._terms(query)
+        with self._snapshot.connection() as conn:
+            total = self.total if not query.is_filtered() else \
+                conn.execute(f"SELECT COUNT(*) FROM results WHERE {where}", params).fetchone()[0]
+            if after is not None:
+                keyset, keyset_params = self._keyset(conn, terms, after[1])
+                where, params = f"{where} AND {keyset}", params + keyset_params
+            rows = conn.execute(
+                f"SELECT {_RESULT_COLUMNS} FROM results WHERE {where} ORDER BY {_order_by(terms)} "
+                f"LIMIT ? OFFSET ?", params + [limit + 1, skip],  # one extra row tells if a next page exists
+            ).fetchall()
+        last = (None, rows[limit - 1][0]) if len(rows) > limit else None
+        return rows[:limit], total, last
+
+    def iter_rows(self, query: ResultQuery, batch_size: int) -> Iterator[List[tuple]]:
+        """Matching results in order as export row tuples (see export.column_rows), a batch at a time."""
+        where, params = self._where(query)
+        # held for the whole stream, which may resume on any thread
+        with self._snapshot.connection() as conn:
+            cursor = conn.execute(f"SELECT {_RESULT_COLUMNS} FROM results WHERE {where} "
+                                  f"ORDER BY {_order_by(self._terms(query))}", params)
+            try:
+                while True:
+                    batch = cursor.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    yield [self._export_row(r) for r in batch]
+            finally:
+                cursor.close()
+
+    def _model(self, r: tuple) -> ReconciliationResult:
+        _, claim_id, pid, dos, charges, invoices, count, status, credit = r
+        return ReconciliationResult(
+            claim_id=claim_id.decode("utf-8"),
+            patient_id=str(pid),
+            patient_name=self.patient_name(pid),
+            date_of_service=date.fromordinal(dos),
+            charges_amount=charges / 100,
+            invoice_total=invoices / 100 if count else None,
+            status=STATUS_LABELS[status],
+            credit=credit / 100 if count else None,
+        )
+
+    def orphan_invoices(self, skip: int = 0, limit: int = 100) -> Tuple[List[Dict], int, int]:
+        """Same contract as ResultVersion.orphan_invoices(); an anti-join on the claims' claim_id index."""
+        orphan = "FROM invoices i WHERE NOT EXISTS (SELECT 1 FROM claims c WHERE c.claim_id = i.claim_id)"
+        with self._snapshot.connection() as conn:
+            total, cents = conn.execute(f"SELECT COUNT(*), COALESCE(SUM(amount_cents), 0) {orphan}").fetchone()
+            rows = conn.execute(f"SELECT invoice_id, claim_id, amount_cents {orphan} ORDER BY i.rowid LIMIT ? OFFSET ?",
+                                [limit, skip]).fetchall()
+        return [{"invoice_id": i.decode("utf-8"), "claim_id": c.decode("utf-8"), "transaction_value": cents / 100}
+                for i, c, cents in rows], total, cents
+
+    def _export_row(self, r: tuple) -> tuple:
+        _, claim_id, pid, dos, charges, invoices, count, status, credit = r
+        return (claim_id.decode("utf-8"), pid, self.patient_name(pid), date.fromordinal(dos).isoformat(),
+                charges, invoices, STATUS_LABELS[status], credit or 0, count > 0)
+
+    @staticmethod
+    def _terms(query: ResultQuery):
+        field, descending = _parse_sort(query.sort)
+        return _DESCENDING[field] if descending else _ORDER[field]
+
+    def _where(self, q: ResultQuery) -> Tuple[str, list]:
+        clauses, params = ["1"], []
+        if q.status:
+            codes = sorted({STATUS_LABELS.index(s) for s in q.status})
+            clauses.append(f"status IN ({', '.join('?' * len(codes))})")
+            params += codes
+        if q.patient_id is not None:
+            clauses.append("patient_id = ?")
+            params.append(q.patient_id)
+        if q.patient_name:
+            # names come from the patients table, which writers keep in step with the
+            # directory (sync_patients); unlisted patients are named "Patient <id>"
+            prefix = q.patient_name.casefold()
+            clauses.append("(patient_id IN (SELECT patient_id FROM patients WHERE folded >= ? AND folded < ?)"
+                           " OR (patient_id NOT IN (SELECT patient_id FROM patients)"
+                           " AND 'patient ' || patient_id >= ? AND 'patient ' || patient_id < ?))")
+            params += [prefix, prefix + "\U0010ffff"] * 2
+        for column, lo, hi in (
+            ("date_of_service", q.date_from.toordinal() if q.date_from else None,
+             q.date_to.toordinal() if q.date_to else None),
+            ("charges_cents", _cents(q.min_charges), _cents(q.max_charges)),
+            ("credit_cents", _cents(q.min_credit), _cents(q.max_credit)),
+        ):
+            if lo is not None:
+                clauses.append(f"{column} >= ?")
+                params.append(lo)
+            if hi is not None:
+                clauses.append(f"{column} <= ?")
+                params.append(hi)
+            if column == "credit_cents" and (lo is not None or hi is not None):
+                clauses.append("credit_cents IS NOT NULL")
+        return " AND ".join(clauses), params
+
+    @staticmethod
+    def _keyset(conn: sqlite3.Connection, terms, row: int) -> Tuple[str, list]:
+        """Condition selecting the rows ordered after `row`; ValueError if the row does not exist."""
+        values = conn.execute(f"SELECT {', '.join(e for e, _ in terms)} FROM results WHERE row = ?",
+                              [row]).fetchone()
+        if values is None:
+            raise ValueError("Cursor row is not part of this result set")
+        if all(not d for _, d in terms) and None not in values:
+            # one row-value comparison, which SQLite can answer from an index range
+            return f"({', '.join(e for e, _ in terms)}) > ({', '.join('?' * len(terms))})", list(values)
+        alternatives, params = [], []
+        for i, (expr, descending) in enumerate(terms):
+            equal = [f"{e} IS ?" for e, _ in terms[:i]]
+            alternatives.append("(" + " AND ".join(equal + [f"{expr} {'<' if descending else '>'} ?"]) + ")")
+            params += list(values[:i]) + [values[i]]
+        return "(" + " OR ".join(alternatives) + ")", params
+
+
+def _order_by(terms) -> str:
+    return ", ".join(f"{e} DESC" if d else e for e, d in terms)
+
+
+class SqliteReconciliationService:
+    """ReconciliationService's interface over one SQLite database per dataset."""
+
+    def __init__(self, snapshot_dir: str, cache_mb: int = SQLITE_CACHE_MB):
+        self.snapshot_dir = snapshot_dir
+        self.path = Path(snapshot_dir) / DATABASE
+        self.cache_mb = cache_mb
+        self._local = threading.local()  # sqlite3 connections are per thread
+        self.patients = get_patients()
+        self.claims = Table(self, "claims")
+        self.invoices = Table(self, "invoices")
+        self.analytics = AnalyticsState()  # of the published version; upserts update it in place
+        self.current: Optional[SqliteResultVersion] = None
+        self.version = 0
+        # upserts are diffable; a full reconcile is recorded without its fingerprint table, which
+        # would hold every claim in memory
+        self.changelog = Changelog()
+        self.saved_version: Optional[int] = None  # every commit is durable: always equal to version
+        self.snapshot_name = DATABASE
+        self._init_schema()
+
+    # --- connections ---------------------------------------------------------------------------
+
+    def _connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=check_same_thread, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{self.cache_mb * 1024}")  # KiB
+        conn.execute("PRAGMA temp_store=FILE")  # sorts and temp tables spill to disk, not RAM
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        """A connection for a _Snapshot, which hands it to whichever thread reads next."""
+        return self._connect(check_same_thread=False)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _init_schema(self):
+        conn = self._conn()
+        with _transaction(conn, "IMMEDIATE"):
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                         "version INTEGER NOT NULL, published INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO meta (id, version, published) VALUES (0, 0, 0)")
+            for table in _TABLES:
+                _create(conn, table)
+                _create_indexes(conn, table)
+            columns = {r[1] for r in conn.execute("PRAGMA table_info(meta)")}
+            for table in ("claims", "invoices"):
+                if f"{table}_rows" not in columns:  # new, or a database from before row counts were kept
+                    conn.execute(f"ALTER TABLE meta ADD COLUMN {table}_rows INTEGER NOT NULL DEFAULT 0")
+                    conn.execute(f"UPDATE meta SET {table}_rows = (SELECT COUNT(*) FROM {table})")
+            conn.execute("CREATE TABLE IF NOT EXISTS patients "
+                         "(patient_id INTEGER PRIMARY KEY, name TEXT NOT NULL, folded TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS patients_0 ON patients (folded)")
+            conn.execute("CREATE TABLE IF NOT EXISTS patients_source "
+                         "(id INTEGER PRIMARY KEY CHECK (id = 0), generation TEXT NOT NULL)")
+
+    def sync_patients(self):
+        """
+        Copy the current patient directory into the patients table (read by name
+        filters). Writers only: reconciles and upserts call it in their own
+        transaction, and a patient directory upload calls it for every dataset.
+        """
+        conn = self._conn()
+        with _transaction(conn, "IMMEDIATE"):
+            self._sync_patients(conn)
+        self._repin()
+
+    def _sync_patients(self, conn: sqlite3.Connection):
+        """sync_patients() inside the caller's write transaction; nothing to do if the table holds this generation."""
+        directory = self.patients.directory
+        row = conn.execute("SELECT generation FROM patients_source").fetchone()
+        if row is None or row[0] != directory.generation:
+            conn.execute("DELETE FROM patients")
+            conn.executemany("INSERT INTO patients VALUES (?, ?, ?)", _patient_rows(directory))
+            conn.execute("INSERT OR REPLACE INTO patients_source VALUES (0, ?)", [directory.generation])
+
+    # --- loading -------------------------------------------------------------------------------
+
+    def read_claims(self, files, progress: Optional[Callable[[IngestReport], None]] = None,
+                    on_error: str = "fail") -> Staged:
+        """
+        Stream claims CSV file(s) into a staging table, one parsed chunk per
+        transaction; several files are staged one after another (one writer).
+        Invalid rows fail the staging unless `on_error` is "skip".
+        """
+        report = IngestReport("claims")
+        chunks = iter_claims(files, report, progress=progress, on_error=on_error)
+        return self._stage("claims", (self._claim_rows(c) for c in chunks), report)
+
+    def read_invoices(self, files, progress: Optional[Callable[[IngestReport], None]] = None,
+                      on_error: str = "fail") -> Staged:
+        report = IngestReport("invoices")
+        chunks = iter_invoices(files, report, progress=progress, on_error=on_error)
+        return self._stage("invoices", (self._invoice_rows(i) for i in chunks), report)
+
+    @staticmethod
+    def _claim_rows(claims: ClaimStore) -> Iterator[tuple]:
+        return zip(claims.keys.values[claims.key].tolist(), claims.patient_id.tolist(),
+                   claims.date_of_service.tolist(), claims.charges_cents.tolist())
+
+    @staticmethod
+    def _invoice_rows(invoices: InvoiceStore) -> Iterator[tuple]:
+        return zip(invoices.invoice_id.tolist(), invoices.keys.values[invoices.key].tolist(),
+                   invoices.amount_cents.tolist())
+
+    def _stage(self, table: str, chunks, report: Optional[IngestReport] = None) -> Staged:
+        conn = self._conn()
+        stage = f"{table}_stage"
+        conn.execute(f"DROP TABLE IF EXISTS {stage}")
+        _create(conn, table, stage)
+        rows = 0
+        for chunk in chunks:
+            with _transaction(conn, "IMMEDIATE"):
+                if table == "claims":
+                    cursor = conn.executemany(f"INSERT INTO {stage} VALUES (?, ?, ?, ?, ?)",
+                                              ((rows + i, *r) for i, r in enumerate(chunk)))
+                else:
+                    cursor = conn.executemany(f"INSERT INTO {stage} VALUES (?, ?, ?)", chunk)
+            rows += cursor.rowcount
+        if report is not None:
+            column = "claim_id" if table == "claims" else "invoice_id"
+            duplicates = conn.execute(f"SELECT {column} FROM {stage} GROUP BY {column} HAVING COUNT(*) > 1")
+            report.duplicated(np.array([bytes(r[0]) for r in duplicates], dtype=object))
+        return Staged(stage, rows, report)
+
+    def _staged(self, data, table: str) -> Staged:
+        if isinstance(data, Staged):
+            return data
+        if table == "claims":
+            store = data if isinstance(data, ClaimStore) else ClaimStore.from_models(data)
+            return self._stage(table, [self._claim_rows(store)])
+        store = data if isinstance(data, InvoiceStore) else InvoiceStore.from_models(data)
+        return self._stage(table, [self._invoice_rows(store)])
+
+    def _swap_in(self, staged: Staged, table: str):
+        conn = self._conn()
+        with _transaction(conn, "IMMEDIATE"):
+            conn.execute(f"DROP TABLE {table}")
+            conn.execute(f"ALTER TABLE {staged.table} RENAME TO {table}")
+            _create_indexes(conn, table)
+            conn.execute(f"UPDATE meta SET {table}_rows = ?", [staged.rows])
+
+    def load_claims(self, claims: Sequence[Claim]):
+        """Replace the claims; readers keep the published results until the next reconcile."""
+        self._swap_in(self._staged(claims, "claims"), "claims")
+
+    def load_invoices(self, invoices: Sequence[Invoice]):
+        self._swap_in(self._staged(invoices, "invoices"), "invoices")
+
+    def ensure_indexes(self):
+        """Indexes are part of the schema; nothing to build."""
+
+    # --- reconcile -----------------------------------------------------------------------------
+
+    def reconcile(self, progress: Optional[Callable[[str], None]] = None) -> SqliteResultVersion:
+        """Full reconciliation as one join/aggregate; `progress` is told each stage as it starts."""
+        stage = progress or (lambda name: None)
+        conn = self._conn()
+        with _transaction(conn, "IMMEDIATE"):
+            stage("reconcile")
+            with timed("reconcile", engine="sqlite"):
+                conn.execute("DROP TABLE results")
+                _create(conn, "results")
+                conn.execute(_RECONCILE.format(invoice_filter="", claim_filter=""))
+            stage("index")
+            with timed("index", engine="sqlite"):
+                _create_indexes(conn, "results")
+            stage("analytics")
+            self._sync_patients(conn)
+            version = self._bump_version(conn)
+            with timed("analytics", engine="sqlite"):
+                analytics = self._analytics(conn)
+        conn.execute("PRAGMA optimize")
+        view = self._publish(version, analytics)
+        self._checkpoint()
+        return view
+
+    @staticmethod
+    def _bump_version(conn: sqlite3.Connection) -> int:
+        version = conn.execute("SELECT version FROM meta").fetchone()[0] + 1
+        conn.execute("UPDATE meta SET version = ?, published = 1", [version])
+        return version
+
+    def _publish(self, version: int, analytics: AnalyticsState,
+                 changes: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+                 snapshot: Optional[_Snapshot] = None) -> SqliteResultVersion:
+        """
+        Swap in a view pinned to a committed version; `changes` as for
+        ReconciliationService._publish().
+        """
+        snapshot = snapshot or _Snapshot(self._reader)
+        if snapshot.version != version:
+            # another process committed after this one (only without the shared writer lock): publish its version
+            logger.warning("version %d superseded by %d before it was published", version, snapshot.version)
+            with snapshot.connection() as conn:
+                version, analytics, changes = snapshot.version, self._analytics(conn), None
+        if changes is None:
+            self.changelog.record_full(version)
+        else:
+            self.changelog.record_delta(version, *changes)
+        self.analytics = analytics
+        self.version = self.saved_version = version
+        self.current = self._view(version, analytics, snapshot)
+        return self.current
+
+    def _view(self, version: int, analytics: AnalyticsState, snapshot: _Snapshot) -> SqliteResultVersion:
+        return SqliteResultVersion(self, version, analytics.payload(self._patient_name),
+                                   int(analytics.status_counts.sum()), analytics.rollup(), snapshot,
+                                   self.changelog.history)
+
+    def _checkpoint(self):
+        """
+        After a writer published: keep the WAL bounded. A pinned version holds a read mark in the log, so the
+        log can never restart. Once the previous versions are released and the log
+        is fully copied into the database, pin the current version again: the new
+        read transactions read the database file alone, and the next write restarts
+        the log.
+        """
+        _, frames, copied = self._conn().execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        if frames >= _WAL_RESTART_FRAMES and copied == frames:
+            self._repin()
+
+    def _repin(self):
+        """Pin the published version again, on fresh read transactions (the results are unchanged)."""
+        if self.current is None:
+            return
+        snapshot = _Snapshot(self._reader)
+        if snapshot.version != self.version:
+            snapshot.close()
+            self.load_snapshot()  # another process published meanwhile
+        else:
+            self.current = self._view(self.version, self.analytics, snapshot)
+
+    @staticmethod
+    def _analytics(conn: sqlite3.Connection) -> AnalyticsState:
+        """The summary aggregates as GROUP BY queries; only the grouped output is held in memory."""
+        state = AnalyticsState()
+        for status, count in conn.execute("SELECT status, COUNT(*) FROM results GROUP BY status"):
+            state.status_counts[status] = count
+        if state.sketches is not None:
+            # sketches are built from the rows themselves, streamed in batches
+            cursor = conn.execute("SELECT patient_id, status, charges_cents, invoice_cents, "
+                                  "COALESCE(credit_cents, 0) FROM results")
+            while True:
+                rows = np.array(cursor.fetchmany(_SKETCH_BATCH_ROWS), dtype=np.int64).reshape(-1, 5)
+                if not len(rows):
+                    break
+                state.sketches.add(rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3], rows[:, 4])
+        else:
+            patients = np.array(conn.execute(f"""
+                SELECT patient_id, COUNT(*),
+                       SUM(CASE WHEN status = {OVERPAID} THEN credit_cents ELSE 0 END),
+                       SUM(CASE WHEN status = {UNDERPAID} THEN -credit_cents ELSE 0 END),
+                       SUM(charges_cents)
+                FROM results GROUP BY patient_id""").fetchall(), dtype=np.int64).reshape(-1, 5)
+            state.patients.keys = patients[:, 0].copy()
+            state.patients.sums = np.ascontiguousarray(patients[:, 1:].T)
+        # the day-level rollup cube; floor division as in AnalyticsState (SQLite's truncates)
+        day = np.array(conn.execute(f"""
+            SELECT date_of_service, status,
+                   (charges_cents - ((charges_cents % {CHARGE_BIN_CENTS}) + {CHARGE_BIN_CENTS}) % {CHARGE_BIN_CENTS})
+                       / {CHARGE_BIN_CENTS} AS bin,
+                   COUNT(*), SUM(charges_cents), SUM(invoice_cents), SUM(COALESCE(credit_cents, 0))
+            FROM results GROUP BY date_of_service, status, bin""").fetchall(), dtype=np.int64).reshape(-1, 7)
+        cube = GroupedSums(4)
+        cube.keys, cube.sums = cube_keys(day[:, 0], day[:, 1], day[:, 2]), np.ascontiguousarray(day[:, 3:].T)
+        order = np.argsort(cube.keys)
+        cube.keys, cube.sums = cube.keys[order], cube.sums[:, order]
+        state.add_cube(cube)
+        return state
+
+    # --- upserts -------------------------------------------------------------------------------
+
+    @timed("upsert", kind="claims", engine="sqlite")
+    def upsert_claims(self, claims: Sequence[Claim]) -> int:
+        """Insert or replace claims by claim_id; returns how many results changed."""
+        staged = self._staged(claims, "claims")
+        conn = self._conn()
+        with _transaction(conn, "IMMEDIATE"):
+            conn.execute("DROP TABLE IF EXISTS temp.delta")
+            # a claim_id repeated in the delta: last row wins
+            conn.execute(f"CREATE TEMP TABLE delta AS SELECT * FROM {staged.table} "
+                         f"WHERE row IN (SELECT MAX(row) FROM {staged.table} GROUP BY claim_id)")
+            conn.execute("CREATE INDEX temp.delta_0 ON delta (claim_id)")
+            conn.execute("""UPDATE claims SET patient_id = d.patient_id, date_of_service = d.date_of_service,
+                                charges_cents = d.charges_cents
+                            FROM delta d WHERE claims.claim_id = d.claim_id""")
+            added = conn.execute("""
+                INSERT INTO claims (row, claim_id, patient_id, date_of_service, charges_cents)
+                SELECT (SELECT COALESCE(MAX(row), -1) FROM claims) + ROW_NUMBER() OVER (ORDER BY d.row),
+                       d.claim_id, d.patient_id, d.date_of_service, d.charges_cents
+                FROM delta d WHERE d.claim_id NOT IN (SELECT claim_id FROM claims)""").rowcount
+            conn.execute("UPDATE meta SET claims_rows = claims_rows + ?", [added])
+            conn.execute("DROP TABLE IF EXISTS temp.touched")
+            conn.execute("CREATE TEMP TABLE touched AS SELECT claim_id FROM delta")
+            conn.execute(f"DROP TABLE {staged.table}")
+            changed, delta = self._refresh_results(conn)
+        return self._publish_delta(changed, delta)
+
+    @timed("upsert", kind="invoices", engine="sqlite")
+    def upsert_invoices(self, invoices: Sequence[Invoice]) -> int:
+        """Insert or replace invoices by invoice_id; returns how many results changed."""
+        staged = self._staged(invoices, "invoices")
+        conn = self._conn()
+        with _transaction(conn, "IMMEDIATE"):
+            conn.execute("DROP TABLE IF EXISTS temp.delta")
+            # an invoice_id repeated in the delta: last row wins
+            conn.execute(f"CREATE TEMP TABLE delta AS SELECT * FROM {staged.table} "
+                         f"WHERE rowid IN (SELECT MAX(rowid) FROM {staged.table} GROUP BY invoice_id)")
+            conn.execute("DROP TABLE IF EXISTS temp.touched")
+            # claims losing a replaced invoice and claims gaining one
+            conn.execute("""CREATE TEMP TABLE touched AS
+                            SELECT claim_id FROM invoices WHERE invoice_id IN (SELECT invoice_id FROM delta)
+                            UNION SELECT claim_id FROM delta""")
+            removed = conn.execute("DELETE FROM invoices WHERE invoice_id IN (SELECT invoice_id FROM delta)").rowcount
+            added = conn.execute("INSERT INTO invoices SELECT invoice_id, claim_id, amount_cents FROM delta").rowcount
+            conn.execute("UPDATE meta SET invoices_rows = invoices_rows + ?", [added - removed])
+            conn.execute(f"DROP TABLE {staged.table}")
+            changed, delta = self._refresh_results(conn)
+        return self._publish_delta(changed, delta)
+
+    def _refresh_results(self, conn: sqlite3.Connection) -> Tuple[int, Optional[tuple]]:
+        """
+        Recompute the results of the claims in temp.touched, inside the upsert's
+        transaction. Returns how many results changed and, unless nothing was
+        reconciled yet, (version, before, after, changes) for _publish_delta().
+        """
+        if not conn.execute("SELECT published FROM meta").fetchone()[0]:
+            return 0, None  # nothing reconciled yet; the next reconcile() covers everything
+        self._sync_patients(conn)
+        conn.execute("CREATE INDEX temp.touched_0 ON touched (claim_id)")
+        conn.execute("DROP TABLE IF EXISTS temp.before")
+        conn.execute("CREATE TEMP TABLE before AS SELECT * FROM results "
+                     "WHERE claim_id IN (SELECT claim_id FROM touched)")
+        conn.execute("DELETE FROM results WHERE claim_id IN (SELECT claim_id FROM touched)")
+        conn.execute(_RECONCILE.format(
+            invoice_filter="WHERE claim_id IN (SELECT claim_id FROM touched)",
+            claim_filter="WHERE c.claim_id IN (SELECT claim_id FROM touched)",
+        ))
+        changed = conn.execute("""
+            SELECT COUNT(*) FROM results r LEFT JOIN before b ON b.row = r.row
+            WHERE r.claim_id IN (SELECT claim_id FROM touched)
+              AND (b.row IS NULL OR r.patient_id != b.patient_id OR r.date_of_service != b.date_of_service
+                   OR r.charges_cents != b.charges_cents OR r.invoice_cents != b.invoice_cents
+                   OR r.invoice_count != b.invoice_count OR r.status != b.status
+                   OR r.credit_cents IS NOT b.credit_cents)""").fetchone()[0]
+        before = self._row_state(conn, "SELECT {} FROM before")
+        after = self._row_state(conn, "SELECT {} FROM results WHERE claim_id IN (SELECT claim_id FROM touched)")
+        return changed, (self._bump_version(conn), before, after, self._changes(conn))
+
+    @staticmethod
+    def _changes(conn: sqlite3.Connection) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Touched claim ids with their fingerprints before and after (the last row of a repeated id)."""
+        def state(source: str) -> Dict[bytes, int]:
+            rows = conn.execute(f"SELECT claim_id, status, COALESCE(credit_cents, 0) FROM {source} "
+                                f"ORDER BY row").fetchall()
+            fps = fingerprints([r[1] for r in rows], [r[2] for r in rows]).tolist()
+            return dict(zip((r[0] for r in rows), fps))  # a repeated claim_id: its last row wins
+
+        before = state("before")
+        after = state("results WHERE claim_id IN (SELECT claim_id FROM touched)")
+        ids = list(after.keys() | before.keys())
+        return (np.array(ids, dtype="S") if ids else np.empty(0, dtype="S1"),
+                np.array([before.get(c, ABSENT) for c in ids], dtype=np.int64),
+                np.array([after.get(c, ABSENT) for c in ids], dtype=np.int64))
+
+    @staticmethod
+    def _row_state(conn: sqlite3.Connection, sql: str) -> np.ndarray:
+        """analytics.row_state() of the rows a query selects."""
+        columns = ("patient_id, date_of_service, charges_cents, invoice_cents, invoice_count, status, "
+                   "COALESCE(credit_cents, 0)")
+        rows = conn.execute(sql.format(columns)).fetchall()
+        return np.array(rows, dtype=np.int64).reshape(-1, len(STATE_FIELDS)).T
+
+    def _publish_delta(self, changed: int, delta: Optional[tuple]) -> int:
+        """After an upsert committed: move the touched rows' contribution in the analytics and publish."""
+        if delta is not None:
+            version, before, after, changes = delta
+            self.analytics.add_state(before, sign=-1)
+            self.analytics.add_state(after)
+            self._publish(version, self.analytics, changes)
+            self._checkpoint()
+        return changed
+
+    # --- persistence and reads -----------------------------------------------------------------
+
+    @property
+    def nbytes(self) -> int:
+        """The data stays in the database file; resident memory is SQLite's bounded page cache only."""
+        return 0
+
+    def save_snapshot(self, root: Optional[str] = None) -> Optional[Path]:
+        """Every write is already committed to the database; nothing to do."""
+        return None
+
+    def load_snapshot(self, root: Optional[str] = None) -> bool:
+        """Publish the database's newest committed version; False if it has never been reconciled."""
+        snapshot = _Snapshot(self._reader)
+        with snapshot.connection() as conn:  # the analytics and the published view read the same version
+            published = conn.execute("SELECT published FROM meta").fetchone()[0]
+            analytics = self._analytics(conn) if published else None
+        if analytics is None:
+            snapshot.close()
+            self.version = self.saved_version = snapshot.version
+            self.current = None
+            return False
+        self._publish(snapshot.version, analytics, snapshot=snapshot)
+        return True
+
+    def refresh(self) -> bool:
+        """Pick up a version another process committed; True if there was one."""
+        conn = self._conn()
+        latest = conn.execute("SELECT version FROM meta").fetchone()[0]
+        if latest == self.version:
+            synced = conn.execute("SELECT generation FROM patients_source").fetchone()
+            if self.current is not None and synced and synced[0] != self.current.patients_source:
+                self._repin()  # another process synced the patients table
+            return False
+        return self.load_snapshot()
+
+    def get_results(self, skip: int = 0, limit: int = 100) -> List[ReconciliationResult]:
+        view = self.current
+        return view.page(skip, limit) if view is not None else []
+
+    def query_results(self, query: ResultQuery, skip: int = 0, limit: int = 100,
+                      after: Optional[Tuple] = None) -> Tuple[List[ReconciliationResult], int, Optional[Tuple]]:
+        view = self.current
+        return view.query(query, skip, limit, after) if view is not None else ([], 0, None)
+
+    def get_analytics(self) -> Dict:
+        view = self.current
+        return view.summary if view is not None else {}
+
+    def _patient_name(self, patient_id: int) -> str:
+        return self.patients.name(patient_id)
@@ -0,0 +1,537 @@
+"""
+Compact in-memory record store.
+
+Claims, invoices and reconciliation results are kept as struct-of-arrays:
+claim ids are interned into a shared KeyTable (one int32 code per row),
+dates are int32 ordinals and money is int64 cents. Pydantic models are only
+built at the API boundary, when a row is indexed.
+"""
+from collections.abc import Sequence
+from datetime import date
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.models.claim import Claim
+from app.models.invoice import Invoice
+from app.models.schemas import ReconciliationResult
+
+# status codes, indexes into STATUS_LABELS
+NO_INVOICES, BALANCED, OVERPAID, UNDERPAID = 0, 1, 2, 3
+STATUS_LABELS = ("N/A", "BALANCED", "OVERPAID", "UNDERPAID")
+
+# date.toordinal() of 1970-01-01, the numpy datetime64 epoch
+EPOCH_ORDINAL = 719163
+
+
+def to_cents(amounts: np.ndarray) -> np.ndarray:
+    return np.round(np.asarray(amounts, dtype=np.float64) * 100).astype(np.int64)
+
+
+def to_ordinal(days: np.ndarray) -> np.ndarray:
+    """datetime64[D] -> int32 proleptic Gregorian ordinal (date.toordinal())."""
+    return (days.astype("datetime64[D]").astype(np.int64) + EPOCH_ORDINAL).astype(np.int32)
+
+
+def encode_ids(values: Iterable) -> np.ndarray:
+    """Strings -> fixed-width UTF-8 bytes array (numpy 'S' dtype)."""
+    values = np.asarray(values, dtype=object)
+    if len(values) == 0:
+        return np.empty(0, dtype="S1")
+    try:
+        return values.astype("S")
+    except UnicodeEncodeError:
+        return np.array([v.encode("utf-8") for v in values], dtype="S")
+
+
+def last_occurrence(codes: np.ndarray) -> np.ndarray:
+    """Positions of the last occurrence of each distinct code, in input order."""
+    _, first_from_end = np.unique(codes[::-1], return_index=True)
+    return np.sort(len(codes) - 1 - first_from_end)
+
+
+def grow_array(values: np.ndarray, size: int, fill) -> np.ndarray:
+    if len(values) >= size:
+        return values
+    return np.concatenate([values, np.full(size - len(values), fill, dtype=values.dtype)])
+
+
+def _hash(ids: np.ndarray) -> np.ndarray:
+    return pd.util.hash_array(ids.astype(object), categorize=False)
+
+
+def duplicate_ids(ids: np.ndarray) -> np.ndarray:
+    """Distinct values of a bytes id array that occur more than once, found through a hash table."""
+    if len(ids) < 2:
+        return ids[:0]
+    candidates = np.flatnonzero(pd.Series(_hash(ids)).duplicated(keep=False).to_numpy())
+    if not len(candidates):
+        return ids[:0]
+    # rows sharing a hash almost always share the id; collisions are settled on the candidates only
+    values = pd.Series(ids[candidates].astype(object))
+    return np.asarray(values[values.duplicated()].unique(), dtype=ids.dtype)
+
+
+def merge_keys(tables: List["KeyTable"]) -> Tuple["KeyTable", List[np.ndarray]]:
+    """
+    One KeyTable holding the values of several; also returns, per input table,
+    the new code of each of its old codes.
+    """
+    keys = KeyTable()
+    codes = keys.intern(np.concatenate([t.values for t in tables]))  # one intern, not one per table
+    bounds = np.cumsum([0] + [len(t) for t in tables])
+    return keys, [codes[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+
+class GroupedSums:
+    """Several int64 sums per int64 key; keys kept sorted for ordered output."""
+
+    def __init__(self, n_measures: int):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.sums = np.zeros((n_measures, 0), dtype=np.int64)
+
+    def add(self, keys: np.ndarray, measures: List[np.ndarray], sign: int = 1):
+        if not len(keys):
+            return
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        pos = np.searchsorted(self.keys, uniq)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == uniq[found]
+        missing = ~found
+        if missing.any():
+            self.keys = np.insert(self.keys, pos[missing], uniq[missing])
+            self.sums = np.insert(self.sums, pos[missing], 0, axis=1)
+            pos = np.searchsorted(self.keys, uniq)
+        for j, m in enumerate(measures):
+            # grouped integer sums; exact in float64 for any realistic total
+            self.sums[j, pos] += sign * np.bincount(inverse, weights=m, minlength=len(uniq)).astype(np.int64)
+
+    def merge(self, other: "GroupedSums"):
+        self.add(other.keys, list(other.sums))
+
+    def present(self) -> np.ndarray:
+        """Positions whose first measure (the row count) is non-zero."""
+        return np.flatnonzero(self.sums[0])
+
+
+class KeyTable:
+    """
+    Interned string ids.
+
+    Each distinct value gets a dense int32 code. Values are stored once as a
+    fixed-width bytes array; lookups go through a sorted uint64 hash index, so
+    there is no per-key Python object.
+    """
+
+    def __init__(self, values: Optional[np.ndarray] = None):
+        self.values = np.empty(0, dtype="S1")
+        self._hashes = np.empty(0, dtype=np.uint64)  # sorted
+        self._codes = np.empty(0, dtype=np.int32)    # code of each entry in _hashes
+        if values is not None and len(values):
+            self.intern(values)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __getitem__(self, code: int) -> str:
+        return self.values[code].decode("utf-8")
+
+    def copy(self) -> "KeyTable":
+        return KeyTable.from_parts(*(part.copy() for part in self.parts()))
+
+    def parts(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(values, hashes, codes): everything needed to rebuild the table without rehashing."""
+        return self.values, self._hashes, self._codes
+
+    @classmethod
+    def from_parts(cls, values: np.ndarray, hashes: np.ndarray, codes: np.ndarray) -> "KeyTable":
+        table = cls()
+        table.values, table._hashes, table._codes = values, hashes, codes
+        return table
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + self._hashes.nbytes + self._codes.nbytes
+
+    def lookup(self, ids) -> np.ndarray:
+        """Codes for `ids` (str or bytes), -1 where the id is unknown."""
+        ids = encode_ids(ids) if not isinstance(ids, np.ndarray) or ids.dtype.kind != "S" else ids
+        if not len(self.values):
+            return np.full(len(ids), -1, dtype=np.int32)
+        return self._find(ids, _hash(ids))
+
+    def _find(self, ids: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+        pos = np.searchsorted(self._hashes, hashes)
+        hit = pos < len(self._hashes)
+        hit[hit] = self._hashes[pos[hit]] == hashes[hit]
+        codes = np.full(len(ids), -1, dtype=np.int32)
+        codes[hit] = self._codes[pos[hit]]
+
+        # hash collisions: the first entry with this hash holds a different value
+        clash = np.flatnonzero(hit & (self.values[np.maximum(codes, 0)] != ids))
+        for i in clash:
+            codes[i] = -1
+            j = pos[i]
+            while j < len(self._hashes) and self._hashes[j] == hashes[i]:
+                if self.values[self._codes[j]] == ids[i]:
+                    codes[i] = self._codes[j]
+                    break
+                j += 1
+        return codes
+
+    def intern(self, ids) -> np.ndarray:
+        """Codes for `ids`, adding unseen values to the table."""
+        ids = encode_ids(ids) if not isinstance(ids, np.ndarray) or ids.dtype.kind != "S" else ids
+        hashes = _hash(ids)
+        codes = self._find(ids, hashes) if len(self.values) else np.full(len(ids), -1, dtype=np.int32)
+        missing = np.flatnonzero(codes < 0)
+        if len(missing):
+            new_values, new_hashes, local = ids[missing], hashes[missing], np.arange(len(missing))
+            order = np.argsort(new_hashes)
+            if (np.diff(new_hashes[order]) == 0).any():
+                # repeated new ids: group them by hash (a numeric factorize), or by value if two share a hash
+                local, new_hashes = pd.factorize(new_hashes)
+                first = np.ones(len(local), dtype=bool)  # factorize numbers groups by first appearance
+                first[1:] = local[1:] > np.maximum.accumulate(local)[:-1]
+                new_values = ids[missing[first]]
+                if (new_values[local] != ids[missing]).any():
+                    local, uniques = pd.factorize(ids[missing].astype(object))
+                    new_values = np.asarray(uniques, dtype=object).astype("S")
+                    new_hashes = _hash(new_values)
+                order = np.argsort(new_hashes)
+            new_codes = np.arange(len(self.values), len(self.values) + len(new_values), dtype=np.int32)
+            codes[missing] = new_codes[local]
+
+            if len(self._hashes):
+                at = np.searchsorted(self._hashes, new_hashes[order])
+                self._hashes = np.insert(self._hashes, at, new_hashes[order])
+                self._codes = np.insert(self._codes, at, new_codes[order])
+            else:
+                self._hashes, self._codes = new_hashes[order], new_codes[order]
+            self.values = np.concatenate([self.values, new_values])
+        return codes
+
+
+class ClaimStore(Sequence):
+    """Claims as parallel arrays; indexing yields a Claim model for that row."""
+
+    def __init__(self, keys: KeyTable, key: np.ndarray, patient_id: np.ndarray,
+                 date_of_service: np.ndarray, charges_cents: np.ndarray):
+        self.keys = keys                        # claim_id intern table
+        self.key = key                          # int32 code into keys
+        self.patient_id = patient_id            # int64
+        self.date_of_service = date_of_service  # int32 ordinal
+        self.charges_cents = charges_cents      # int64
+        self.report = None                      # IngestReport when built by csv_loader
+
+    @classmethod
+    def from_columns(cls, claim_id, patient_id, date_of_service, charges_amount,
+                     keys: Optional[KeyTable] = None) -> "ClaimStore":
+        keys = keys if keys is not None else KeyTable()
+        return cls(
+            keys=keys,
+            key=keys.intern(claim_id),
+            patient_id=np.asarray(patient_id, dtype=np.int64),
+            date_of_service=to_ordinal(np.asarray(date_of_service, dtype="datetime64[D]")),
+            charges_cents=to_cents(charges_amount),
+        )
+
+    @classmethod
+    def from_models(cls, claims: List[Claim]) -> "ClaimStore":
+        return cls.from_columns(
+            [c.claim_id for c in claims],
+            [c.patient_id for c in claims],
+            np.array([c.date_of_service for c in claims], dtype="datetime64[D]"),
+            [c.charges_amount for c in claims],
+        )
+
+    @classmethod
+    def empty(cls) -> "ClaimStore":
+        return cls(KeyTable(), np.empty(0, np.int32), np.empty(0, np.int64),
+                   np.empty(0, np.int32), np.empty(0, np.int64))
+
+    @classmethod
+    def concat(cls, parts: List["ClaimStore"]) -> "ClaimStore":
+        """Merge stores that share one KeyTable."""
+        if not parts:
+            return cls.empty()
+        return cls(
+            keys=parts[0].keys,
+            key=np.concatenate([p.key for p in parts]),
+            patient_id=np.concatenate([p.patient_id for p in parts]),
+            date_of_service=np.concatenate([p.date_of_service for p in parts]),
+            charges_cents=np.concatenate([p.charges_cents for p in parts]),
+        )
+
+    @classmethod
+    def merge(cls, parts: List["ClaimStore"]) -> "ClaimStore":
+        """Merge stores that each have their own KeyTable (e.g. parsed in parallel)."""
+        if len(parts) < 2:
+            return cls.concat(parts)
+        keys, remaps = merge_keys([p.keys for p in parts])
+        return cls.concat([cls(keys, remap[p.key], p.patient_id, p.date_of_service, p.charges_cents)
+                           for p, remap in zip(parts, remaps)])
+
+    def duplicate_ids(self) -> np.ndarray:
+        """claim_ids held by more than one row; the key table already is their hash index."""
+        return self.keys.values[np.flatnonzero(np.bincount(self.key, minlength=len(self.keys)) > 1)]
+
+    @property
+    def nbytes(self) -> int:
+        return (self.keys.nbytes + self.key.nbytes + self.patient_id.nbytes
+                + self.date_of_service.nbytes + self.charges_cents.nbytes)
+
+    def __len__(self) -> int:
+        return len(self.key)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return Claim(
+            claim_id=self.keys[self.key[i]],
+            patient_id=int(self.patient_id[i]),
+            date_of_service=date.fromordinal(int(self.date_of_service[i])),
+            charges_amount=int(self.charges_cents[i]) / 100,
+        )
+
+
+class InvoiceStore(Sequence):
+    """Invoices as parallel arrays; indexing yields an Invoice model for that row."""
+
+    def __init__(self, invoice_id: np.ndarray, keys: KeyTable, key: np.ndarray, amount_cents: np.ndarray):
+        self.invoice_id = invoice_id      # fixed-width bytes
+        self.keys = keys                  # claim_id intern table
+        self.key = key                    # int32 code of the invoice's claim_id
+        self.amount_cents = amount_cents  # int64
+        self.report = None
+
+    @classmethod
+    def from_columns(cls, invoice_id, claim_id, transaction_value,
+                     keys: Optional[KeyTable] = None) -> "InvoiceStore":
+        keys = keys if keys is not None else KeyTable()
+        return cls(
+            invoice_id=encode_ids(invoice_id),
+            keys=keys,
+            key=keys.intern(claim_id),
+            amount_cents=to_cents(transaction_value),
+        )
+
+    @classmethod
+    def from_models(cls, invoices: List[Invoice]) -> "InvoiceStore":
+        return cls.from_columns(
+            [i.invoice_id for i in invoices],
+            [i.claim_id for i in invoices],
+            [i.transaction_value for i in invoices],
+        )
+
+    @classmethod
+    def empty(cls) -> "InvoiceStore":
+        return cls(np.empty(0, dtype="S1"), KeyTable(), np.empty(0, np.int32), np.empty(0, np.int64))
+
+    @classmethod
+    def concat(cls, parts: List["InvoiceStore"]) -> "InvoiceStore":
+        """Merge stores that share one KeyTable."""
+        if not parts:
+            return cls.empty()
+        return cls(
+            invoice_id=np.concatenate([p.invoice_id for p in parts]),
+            keys=parts[0].keys,
+            key=np.concatenate([p.key for p in parts]),
+            amount_cents=np.concatenate([p.amount_cents for p in parts]),
+        )
+
+    @classmethod
+    def merge(cls, parts: List["InvoiceStore"]) -> "InvoiceStore":
+        """Merge stores that each have their own KeyTable (e.g. parsed in parallel)."""
+        if len(parts) < 2:
+            return cls.concat(parts)
+        keys, remaps = merge_keys([p.keys for p in parts])
+        return cls.concat([cls(p.invoice_id, keys, remap[p.key], p.amount_cents) for p, remap in zip(parts, remaps)])
+
+    def duplicate_ids(self) -> np.ndarray:
+        """invoice_ids held by more than one row."""
+        return duplicate_ids(self.invoice_id)
+
+    def rekey(self, keys: KeyTable) -> "InvoiceStore":
+        """Point this store's claim codes at `keys`, interning only ids still referenced."""
+        if keys is self.keys:
+            return self
+        used = np.flatnonzero(np.bincount(self.key, minlength=len(self.keys)))
+        remap = np.full(len(self.keys), -1, dtype=np.int32)
+        remap[used] = keys.intern(self.keys.values[used])
+        store = InvoiceStore(self.invoice_id, keys, remap[self.key], self.amount_cents)
+        store.report = self.report
+        return store
+
+    @property
+    def nbytes(self) -> int:
+        return self.invoice_id.nbytes + self.keys.nbytes + self.key.nbytes + self.amount_cents.nbytes
+
+    def __len__(self) -> int:
+        return len(self.key)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return Invoice(
+            invoice_id=self.invoice_id[i].decode("utf-8"),
+            claim_id=self.keys[self.key[i]],
+            transaction_value=int(self.amount_cents[i]) / 100,
+        )
+
+
+class ResultRow(NamedTuple):
+    """Plain tuple with the same fields as ReconciliationResult, used for internal scans."""
+    claim_id: str
+    patient_id: str
+    patient_name: str
+    date_of_service: date
+    charges_amount: float
+    invoice_total: Optional[float]
+    status: str
+    credit: Optional[float]
+
+
+class ResultStore(Sequence):
+    """
+    Reconciliation results, one row per claim, held as parallel arrays.
+
+    Behaves like a read-only list of ReconciliationResult; a Pydantic model is
+    only built for the positions that are actually indexed or sliced.
+    """
+
+    def __init__(self, claims: ClaimStore, invoice_cents: np.ndarray, invoice_count: np.ndarray,
+                 status: np.ndarray, credit_cents: np.ndarray, patient_name: Callable[[int], str]):
+        self.claims = claims
+        self.invoice_cents = invoice_cents  # int64, 0 where invoice_count is 0
+        self.invoice_count = invoice_count  # int32
+        self.status = status                # int8 status codes
+        self.credit_cents = credit_cents    # int64, 0 where invoice_count is 0
+        self.patient_name = patient_name    # resolved per returned row, never stored
+
+    @property
+    def nbytes(self) -> int:
+        return (self.invoice_cents.nbytes + self.invoice_count.nbytes
+                + self.status.nbytes + self.credit_cents.nbytes)
+
+    def __len__(self) -> int:
+        return len(self.status)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._model(i) for i in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("result index out of range")
+        return self._model(key)
+
+    def _row(self, i: int) -> ResultRow:
+        claims = self.claims
+        pid = int(claims.patient_id[i])
+        matched = self.invoice_count[i] > 0
+        return ResultRow(
+            claim_id=claims.keys[claims.key[i]],
+            patient_id=str(pid),
+            patient_name=self.patient_name(pid),
+            date_of_service=date.fromordinal(int(claims.date_of_service[i])),
+            charges_amount=int(claims.charges_cents[i]) / 100,
+            invoice_total=int(self.invoice_cents[i]) / 100 if matched else None,
+            status=STATUS_LABELS[self.status[i]],
+            credit=int(self.credit_cents[i]) / 100 if matched else None,
+        )
+
+    def _model(self, i: int) -> ReconciliationResult:
+        return ReconciliationResult(**self._row(i)._asdict())
+
+    def resize(self, n: int):
+        """Grow to n rows; new rows are filled by the caller."""
+        self.invoice_cents = grow_array(self.invoice_cents, n, 0)
+        self.invoice_count = grow_array(self.invoice_count, n, 0)
+        self.status = grow_array(self.status, n, NO_INVOICES)
+        self.credit_cents = grow_array(self.credit_cents, n, 0)
+
+    def rows(self) -> Iterator[ResultRow]:
+        for i in range(len(self)):
+            yield self._row(i)
+
+
+def classify(credit_cents: np.ndarray, invoice_count: np.ndarray) -> np.ndarray:
+    """Status code per row from the credit and the number of matched invoices."""
+    return np.select(
+        [invoice_count == 0, credit_cents == 0, credit_cents > 0],
+        [NO_INVOICES, BALANCED, OVERPAID],
+        default=UNDERPAID,
+    ).astype(np.int8)
+
+
+class InvoiceIndex:
+    """
+    Persistent claim -> invoice index, aggregated per interned claim code:
+    the invoice total (cents) and invoice count of every claim id.
+    """
+
+    def __init__(self, totals: np.ndarray, counts: np.ndarray):
+        self.totals = totals  # int64 cents per claim code
+        self.counts = counts  # int32 invoices per claim code
+
+    @classmethod
+    def build(cls, invoices: InvoiceStore, n_keys: int) -> "InvoiceIndex":
+        # cents sums are exact in float64 well beyond any realistic per-claim total
+        totals = np.bincount(invoices.key, weights=invoices.amount_cents, minlength=n_keys)
+        counts = np.bincount(invoices.key, minlength=n_keys)
+        return cls(totals.astype(np.int64), counts.astype(np.int32))
+
+    @property
+    def nbytes(self) -> int:
+        return self.totals.nbytes + self.counts.nbytes
+
+    def grow(self, n_keys: int):
+        self.totals = grow_array(self.totals, n_keys, 0)
+        self.counts = grow_array(self.counts, n_keys, 0)
+
+    def add(self, keys: np.ndarray, cents: np.ndarray, sign: int = 1):
+        np.add.at(self.totals, keys, sign * cents)
+        np.add.at(self.counts, keys, sign)
+
+
+class RowIndex:
+    """Maps interned key codes to the row(s) that hold them."""
+
+    def __init__(self, keys: np.ndarray, n_keys: int):
+        self.row = np.full(n_keys, -1, dtype=np.int64)
+        self.row[keys] = np.arange(len(keys))
+        # keys held by more than one row are rare; keep their rows on the side
+        self.duplicates: Dict[int, np.ndarray] = {}
+        dup = np.flatnonzero(np.bincount(keys, minlength=n_keys) > 1)
+        if len(dup):
+            rows = np.flatnonzero(np.isin(keys, dup))
+            order = np.argsort(keys[rows], kind="stable")
+            rows = rows[order]
+            split = np.flatnonzero(np.diff(keys[rows])) + 1
+            for group in np.split(rows, split):
+                self.duplicates[int(keys[group[0]])] = group
+
+    @property
+    def nbytes(self) -> int:
+        return self.row.nbytes + sum(rows.nbytes for rows in self.duplicates.values())
+
+    def grow(self, n_keys: int):
+        self.row = grow_array(self.row, n_keys, -1)
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """Last row holding each key, -1 where none does."""
+        return self.row[keys]
+
+    def rows_for(self, keys: np.ndarray) -> np.ndarray:
+        """Every row holding any of `keys`."""
+        rows = self.row[keys]
+        rows = rows[rows >= 0]
+        extra = [self.duplicates[k] for k in keys.tolist() if k in self.duplicates] if self.duplicates else []
+        if extra:
+            rows = np.unique(np.concatenate([rows, *extra]))
+        return rows
+
+    def add(self, keys: np.ndarray, rows: np.ndarray):
+        self.row[keys] = rows
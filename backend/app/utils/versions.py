@@ -0,0 +1,118 @@
+"""
+Published, immutable reconcile results.
+
+The writer (an upload job) builds a ResultVersion once a reconcile or upsert
+is complete (results, their query index, the rendered summary and a frozen
+rollup of the aggregates) and publishes it by replacing one attribute on the service. A reader takes that
+reference once and serves the whole request from it, so it never sees a
+half-built state, never locks and never computes anything beyond its own
+query. A version is freed as soon as the last request holding it finishes.
+
+Each version also holds its orphan invoices (invoices whose claim_id matches
+no claim) and the changelog History it was published with, which diffs are
+served from. After a full reconcile the writer finds the orphans by an
+anti-join before publishing; an upsert hands over the set it kept up to date.
+
+Patient names are the one thing read from outside the version: they come
+from the current patient directory, so a replaced directory shows up in the
+next response without a new version. The job that replaces the directory
+re-renders the default summary of the current versions (render_summary).
+"""
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from app.models.schemas import ReconciliationResult, ResultQuery
+from app.utils.analytics import Rollup
+from app.utils.changelog import History
+from app.utils.export import column_rows, json_record
+from app.utils.patients import Patients
+from app.utils.query import ResultIndex
+from app.utils.store import InvoiceStore, ResultStore
+
+
+class ResultVersion:
+    __slots__ = ("version", "results", "index", "_summary", "rollup", "orphans", "history", "patients",
+                 "patient_name", "published_at")
+
+    def __init__(self, version: int, results: ResultStore, patients: Patients, summary: Dict,
+                 index: Optional[ResultIndex] = None, rollup: Optional[Rollup] = None,
+                 orphans: Optional["Orphans"] = None, history: Optional[History] = None):
+        self.version = version
+        self.results = results  # never written to after publication (the writer copies first)
+        self.index = index if index is not None else ResultIndex(results, patients)
+        self._summary = (patients.generation, summary)
+        self.rollup = rollup  # aggregates for summaries other than the default one
+        self.orphans = orphans if orphans is not None else Orphans(InvoiceStore.empty(), np.empty(0, np.int64))
+        self.history = history if history is not None else History()
+        self.patients = patients
+        self.patient_name = patients.name
+        self.published_at = time.time()  # Last-Modified of every read served from this version
+
+    @property
+    def summary(self) -> Dict:
+        return self._summary[1]
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def page(self, skip: int = 0, limit: int = 100) -> List[ReconciliationResult]:
+        return self.results[skip: skip + limit]
+
+    def query(self, query: ResultQuery, skip: int = 0, limit: int = 100,
+              after: Optional[Tuple[int, int]] = None) -> Tuple[List[ReconciliationResult], int, Optional[Tuple]]:
+        """
+        One page of filtered, sorted results, the total number of matches and
+        the cursor of the page's last row (None when nothing follows it).
+        """
+        rows, total, last = self._page(query, skip, limit, after)
+        return [self.results[int(i)] for i in rows], total, last
+
+    def records(self, query: ResultQuery, skip: int = 0, limit: int = 100,
+                after: Optional[Tuple[int, int]] = None) -> Tuple[List[Dict], int, Optional[Tuple]]:
+        """query(), with each result as its JSON object built straight from the columns (no models)."""
+        rows, total, last = self._page(query, skip, limit, after)
+        return [json_record(r) for r in column_rows(self.results, rows, self.patient_name)], total, last
+
+    def _page(self, query: ResultQuery, skip: int, limit: int, after: Optional[Tuple[int, int]]):
+        rows, total = self.index.query(query, skip, limit + 1, after)  # one extra row tells if a next page exists
+        last = self.index.cursor(query, int(rows[limit - 1])) if len(rows) > limit else None
+        return rows[:limit], total, last
+
+    def orphan_invoices(self, skip: int = 0, limit: int = 100) -> Tuple[List[Dict], int, int]:
+        """A page of orphan invoices as JSON objects, their number and their total in cents."""
+        orphans = self.orphans.store
+        page = orphans[skip: skip + limit]
+        return [i.model_dump() for i in page], len(orphans), int(orphans.amount_cents.sum())
+
+    def iter_rows(self, query: ResultQuery, batch_size: int) -> Iterator[Iterator[tuple]]:
+        """Matching results in order as export row tuples (see export.column_rows), a batch at a time."""
+        for rows in self.index.iter_batches(query, batch_size):
+            yield column_rows(self.results, rows, self.patient_name)
+
+
+class Orphans:
+    """Invoices whose claim_id no claim holds, as of one version; copied out of the writer's columns."""
+
+    def __init__(self, invoices: InvoiceStore, rows: np.ndarray):
+        self.rows = rows  # invoice rows of the orphans in the writer's columns, ascending
+        self.store = InvoiceStore(invoices.invoice_id[rows], invoices.keys, invoices.key[rows],
+                                  invoices.amount_cents[rows])
+
+    @classmethod
+    def find(cls, claim_key: np.ndarray, invoices: InvoiceStore) -> "Orphans":
+        """The anti-join: invoices whose claim code is on no claim row."""
+        held = np.zeros(len(invoices.keys), dtype=bool)
+        held[claim_key] = True
+        return cls(invoices, np.flatnonzero(~held[invoices.key]))
+
+
+def render_summary(view):
+    """
+    Re-render a version's default summary if the patient directory was
+    replaced since; called by the writer, so reads never render it.
+    """
+    generation = view.patients.generation
+    if view._summary[0] != generation and view.rollup is not None:
+        view._summary = (generation, view.rollup.summary(view.patient_name))
@@ -0,0 +1,102 @@
+"""
+Memory report: bytes per row of the per-row Pydantic representation versus
+the compact record store, on the dataset produced by app/data/generate_data.py.
+
+    cd backend && python -m benchmarks.memory_report [--seed 42] [--claims 110000]
+"""
+import argparse
+import csv
+import gc
+import tempfile
+import tracemalloc
+from collections import defaultdict
+from pathlib import Path
+from types import SimpleNamespace
+
+from app.data import generate_data
+from app.models.claim import Claim
+from app.models.invoice import Invoice
+from app.models.schemas import ReconciliationResult
+from app.utils.csv_loader import load_claims, load_invoices
+from app.utils.patients import PatientDirectory, Patients
+from app.utils.reconciliation import ReconciliationService
+
+
+def _measure(build):
+    gc.collect()
+    tracemalloc.start()
+    kept = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return kept, size
+
+
+def _pydantic_models(claims_csv: Path, invoices_csv: Path):
+    """The previous representation: one model per claim, invoice and result."""
+    with open(claims_csv, newline="") as f:
+        claims = [Claim(claim_id=r["claim_id"], patient_id=int(r["patient_id"]),
+                        date_of_service=r["date_of_service"], charges_amount=float(r["charges_amount"]))
+                  for r in csv.DictReader(f)]
+    with open(invoices_csv, newline="") as f:
+        invoices = [Invoice(invoice_id=r["invoice_id"], claim_id=r["claim_id"],
+                            transaction_value=float(r["transaction_value"]))
+                    for r in csv.DictReader(f)]
+    return claims, invoices
+
+
+def _pydantic_results(claims, invoices):
+    inv_map = defaultdict(list)
+    for inv in invoices:
+        inv_map[inv.claim_id].append(inv)
+    results = []
+    for c in claims:
+        related = inv_map.get(c.claim_id, [])
+        total = sum(i.transaction_value for i in related) if related else None
+        credit = total - c.charges_amount if related else None
+        results.append(ReconciliationResult(
+            claim_id=c.claim_id, patient_id=str(c.patient_id), patient_name=f"Patient {c.patient_id}",
+            date_of_service=c.date_of_service, charges_amount=c.charges_amount,
+            invoice_total=total, status="N/A", credit=credit,
+        ))
+    del inv_map
+    return results
+
+
+def _compact_store(claims_csv: Path, invoices_csv: Path):
+    svc = ReconciliationService()
+    with open(claims_csv, "rb") as f:
+        svc.load_claims(load_claims(SimpleNamespace(file=f)))
+    with open(invoices_csv, "rb") as f:
+        svc.load_invoices(load_invoices(SimpleNamespace(file=f)))
+    svc.patients = Patients(None, PatientDirectory.empty())  # the patient directory is not part of the per-row cost
+    return svc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--claims", type=int, default=110_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        written = generate_data.generate(Path(tmp), args.claims, seed=args.seed, balance_ratio=0.25)
+        claims_csv, invoices_csv = Path(tmp) / "claims.csv", Path(tmp) / "invoices.csv"
+        n_claims, n_invoices = written["claims"], written["invoices"]
+
+        (claims, invoices), models_bytes = _measure(lambda: _pydantic_models(claims_csv, invoices_csv))
+        _, results_bytes = _measure(lambda: _pydantic_results(claims, invoices))
+        del claims, invoices
+
+        svc, store_bytes = _measure(lambda: _compact_store(claims_csv, invoices_csv))
+        _, compact_results_bytes = _measure(svc.reconcile)
+
+    rows = n_claims + n_invoices
+    print(f"dataset: {n_claims} claims, {n_invoices} invoices (seed {args.seed})")
+    print(f"{'':28}{'pydantic':>12}{'compact':>12}")
+    print(f"{'claims+invoices bytes/row':28}{models_bytes / rows:12.1f}{store_bytes / rows:12.1f}")
+    print(f"{'results bytes/claim':28}{results_bytes / n_claims:12.1f}{compact_results_bytes / n_claims:12.1f}")
+
+
+if __name__ == "__main__":
+    main()
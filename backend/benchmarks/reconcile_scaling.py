@@ -0,0 +1,75 @@
+"""
+Scaling benchmark: full reconcile (results, invoice index and analytics) at
+1/2/4/8 worker processes on a synthetic dataset.
+
+    cd backend && python -m benchmarks.reconcile_scaling [--claims 2000000] [--workers 1 2 4 8]
+
+Worker count 1 is the in-process columnar path; the others go through the
+sharded process pool. Each timing is the best of --repeat runs after one
+warm-up, so pool start-up is not counted.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from app.utils import reconciliation
+from app.utils.store import ClaimStore, InvoiceStore
+
+
+def _dataset(n_claims: int, invoices_per_claim: float, seed: int):
+    rng = np.random.default_rng(seed)
+    claim_ids = np.char.add("c", np.arange(n_claims).astype(str)).astype(object)
+    claims = ClaimStore.from_columns(
+        claim_ids,
+        rng.integers(1, 10_000, n_claims),
+        np.datetime64("2023-01-01") + rng.integers(0, 365, n_claims),
+        rng.integers(1_000, 500_000, n_claims) / 100,
+    )
+    n_invoices = int(n_claims * invoices_per_claim)
+    invoices = InvoiceStore.from_columns(
+        np.char.add("i", np.arange(n_invoices).astype(str)).astype(object),
+        claim_ids[rng.integers(0, n_claims, n_invoices)],
+        rng.integers(-50_000, 500_000, n_invoices) / 100,
+    ).rekey(claims.keys)
+    return claims, invoices
+
+
+def _time(svc: reconciliation.ReconciliationService, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        svc.load_claims(svc.claims)  # drop cached indexes so every run is a full reconcile
+        start = time.perf_counter()
+        svc.reconcile()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--claims", type=int, default=2_000_000)
+    parser.add_argument("--invoices-per-claim", type=float, default=2.5)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    claims, invoices = _dataset(args.claims, args.invoices_per_claim, args.seed)
+    reconciliation.RECONCILE_SHARD_MIN_ROWS = 0
+    print(f"dataset: {len(claims)} claims, {len(invoices)} invoices; {os.cpu_count()} CPUs")
+    print(f"{'workers':>8}{'seconds':>10}{'speedup':>9}")
+
+    baseline = None
+    for workers in args.workers:
+        svc = reconciliation.ReconciliationService(workers=workers)
+        svc.load_claims(claims)
+        svc.load_invoices(invoices)
+        svc.reconcile()  # warm-up: starts the pool, touches every page once
+        seconds = _time(svc, args.repeat)
+        baseline = baseline or seconds
+        print(f"{workers:>8}{seconds:>10.3f}{baseline / seconds:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+Benchmark suite: ingest, reconcile, analytics, reads and the HTTP read routes
+on seeded synthetic data at several scales, checked against a JSON baseline.
+
+    cd backend && python -m benchmarks.suite [--scales 10k 1m 10m] [--skew 1.0]
+                  [--concurrency 1 8 32] [--baseline benchmarks/baseline.json] [--threshold 0.25]
+
+For each scale it writes claims/invoices CSVs (same seed, same bytes), then
+times read + load of both files, reconcile, get_analytics and get_results
+on the service, and /api/reconciliation, /api/summary and
+/api/reconciliation/export through an in-process ASGI client at each
+concurrency level. It records seconds and rows/s, p50/p99 latency with
+throughput, and the process's peak RSS. Scales run smallest first, so each
+peak RSS belongs to its own scale.
+
+The run is written to --output. When --baseline exists, durations,
+latencies and peak RSS are compared with it (values too small to time
+reliably are skipped) and the run exits 1 if one is worse by more than
+--threshold (0.25 = 25%). A missing baseline is created from the run, and
+--update-baseline replaces it.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import httpx
+import numpy as np
+import pandas as pd
+from fastapi import UploadFile
+
+from app.main import app
+from app.models.schemas import ResultQuery
+from app.routes import upload
+from app.utils.datasets import DatasetRegistry
+
+DATASET = "bench"
+CHUNK_CLAIMS = 1_000_000
+# metrics checked against the baseline, with the size below which a difference is noise;
+# throughputs are derived from these and not checked separately
+COMPARED = {"seconds": 0.05, "p50_ms": 0.5, "p99_ms": 1.0, "peak_rss_mb": 50.0}
+
+# request mixes per route: cycled through, so hot first pages, filters and deep pages all count
+ROUTES = {
+    "reconciliation": ("/api/reconciliation", [
+        {}, {"sort": "-credit"}, {"status": "UNDERPAID", "sort": "charges_amount"},
+        {"skip": 5000, "limit": 100}, {"patient_name": "pat", "sort": "-date_of_service"},
+        {"min_credit": -50, "max_credit": 50, "limit": 500},
+    ]),
+    "summary": ("/api/summary", [
+        {}, {"granularity": "month"}, {"granularity": "week", "status": ["OVERPAID", "UNDERPAID"]},
+        {"date_from": "2023-03-01", "date_to": "2023-06-30"},
+    ]),
+    "export": ("/api/reconciliation/export", [
+        {"patient_id": 7}, {"patient_id": 11, "format": "ndjson"}, {"patient_id": 13, "status": "OVERPAID"},
+    ]),
+}
+
+
+def parse_scale(text: str) -> int:
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(text[-1].lower(), 1)
+    return int(float(text[:-1] if multiplier > 1 else text) * multiplier)
+
+
+def write_dataset(root: Path, n_claims: int, invoices_per_claim: float, skew: float, seed: int):
+    """
+    Claims and invoices CSVs, generated and written one chunk of claims at a time.
+    Invoice counts per claim are Poisson around invoices_per_claim, scaled by a
+    lognormal(0, skew) weight per claim: skew 0 is even, larger skews pile invoices
+    onto fewer claims. A quarter of the claims are settled by one exact invoice.
+    """
+    claims_csv, invoices_csv = root / "claims.csv", root / "invoices.csv"
+    n_patients = max(2_000, n_claims // 50)
+    n_invoices = 0
+    for chunk, start in enumerate(range(0, n_claims, CHUNK_CLAIMS)):
+        rng = np.random.default_rng([seed, chunk])  # per chunk, so a chunk's rows never depend on the chunk size
+        ids = np.arange(start, min(start + CHUNK_CLAIMS, n_claims))
+        n = len(ids)
+        charges = rng.integers(100, 500_000, n)  # cents
+        claims = pd.DataFrame({
+            "claim_id": np.char.add("c", ids.astype(str)),
+            "patient_id": rng.integers(1, n_patients + 1, n),
+            "date_of_service": np.datetime64("2023-01-01") + rng.integers(0, 365, n),
+            "charges_amount": charges / 100,
+        })
+        claims.to_csv(claims_csv, mode="a", header=chunk == 0, index=False, float_format="%.2f")
+
+        weights = rng.lognormal(0, skew, n) if skew > 0 else np.ones(n)
+        counts = rng.poisson(invoices_per_claim * weights / weights.mean())
+        exact = rng.random(n) < 0.25
+        counts[exact] = 1
+        owner = np.repeat(np.arange(n), counts)
+        amounts = rng.integers(-50_000, 500_000, len(owner))
+        first = np.r_[0, np.cumsum(counts)[:-1]][exact]
+        amounts[first] = charges[exact]
+        invoices = pd.DataFrame({
+            "invoice_id": np.char.add("i", np.arange(n_invoices, n_invoices + len(owner)).astype(str)),
+            "claim_id": claims["claim_id"].to_numpy()[owner],
+            "transaction_value": amounts / 100,
+        })
+        invoices.to_csv(invoices_csv, mode="a", header=chunk == 0, index=False, float_format="%.2f")
+        n_invoices += len(owner)
+    return claims_csv, invoices_csv, n_invoices
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KiB on Linux
+
+
+def latency_stats(latencies: List[float], wall: float) -> Dict:
+    ms = np.asarray(latencies) * 1000
+    return {"p50_ms": float(np.percentile(ms, 50)), "p99_ms": float(np.percentile(ms, 99)),
+            "ops_per_s": len(ms) / wall if wall else 0.0}
+
+
+def repeat_call(fn, n: int) -> Dict:
+    latencies = []
+    start = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - t)
+    return latency_stats(latencies, time.perf_counter() - start)
+
+
+async def http_load(app, path: str, params: List[Dict], concurrency: int, requests: int) -> Dict:
+    """`requests` GETs cycling through `params`, `concurrency` at a time."""
+    latencies = []
+    pending = iter(range(requests))
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def worker():
+            for i in pending:  # shared iterator: each request is taken by exactly one worker
+                t = time.perf_counter()
+                response = await client.get(path, params={"dataset": DATASET, **params[i % len(params)]})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - t)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return latency_stats(latencies, time.perf_counter() - start)
+
+
+def run_scale(n_claims: int, args, root: Path) -> Dict:
+    metrics: Dict[str, Dict] = {}
+    claims_csv, invoices_csv, n_invoices = write_dataset(root, n_claims, args.invoices_per_claim, args.skew, args.seed)
+    upload.datasets = DatasetRegistry(root=str(root / "datasets"), backend=args.backend)
+    service = upload.datasets.get(DATASET, create=True)
+
+    for name, path, read, load, rows in (
+        ("ingest.claims", claims_csv, service.read_claims, service.load_claims, n_claims),
+        ("ingest.invoices", invoices_csv, service.read_invoices, service.load_invoices, n_invoices),
+    ):
+        start = time.perf_counter()
+        with open(path, "rb") as f:
+            load(read(UploadFile(f, filename=path.name)))
+        seconds = time.perf_counter() - start
+        metrics[name] = {"seconds": seconds, "rows_per_s": rows / seconds}
+
+    start = time.perf_counter()
+    service.reconcile()
+    seconds = time.perf_counter() - start
+    metrics["reconcile"] = {"seconds": seconds, "rows_per_s": n_claims / seconds}
+
+    metrics["get_analytics"] = repeat_call(lambda i: service.get_analytics(), args.calls)
+    offsets = np.random.default_rng(args.seed).integers(0, max(n_claims - 100, 1), args.calls)
+    metrics["get_results"] = repeat_call(lambda i: service.get_results(skip=int(offsets[i]), limit=100), args.calls)
+    metrics["query_results"] = repeat_call(
+        lambda i: service.query_results(ResultQuery(sort="-credit"), skip=int(offsets[i]) % 10_000, limit=100),
+        args.calls)
+
+    for route, (path, params) in ROUTES.items():
+        for concurrency in args.concurrency:
+            metrics[f"http.{route}.c{concurrency}"] = asyncio.run(
+                http_load(app, path, params, concurrency, args.requests))
+
+    metrics["memory"] = {"peak_rss_mb": peak_rss_mb()}
+    metrics["dataset"] = {"claims": n_claims, "invoices": n_invoices}
+    return metrics
+
+
+def regressions(current: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """Human-readable list of metrics worse than the baseline by more than `threshold`."""
+    found = []
+    for scale, groups in current.items():
+        for group, values in groups.items():
+            if group == "dataset":
+                continue
+            for metric, value in values.items():
+                base = baseline.get(scale, {}).get(group, {}).get(metric)
+                if metric not in COMPARED or not base or max(base, value) < COMPARED[metric]:
+                    continue
+                change = value / base - 1
+                if change > threshold:
+                    found.append(f"{scale} {group}.{metric}: {base:.4g} -> {value:.4g} ({change:+.0%} worse)")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", nargs="+", default=["10k", "1m"], help="claim counts, e.g. 10k 1m 10m")
+    parser.add_argument("--invoices-per-claim", type=float, default=2.5)
+    parser.add_argument("--skew", type=float, default=1.0, help="invoices-per-claim skew (0 = even)")
+    parser.add_argument("--backend", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="HTTP requests per route and concurrency level")
+    parser.add_argument("--calls", type=int, default=200, help="service calls per read benchmark")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmarks/results.json")
+    parser.add_argument("--baseline", default="benchmarks/baseline.json")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown before failing (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    results = {}
+    for scale in sorted(args.scales, key=parse_scale):
+        with tempfile.TemporaryDirectory() as tmp:
+            results[scale] = run_scale(parse_scale(scale), args, Path(tmp))
+        for group, values in results[scale].items():
+            print(f"{scale:>5} {group:<26}" + "  ".join(f"{k}={v:.4g}" for k, v in values.items()))
+
+    run = {"created_at": time.time(), "python": platform.python_version(), "cpus": os.cpu_count(),
+           "args": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "update_baseline")},
+           "results": results}
+    Path(args.output).write_text(json.dumps(run, indent=2))
+
+    baseline_path = Path(args.baseline)
+    if args.update_baseline or not baseline_path.exists():
+        baseline_path.write_text(json.dumps(run, indent=2))
+        print(f"baseline written to {baseline_path}")
+        return
+    found = regressions(results, json.loads(baseline_path.read_text())["results"], args.threshold)
+    for line in found:
+        print(f"REGRESSION {line}")
+    if found:
+        sys.exit(1)
+    print(f"no regressions beyond {args.threshold:.0%} against {baseline_path}")
+
+
+if __name__ == "__main__":
+    main()
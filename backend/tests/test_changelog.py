@@ -0,0 +1,155 @@
+import random
+from datetime import date
+
+import pytest
+
+from app.models.claim import Claim
+from app.models.invoice import Invoice
+from app.models.schemas import ResultQuery
+from app.utils import changelog
+from app.utils.reconciliation import ReconciliationService
+from app.utils.sqlite_backend import SqliteReconciliationService
+from app.utils.versions import Orphans
+from tests.test_reconciliation import _random_dataset
+
+
+def _states(svc):
+    """claim_id -> (status, credit) of the published version, last row of a repeated id."""
+    return {r.claim_id: (r.status, r.credit) for r in svc.query_results(ResultQuery(), 0, 10 ** 6)[0]}
+
+
+def _naive(old, new):
+    changed = {}
+    for claim_id in old.keys() | new.keys():
+        if old.get(claim_id) != new.get(claim_id):
+            changed[claim_id] = (old.get(claim_id), new.get(claim_id))
+    return changed
+
+
+def _diffed(svc, old, new):
+    as_tuple = lambda s: (s["status"], s["credit"]) if s else None
+    diff = svc.changelog.diff(old, new)
+    return {r["claim_id"]: (as_tuple(r["before"]), as_tuple(r["after"])) for r in diff.records(0, len(diff))}
+
+
+def _random_delta(rng, step):
+    claims = [Claim(claim_id=f"c{rng.randrange(300)}" if rng.random() < 0.7 else f"new{step}-{i}",
+                    patient_id=rng.randint(1, 40), date_of_service=date(2023, 2, 1 + i),
+                    charges_amount=rng.choice([100.0, 20.0, 0.3]))
+               for i in range(rng.randint(1, 6))]
+    invoices = [Invoice(invoice_id=f"i{rng.randrange(600)}" if rng.random() < 0.5 else f"inv{step}-{i}",
+                        claim_id=f"c{rng.randrange(300)}", transaction_value=rng.choice([100.0, 20.0, 5.0]))
+                for i in range(rng.randint(1, 8))]
+    return claims, invoices
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_diff_matches_comparing_full_results(tmp_path, backend):
+    rng = random.Random(11)
+    svc = ReconciliationService() if backend == "memory" else SqliteReconciliationService(str(tmp_path))
+    svc.changelog.keep = 100
+    claims, invoices = _random_dataset(n_claims=300, seed=3)
+    svc.load_claims(claims)
+    svc.load_invoices(invoices)
+    svc.reconcile()
+    states = {svc.version: _states(svc)}
+    # the anti-join finds the invoice whose claim does not exist
+    orphans, total, cents = svc.current.orphan_invoices()
+    assert orphans == [{"invoice_id": "orphan", "claim_id": "missing", "transaction_value": 10.0}]
+    assert total == 1 and cents == 1000
+    for step in range(6):
+        delta_claims, delta_invoices = _random_delta(rng, step)
+        svc.upsert_claims(delta_claims)
+        states[svc.version] = _states(svc)
+        svc.upsert_invoices(delta_invoices)
+        states[svc.version] = _states(svc)
+        if backend == "memory" and step == 3:
+            # a full replace in the middle: diffs across it compare fingerprint tables
+            svc.load_invoices(invoices[: len(invoices) // 2])
+            svc.reconcile()
+            states[svc.version] = _states(svc)
+
+    versions = sorted(states)
+    for old in versions:
+        for new in versions:
+            if old <= new:
+                assert _diffed(svc, old, new) == _naive(states[old], states[new]), (old, new)
+
+
+def test_diff_history_is_bounded():
+    svc = ReconciliationService()
+    svc.changelog.keep = 2
+    claims, invoices = _random_dataset(n_claims=20)
+    svc.load_claims(claims)
+    svc.load_invoices(invoices)
+    svc.reconcile()
+    first = svc.version
+    for value in (1.0, 2.0):
+        svc.upsert_invoices([Invoice(invoice_id="late", claim_id="c1", transaction_value=value)])
+    with pytest.raises(KeyError, match=f"Version {first} is not retained"):
+        svc.changelog.diff(first, svc.version)
+    with pytest.raises(ValueError):
+        svc.changelog.diff(svc.version, svc.version - 1)
+    assert list(_diffed(svc, svc.version - 1, svc.version)) == ["c1"]
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_a_pinned_version_diffs_from_its_own_history(tmp_path, backend):
+    svc = ReconciliationService() if backend == "memory" else SqliteReconciliationService(str(tmp_path))
+    svc.changelog.keep = 2
+    claims, invoices = _random_dataset(n_claims=20)
+    svc.load_claims(claims)
+    svc.load_invoices(invoices)
+    svc.reconcile()
+    svc.upsert_invoices([Invoice(invoice_id="late", claim_id="c1", transaction_value=1.0)])
+    pinned = svc.current
+    for value in (2.0, 3.0):  # the writer moves on and drops the pinned version's base
+        svc.upsert_invoices([Invoice(invoice_id="late", claim_id="c1", transaction_value=value)])
+    with pytest.raises(KeyError):
+        svc.changelog.diff(pinned.version - 1, pinned.version)
+    assert [r["claim_id"] for r in pinned.history.diff(pinned.version - 1, pinned.version).records()] == ["c1"]
+    with pytest.raises(KeyError):
+        pinned.history.diff(pinned.version, svc.version)  # versions after it are not its to know
+
+
+def test_the_writer_builds_fingerprint_tables_and_orphans_before_publishing(monkeypatch, tmp_path):
+    rng = random.Random(5)
+    svc = ReconciliationService(snapshot_dir=str(tmp_path))
+    claims, invoices = _random_dataset(n_claims=200, seed=5)
+    svc.load_claims(claims)
+    svc.load_invoices(invoices)
+    svc.reconcile()
+    svc.save_snapshot()
+
+    built, found = [], []
+    full_table, find = changelog.full_table, Orphans.find
+    monkeypatch.setattr("app.utils.reconciliation.full_table",
+                        lambda version, *a: built.append(version) or full_table(version, *a))
+    monkeypatch.setattr(Orphans, "find", classmethod(lambda cls, *a: found.append(a) or find(*a)))
+    loaded = ReconciliationService(snapshot_dir=str(tmp_path))
+    loaded.changelog.keep = 100
+    loaded.load_snapshot()
+    first = loaded.version
+    assert built == [first] and len(found) == 1  # both built before the version is published
+    assert isinstance(loaded.current.history.entries[-1], changelog._Table)
+    assert loaded.current.orphan_invoices(0, 0)[1] == 1
+
+    # upserts keep the orphans up to date from the keys they touch, including claims that adopt them
+    all_claims = {c.claim_id for c in claims}
+    all_invoices = {i.invoice_id: i for i in invoices}
+    for step in range(8):
+        delta_claims, delta_invoices = _random_delta(rng, step)
+        delta_invoices.append(Invoice(invoice_id=f"wait{step}", claim_id=f"later{step}", transaction_value=1.0))
+        delta_claims.append(Claim(claim_id=f"later{step - 1}", patient_id=1, date_of_service=date(2023, 3, 1),
+                                  charges_amount=1.0))
+        loaded.upsert_invoices(delta_invoices)
+        loaded.upsert_claims(delta_claims)
+        all_invoices.update({i.invoice_id: i for i in delta_invoices})
+        all_claims |= {c.claim_id for c in delta_claims}
+        expected = sorted(i.invoice_id for i in all_invoices.values() if i.claim_id not in all_claims)
+        orphans, total, _ = loaded.current.orphan_invoices(0, 10 ** 6)
+        assert sorted(o["invoice_id"] for o in orphans) == expected and total == len(expected)
+    upserted = _diffed(loaded, first, loaded.version)
+    assert upserted and built == [first] and len(found) == 1  # upserts kept the orphans; reads built nothing
+    loaded.reconcile()
+    assert _diffed(loaded, first, loaded.version) == upserted and built == [first, loaded.version]
@@ -27,3 +27,82 @@ def test_load_claims_missing_column():
     upload = make_upload_file(csv_text)
     with pytest.raises(Exception):
         load_claims(upload)
+
+def test_load_claims_streams_in_chunks_and_rejects_bad_rows():
+    csv_text = (
+        "claim_id,patient_id,date_of_service,charges_amount\n"
+        "c1,1,2023-01-01,100\n"
+        "c2,x,2023-01-02,200\n"
+        "c3,3,not-a-date,300\n"
+        "c4,4,2023-01-04,400.5\n"
+        ",5,2023-01-05,500\n"
+    )
+    with pytest.raises(ValueError, match="3 invalid claims rows: line 3: invalid patient_id 'x'"):
+        load_claims(make_upload_file(csv_text), chunk_rows=2)
+
+    claims = load_claims(make_upload_file(csv_text), chunk_rows=2, on_error="skip")
+    assert [c.claim_id for c in claims] == ["c1", "c4"]
+    assert claims[1].charges_amount == 400.5
+    assert claims.report.rows_loaded == 2
+    assert claims.report.rows_rejected == 3
+    assert claims.report.errors == [
+        "line 3: invalid patient_id 'x'",
+        "line 4: invalid date_of_service 'not-a-date'",
+        "line 6: invalid claim_id ''",
+    ]
+
+def test_infinite_amounts_are_rejected_and_large_patient_ids_stay_exact():
+    csv_text = (
+        "claim_id,patient_id,date_of_service,charges_amount\n"
+        "c1,9007199254740993,2023-01-01,100\n"
+        "c2,2,2023-01-02,inf\n"
+        "c3,2.5,2023-01-03,300\n"
+        "c4,4,2023-01-04,1e300\n"
+    )
+    claims = load_claims(make_upload_file(csv_text), on_error="skip")
+    assert [c.claim_id for c in claims] == ["c1"]
+    assert claims.patient_id.tolist() == [9007199254740993]  # 2**53 + 1: float64 would round it
+    assert claims.report.errors == [
+        "line 4: invalid patient_id '2.5'",
+        "line 3: invalid charges_amount 'inf'",
+        "line 5: invalid charges_amount '1e300'",
+    ]
+
+    invoices = load_invoices(make_upload_file("invoice_id,claim_id,transaction_value\ni1,c1,-inf\ni2,c1,5\n"),
+                             on_error="skip")
+    assert [i.invoice_id for i in invoices] == ["i2"]
+    assert invoices.report.errors == ["line 2: invalid transaction_value '-inf'"]
+
+def test_load_invoices_all_rows_invalid():
+    csv_text = "invoice_id,claim_id,transaction_value\ni1,c1,abc\n"
+    with pytest.raises(ValueError):
+        load_invoices(make_upload_file(csv_text))
+
+def test_several_compressed_files_are_merged_with_duplicates_reported():
+    import gzip
+    header = "claim_id,patient_id,date_of_service,charges_amount\n"
+    parts = [
+        make_upload_file(header + "c1,1,2023-01-01,100\nc2,2,2023-01-02,200\n", "part1.csv"),
+        UploadFile(filename="part2.csv.gz", file=io.BytesIO(
+            gzip.compress((header + "c3,3,2023-01-03,300\nc2,2,2023-01-02,200\nc4,x,2023-01-04,1\n").encode()))),
+    ]
+    seen = []
+    claims = load_claims(parts, progress=lambda r: seen.append(r.rows_loaded), on_error="skip")
+    assert [c.claim_id for c in claims] == ["c1", "c2", "c3", "c2"]
+    assert len(claims.keys) == 3 and claims[3].patient_id == 2
+    assert claims.report.rows_loaded == 4 and seen[-1] == 4
+    assert claims.report.errors == ["part2.csv.gz line 4: invalid patient_id 'x'"]
+    assert claims.report.duplicates == 1 and claims.report.duplicate_ids == ["c2"]
+
+    invoices = load_invoices(make_upload_file("invoice_id,claim_id,transaction_value\ni1,c1,1\ni1,c2,2\ni2,c1,3\n"))
+    assert invoices.report.duplicate_ids == ["i1"]
+
+    broken = UploadFile(filename="bad.csv.gz", file=io.BytesIO(gzip.compress(header.encode() + b"c9,9,2023-01-01,1\n")[:-8]))
+    with pytest.raises(ValueError, match="bad.csv.gz"):
+        load_claims([make_upload_file(header + "c1,1,2023-01-01,1\n"), broken])
+
+def test_zstd_upload():
+    zstandard = pytest.importorskip("zstandard")
+    csv_text = b"invoice_id,claim_id,transaction_value\ni1,c1,100\n"
+    invoices = load_invoices(UploadFile(filename="i.csv.zst", file=io.BytesIO(zstandard.ZstdCompressor().compress(csv_text))))
+    assert invoices[0].invoice_id == "i1"
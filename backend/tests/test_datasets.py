@@ -0,0 +1,114 @@
+import pytest
+
+from app.models.invoice import Invoice
+from app.utils.datasets import DatasetRegistry
+from tests.test_reconciliation import _random_dataset
+
+
+def _fill(registry, name, seed):
+    claims, invoices = _random_dataset(n_claims=200, seed=seed)
+    service = registry.pin(name)
+    service.load_claims(claims)
+    service.load_invoices(invoices)
+    service.reconcile()
+    registry.unpin(name)
+    return service
+
+
+def test_cold_datasets_spill_to_disk_and_reload(tmp_path):
+    registry = DatasetRegistry(root=str(tmp_path), budget_bytes=1)
+    first = _fill(registry, "march", seed=1)
+    expected = [r.model_dump() for r in first.results_cache[:]]
+    _fill(registry, "april", seed=2)
+    registry.drain()
+
+    # over budget: the least recently used dataset was written out and dropped
+    stats = {d["name"]: d for d in registry.stats()}
+    assert not stats["march"]["resident"] and stats["april"]["resident"]
+    assert stats["april"]["resident_bytes"] > 0
+
+    reloaded = registry.get("march")
+    assert reloaded is not first
+    assert [r.model_dump() for r in reloaded.results_cache[:]] == expected
+    registry.drain()
+    assert not {d["name"]: d for d in registry.stats()}["april"]["resident"]
+
+    with pytest.raises(KeyError):
+        registry.get("may")
+
+
+def test_pinned_datasets_are_not_spilled(tmp_path):
+    registry = DatasetRegistry(root=str(tmp_path), budget_bytes=1)
+    _fill(registry, "a", seed=1)
+    registry.pin("a")
+    _fill(registry, "b", seed=2)
+    assert {d["name"] for d in registry.stats() if d["resident"]} == {"a", "b"}
+    registry.unpin("a")
+    registry.drain()
+    assert [d["name"] for d in registry.stats() if d["resident"]] == ["b"]
+
+
+def test_shared_registries_see_each_others_writes(tmp_path):
+    # two registries over one directory stand in for two API worker processes
+    a = DatasetRegistry(root=str(tmp_path), shared=True)
+    b = DatasetRegistry(root=str(tmp_path), shared=True)
+    claims, invoices = _random_dataset(n_claims=100, seed=8)
+
+    with a.writer("shared") as service:
+        service.load_claims(claims[:-1])
+        service.load_invoices(invoices)
+        service.reconcile()
+        service.save_snapshot()
+    seen = b.get("shared")
+    assert seen.current.version == a.get("shared").current.version
+    assert seen.get_analytics() == a.get("shared").get_analytics()
+
+    # b writes next: it first catches up with a's snapshot, then a picks up b's change
+    with b.writer("shared") as service:
+        service.upsert_invoices([Invoice(invoice_id="late", claim_id="c1", transaction_value=2.0)])
+        service.save_snapshot()
+    before = a.get("shared").current
+    assert before.version < b.get("shared").current.version  # reads never refresh; a keeps serving its version
+    a.refresh()  # what a's watcher thread does every SHARED_REFRESH_SECONDS
+    refreshed = a.get("shared")
+    assert refreshed.current.version == b.get("shared").current.version
+    assert [r.model_dump() for r in refreshed.current.results[:]] == [r.model_dump() for r in b.get("shared").current.results[:]]
+
+
+def test_a_failed_spill_keeps_the_dataset_resident(tmp_path, monkeypatch):
+    registry = DatasetRegistry(root=str(tmp_path), budget_bytes=1)
+    first = _fill(registry, "march", seed=1)
+
+    def fail(root=None):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(first, "save_snapshot", fail)
+    _fill(registry, "april", seed=2)
+    registry.drain()
+    assert registry.get("march") is first  # not dropped, and the request never saw the error
+    assert not (tmp_path / "march").exists()
+
+
+def test_the_watcher_refreshes_shared_datasets_in_the_background(tmp_path):
+    import time
+    a = DatasetRegistry(root=str(tmp_path), shared=True)
+    b = DatasetRegistry(root=str(tmp_path), shared=True)
+    claims, invoices = _random_dataset(n_claims=50, seed=9)
+    with a.writer("shared") as service:
+        service.load_claims(claims[:-1])
+        service.load_invoices(invoices)
+        service.reconcile()
+        service.save_snapshot()
+    assert b.get("shared").current.version == a.get("shared").current.version
+
+    b.start_watcher(interval=0.01)
+    try:
+        with a.writer("shared") as service:
+            service.upsert_invoices([Invoice(invoice_id="late", claim_id="c1", transaction_value=2.0)])
+            service.save_snapshot()
+        deadline = time.time() + 5
+        while b.get("shared").current.version != a.get("shared").current.version and time.time() < deadline:
+            time.sleep(0.01)
+        assert b.get("shared").current.version == a.get("shared").current.version
+    finally:
+        b.stop_watcher()
@@ -0,0 +1,46 @@
+import csv
+import gzip
+from datetime import date
+
+import numpy as np
+
+from app.data import generate_data
+
+
+def test_vectorized_fields_format_like_python():
+    values = np.array([0, 7, -3, 10, -500, 5000, 123456789])
+    data, ends = generate_data.csv_lines([generate_data.digits(values, 10),
+                                          generate_data.iso_dates(np.datetime64("2023-01-01") + np.arange(7) * 59)])
+    lines = data.decode().splitlines()
+    assert lines == [f"{v},{np.datetime64('2023-01-01') + i * 59}" for i, v in enumerate(values.tolist())]
+    assert ends[-1] == len(data)
+
+
+def test_generate_streams_split_gzip_files(tmp_path):
+    written = generate_data.generate(tmp_path, 2_500, seed=3, orphan_rate=0.1, batch_size=1_000,
+                                     rows_per_file=1_000, compress=True, date_from=date(2023, 1, 1),
+                                     date_to=date(2023, 3, 31))
+    assert [p.name for p in written["files"][:4]] == \
+        ["patients.csv", "claims-00000.csv.gz", "claims-00001.csv.gz", "claims-00002.csv.gz"]
+
+    def rows(stem):
+        out = []
+        for path in sorted(tmp_path.glob(f"{stem}-*.csv.gz")):
+            with gzip.open(path, "rt", newline="") as f:
+                out += list(csv.DictReader(f))
+        return out
+
+    claims, invoices = rows("claims"), rows("invoices")
+    assert (len(claims), len(invoices)) == (written["claims"], written["invoices"]) and len(claims) == 2_500
+    with open(tmp_path / "patients.csv", newline="") as f:
+        patients = {r["patient_id"] for r in csv.DictReader(f)}
+    assert {c["patient_id"] for c in claims} <= patients
+    assert all("2023-01-01" <= c["date_of_service"] <= "2023-03-31" for c in claims)
+    claim_ids = {c["claim_id"] for c in claims}
+    orphans = sum(i["claim_id"] not in claim_ids for i in invoices)
+    assert 0.05 < orphans / len(invoices) < 0.15
+
+    again = generate_data.generate(tmp_path / "again", 2_500, seed=3, orphan_rate=0.1, batch_size=1_000,
+                                   date_from=date(2023, 1, 1), date_to=date(2023, 3, 31))
+    with open(again["files"][1], newline="") as f:
+        assert [r["claim_id"] for r in csv.DictReader(f)] == [c["claim_id"] for c in claims]
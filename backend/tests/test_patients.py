@@ -0,0 +1,57 @@
+import io
+import random
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.utils.patients import PatientDirectory, Patients
+
+
+def _names(n, seed=3):
+    rng = random.Random(seed)
+    first = ["Mark", "mary", "MARTA", "Émile", "émilie", "Zoë", "Ana", "Ann", "Li", ""]
+    last = ["Mcdowell", "Major", "Fernandez", "Ørsted", "Straße", "Long" * 10]
+    return [f"{rng.choice(first)} {rng.choice(last)}".strip() for _ in range(n)]
+
+
+def test_lookups_match_a_dict():
+    ids = np.random.default_rng(1).permutation(5000)[:3000] * 7
+    names = _names(len(ids))
+    d = PatientDirectory.from_names(ids, names)
+    expected = dict(zip(ids.tolist(), names))
+
+    assert len(d) == len(expected)
+    assert all(d.name(pid) == name for pid, name in expected.items())
+    assert d.name(-1) == "Patient -1"
+    probe = np.array([0, 1, 7, 35000, -7])
+    assert d.known(probe).tolist() == [pid in expected for pid in probe.tolist()]
+
+    for prefix in ["", "m", "MA", "mar", "émi", "ÉMILE", "zoë ", "straße", "x", "ann", "ana "]:
+        want = sorted(pid for pid, name in expected.items() if name.casefold().startswith(prefix.casefold()))
+        assert d.matching(prefix).tolist() == want, prefix
+
+
+def test_last_row_of_an_id_wins_and_csv_rejects_bad_ids():
+    assert PatientDirectory.from_names([2, 1, 2], ["Old", "One", "New"]).name(2) == "New"
+
+    csv = b"patient_id,name\n1,Mark Mcdowell\nx,Nobody\n2.5,Half\n3,Mary Major\n1,Mark Renamed\n"
+    d = PatientDirectory.from_csv(SimpleNamespace(file=io.BytesIO(csv)), chunk_rows=2)
+    assert d.ids.tolist() == [1, 3]
+    assert d.name(1) == "Mark Renamed"
+    assert d.report.rows_loaded == 3 and d.report.rows_rejected == 2
+
+
+def test_replace_saves_a_memory_mapped_generation(tmp_path):
+    holder = Patients(str(tmp_path), PatientDirectory.empty())
+    first = holder.replace(PatientDirectory.from_names([1], ["Mark Mcdowell"]))
+    assert isinstance(first.blob, np.memmap)
+    second = holder.replace(PatientDirectory.from_names([1], ["Mary Major"]))
+    assert holder.name(1) == "Mary Major" and holder.generation != first.generation
+    assert [p.name for p in tmp_path.iterdir()] == [second.generation]
+
+    # another process sees the newest saved generation
+    other = Patients(str(tmp_path))
+    assert other.name(1) == "Mary Major"
+    holder.replace(PatientDirectory.from_names([1], ["William Fernandez"]))
+    assert other.refresh() and other.name(1) == "William Fernandez"
+    assert not other.refresh()
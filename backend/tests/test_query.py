@@ -0,0 +1,175 @@
+import random
+from datetime import date
+
+import pytest
+
+from app.models.claim import Claim
+from app.models.invoice import Invoice
+from app.models.schemas import ResultQuery
+from app.utils.patients import PatientDirectory, Patients
+from app.utils.query import ResultIndex, decode_cursor, encode_cursor, validate_query
+from app.utils.reconciliation import ReconciliationService
+
+
+@pytest.fixture(scope="module")
+def service():
+    rng = random.Random(5)
+    claims = [
+        Claim(claim_id=f"c{i}", patient_id=rng.randint(1, 30), date_of_service=date(2023, rng.randint(1, 12), rng.randint(1, 28)),
+              charges_amount=rng.randint(1, 50) * 10)
+        for i in range(400)
+    ]
+    invoices = [
+        Invoice(invoice_id=f"i{i}", claim_id=f"c{rng.randrange(450)}", transaction_value=rng.randint(0, 60) * 10)
+        for i in range(600)
+    ]
+    svc = ReconciliationService()
+    svc.patients = Patients(None, PatientDirectory.from_names([1, 2, 3], ["Mark Mcdowell", "Mary Major", "William Fernandez"]))
+    svc.load_claims(claims)
+    svc.load_invoices(invoices)
+    svc.reconcile()
+    return svc
+
+
+def _naive(rows, q: ResultQuery):
+    out = [
+        (i, r) for i, r in enumerate(rows)
+        if (not q.status or r.status in q.status)
+        and (q.patient_id is None or r.patient_id == str(q.patient_id))
+        and (not q.patient_name or r.patient_name.casefold().startswith(q.patient_name.casefold()))
+        and (q.date_from is None or r.date_of_service >= q.date_from)
+        and (q.date_to is None or r.date_of_service <= q.date_to)
+        and (q.min_charges is None or r.charges_amount >= q.min_charges)
+        and (q.max_charges is None or r.charges_amount <= q.max_charges)
+        and (q.min_credit is None or (r.credit is not None and r.credit >= q.min_credit))
+        and (q.max_credit is None or (r.credit is not None and r.credit <= q.max_credit))
+    ]
+    if q.sort:
+        field = q.sort.lstrip("-")
+        with_value = [(i, r) for i, r in out if getattr(r, field) is not None]
+        without = [(i, r) for i, r in out if getattr(r, field) is None]
+        with_value.sort(key=lambda x: (getattr(x[1], field), x[0]))
+        if q.sort.startswith("-"):
+            with_value.reverse()
+        out = with_value + without
+    return [i for i, _ in out]
+
+
+@pytest.mark.parametrize("params", [
+    {},
+    {"sort": "credit"},
+    {"sort": "-credit"},
+    {"sort": "-date_of_service"},
+    {"status": ["UNDERPAID"]},
+    {"status": ["UNDERPAID", "N/A"], "sort": "charges_amount"},
+    {"patient_id": 3, "sort": "-credit"},
+    {"patient_name": "ma"},
+    {"patient_name": "MAR", "status": ["OVERPAID"]},
+    {"date_from": date(2023, 7, 1), "date_to": date(2023, 9, 30), "status": ["UNDERPAID"], "sort": "credit"},
+    {"min_charges": 100, "max_charges": 200, "sort": "-charges_amount"},
+    {"min_credit": -50, "max_credit": 50},
+    {"patient_id": 999},
+])
+def test_index_query_matches_naive_filter(service, params):
+    q = ResultQuery(**params)
+    expected = _naive(service.results_cache[:], q)
+    index = ResultIndex(service.results_cache, service.patients)
+
+    rows, total = index.query(q, skip=0, limit=10_000)
+    assert rows.tolist() == expected
+    assert total == len(expected)
+
+    page, _ = index.query(q, skip=3, limit=5)
+    assert page.tolist() == expected[3:8]
+
+
+def test_validate_query_rejects_unknown_values():
+    with pytest.raises(ValueError):
+        validate_query(ResultQuery(status=["PAID"]))
+    with pytest.raises(ValueError):
+        validate_query(ResultQuery(sort="-patient_name"))
+
+
+@pytest.mark.parametrize("params", [
+    {},
+    {"sort": "-credit"},
+    {"sort": "credit"},
+    {"sort": "charges_amount"},
+    {"status": ["UNDERPAID", "OVERPAID"], "sort": "-date_of_service"},
+    {"status": ["BALANCED", "UNDERPAID", "OVERPAID"], "sort": "-credit"},
+    {"status": ["OVERPAID"]},
+])
+def test_keyset_pages_match_offset_pages(service, params):
+    q = ResultQuery(**params)
+    index = ResultIndex(service.results_cache, service.patients)
+    expected, _ = index.query(q, skip=0, limit=10_000)
+
+    seen, after = [], None
+    while True:
+        page, _ = index.query(q, limit=37, after=after)
+        seen.extend(page.tolist())
+        if len(page) < 37:
+            break
+        after = index.cursor(q, int(page[-1]))
+    assert seen == expected.tolist()
+    assert [r for batch in index.iter_batches(q, 50) for r in batch.tolist()] == expected.tolist()
+
+
+def test_cursor_round_trip_is_bound_to_query():
+    q = ResultQuery(status=["BALANCED"], sort="credit")
+    cursor = encode_cursor(7, q, (1250, 42))
+    assert decode_cursor(cursor, q) == (7, (1250, 42))
+    assert decode_cursor(encode_cursor(7, q, (None, 42)), q) == (7, (None, 42))
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, ResultQuery(status=["OVERPAID"], sort="credit"))
+    with pytest.raises(ValueError):
+        decode_cursor("not-a-cursor", q)
+
+
+def test_next_cursor_is_none_when_the_last_page_is_exactly_full(service):
+    view = service.current
+    q = ResultQuery(sort="-charges_amount")
+    n, limit = len(view), len(view) // 2
+    page, _, last = view.records(q, limit=limit)
+    assert last is not None
+    page, _, last = view.records(q, limit=n - limit, after=last)
+    assert len(page) == n - limit and last is None
+
+
+def test_upserts_patch_the_index_like_a_rebuild():
+    import numpy as np
+
+    def assert_matches_rebuild(index):
+        rebuilt = ResultIndex(index.results, index.patients).parts()
+        parts = index.parts()
+        assert parts.keys() == rebuilt.keys()
+        for name, array in rebuilt.items():
+            assert np.array_equal(parts[name], array), name
+
+    rng = random.Random(9)
+    svc = ReconciliationService()
+    svc.load_claims([
+        Claim(claim_id=f"c{i}", patient_id=rng.randint(1, 20), date_of_service=date(2023, 1, rng.randint(1, 28)),
+              charges_amount=rng.randint(1, 20) * 10)
+        for i in range(300)
+    ])
+    svc.load_invoices([
+        Invoice(invoice_id=f"i{i}", claim_id=f"c{rng.randrange(320)}", transaction_value=rng.randint(0, 20) * 10)
+        for i in range(500)
+    ])
+    svc.reconcile()
+    pinned = svc.current
+    for step in range(6):
+        svc.upsert_claims([
+            Claim(claim_id=f"c{rng.randrange(340)}", patient_id=rng.randint(1, 25),
+                  date_of_service=date(2023, 2, rng.randint(1, 28)), charges_amount=rng.randint(1, 20) * 10)
+            for _ in range(15)
+        ])
+        assert_matches_rebuild(svc.current.index)
+        svc.upsert_invoices([
+            Invoice(invoice_id=f"i{rng.randrange(560)}", claim_id=f"c{rng.randrange(340)}",
+                    transaction_value=rng.randint(0, 20) * 10)
+            for _ in range(25)
+        ])
+        assert_matches_rebuild(svc.current.index)
+    assert_matches_rebuild(pinned.index)  # the writer's in-place edits never reached the pinned version
@@ -1,22 +1,29 @@
+import pytest
 from app.utils.reconciliation import ReconciliationService
 from app.models.claim import Claim
 from app.models.invoice import Invoice
 from datetime import date
 import csv
-from pathlib import Path
+from types import SimpleNamespace
+from app.utils.patients import PatientDirectory, Patients
 
-# Ensure patients.csv exists with patient 1 as "Mark Mcdowell"
-patient_csv_path = Path("./data/patients.csv")
-patient_csv_path.parent.mkdir(parents=True, exist_ok=True)  # create folder if missing
-if not patient_csv_path.exists():
-    with open(patient_csv_path, "w", newline="", encoding="utf-8") as f:
+
+@pytest.fixture
+def patient_csv(tmp_path):
+    """A patients.csv with patient 1 as "Mark Mcdowell", written under tmp_path."""
+    path = tmp_path / "patients.csv"
+    with open(path, "w", newline="", encoding="utf-8") as f:
         writer = csv.writer(f)
         writer.writerow(["patient_id", "name"])
         writer.writerow(["1", "Mark Mcdowell"])
         writer.writerow(["2", "William Fernandez"])
+    return path
+
 
-def test_reconcile_balanced():
+def test_reconcile_balanced(patient_csv):
     svc = ReconciliationService()
+    with open(patient_csv, "rb") as f:
+        svc.patients = Patients(None, PatientDirectory.from_csv(SimpleNamespace(file=f)))
 
     # Load claims and invoices
     claims = [
@@ -53,4 +60,303 @@ def test_reconcile_balanced():
     assert result.charges_amount == 100.0
 
     # Check credit (should be 0 for balanced)
-    assert result.credit == 0
\ No newline at end of file
+    assert result.credit == 0
+
+def _random_dataset(n_claims=500, seed=7):
+    import random
+    rng = random.Random(seed)
+    claims = [
+        Claim(
+            claim_id=f"c{i}",
+            patient_id=rng.randint(1, 40),
+            date_of_service=date(2023, 1, 1 + i % 28),
+            charges_amount=rng.choice([100.0, 0.1, 0.3, rng.uniform(0, 5000)]),
+        )
+        for i in range(n_claims)
+    ]
+    invoices = []
+    for c in claims:
+        for _ in range(rng.randint(0, 4)):
+            invoices.append(Invoice(
+                invoice_id=f"i{len(invoices)}",
+                claim_id=c.claim_id,
+                transaction_value=rng.choice([c.charges_amount, 0.1, 0.2, rng.uniform(-500, 5000)]),
+            ))
+    # an invoice without a claim, and a duplicated claim id
+    invoices.append(Invoice(invoice_id="orphan", claim_id="missing", transaction_value=10.0))
+    claims.append(claims[0].model_copy())
+    return claims, invoices
+
+
+def _float_reconcile(claims, invoices):
+    """The original per-claim float loop: (invoice_total, status, credit) per claim."""
+    from collections import defaultdict
+    inv_map = defaultdict(list)
+    for inv in invoices:
+        inv_map[inv.claim_id].append(inv.transaction_value)
+    rows = []
+    for c in claims:
+        related = inv_map.get(c.claim_id, [])
+        if not related:
+            rows.append((None, "N/A", None))
+            continue
+        credit = sum(related) - c.charges_amount
+        status = "BALANCED" if credit == 0 else "OVERPAID" if credit > 0 else "UNDERPAID"
+        rows.append((sum(related), status, credit))
+    return rows
+
+
+def test_engines_match_the_original_float_loop():
+    claims, invoices = _random_dataset()
+    expected = _float_reconcile(claims, invoices)
+    per_claim = {}
+    for inv in invoices:
+        per_claim[inv.claim_id] = per_claim.get(inv.claim_id, 0) + 1
+
+    for engine in ("python", "columnar"):
+        svc = ReconciliationService(engine=engine)
+        svc.load_claims(claims)
+        svc.load_invoices(invoices)
+        actual = svc.reconcile()[:]
+        assert len(actual) == len(expected)
+        for c, r, (total, status, credit) in zip(claims, actual, expected):
+            if total is None:
+                assert (r.invoice_total, r.status, r.credit) == (None, "N/A", None)
+                continue
+            # amounts are kept in cents: each rounded amount is off by at most half a cent
+            slack = 0.005 * (per_claim[c.claim_id] + 1) + 1e-9
+            assert r.invoice_total == pytest.approx(total, abs=slack)
+            assert r.credit == pytest.approx(credit, abs=slack)
+            # the status only differs where the float credit is rounding noise around zero
+            assert r.status == status or abs(credit) <= slack
+
+
+def test_cent_amounts_that_add_up_are_balanced():
+    # the float loop saw 0.1 + 0.2 - 0.3 == 5.55e-17 and called this claim OVERPAID
+    claims = [Claim(claim_id="c1", patient_id="1", date_of_service="2023-01-01", charges_amount=0.3)]
+    invoices = [Invoice(invoice_id="i1", claim_id="c1", transaction_value=0.1),
+                Invoice(invoice_id="i2", claim_id="c1", transaction_value=0.2)]
+    assert _float_reconcile(claims, invoices)[0][1] == "OVERPAID"
+
+    for engine in ("python", "columnar"):
+        svc = ReconciliationService(engine=engine)
+        svc.load_claims(claims)
+        svc.load_invoices(invoices)
+        result = svc.reconcile()[0]
+        assert (result.status, result.invoice_total, result.credit) == ("BALANCED", 0.3, 0)
+
+
+def test_top_patients_are_grouped_by_patient_id(tmp_path):
+    # two patients sharing a name are listed apart; grouping by name used to merge them
+    path = tmp_path / "patients.csv"
+    path.write_text("patient_id,name\n1,Alex Smith\n2,Alex Smith\n3,Jo Park\n")
+    svc = ReconciliationService()
+    with open(path, "rb") as f:
+        svc.patients = Patients(None, PatientDirectory.from_csv(SimpleNamespace(file=f)))
+    claims = [Claim(claim_id=f"c{i}", patient_id=pid, date_of_service="2023-01-01", charges_amount=10.0)
+              for i, pid in enumerate([1, 1, 2, 2, 3, 3, 3])]
+    svc.load_claims(claims)
+    svc.load_invoices([])
+    svc.reconcile()
+
+    assert svc.get_analytics()["top_patients_volume"][:3] == [
+        {"name": "Jo Park", "count": 3}, {"name": "Alex Smith", "count": 2}, {"name": "Alex Smith", "count": 2},
+    ]
+
+
+def test_columnar_engine_matches_python_engine():
+    claims, invoices = _random_dataset()
+
+    expected_svc = ReconciliationService(engine="python")
+    expected_svc.load_claims(claims)
+    expected_svc.load_invoices(invoices)
+    expected = expected_svc.reconcile()
+
+    svc = ReconciliationService(engine="columnar")
+    svc.load_claims(claims)
+    svc.load_invoices(invoices)
+    actual = svc.reconcile()
+
+    assert len(actual) == len(expected)
+    assert [r.model_dump() for r in actual[:]] == [r.model_dump() for r in expected]
+    assert {r.status for r in expected} == {"BALANCED", "OVERPAID", "UNDERPAID", "N/A"}
+    assert svc.get_analytics() == expected_svc.get_analytics()
+    assert svc.get_results(skip=10, limit=5) == expected_svc.get_results(skip=10, limit=5)
+
+
+def test_sharded_reconcile_matches_single_process(monkeypatch):
+    monkeypatch.setattr("app.utils.reconciliation.RECONCILE_SHARD_MIN_ROWS", 0)
+    claims, invoices = _random_dataset(seed=11)
+
+    expected_svc = ReconciliationService()
+    expected_svc.load_claims(claims)
+    expected_svc.load_invoices(invoices)
+    expected = expected_svc.reconcile()
+
+    svc = ReconciliationService(workers=3)
+    svc.load_claims(claims)
+    svc.load_invoices(invoices)
+    actual = svc.reconcile()
+
+    assert [r.model_dump() for r in actual[:]] == [r.model_dump() for r in expected[:]]
+    assert svc.get_analytics() == expected_svc.get_analytics()
+    # the index the shards built keeps incremental upserts working
+    delta = [Invoice(invoice_id="late", claim_id="c3", transaction_value=1.0)]
+    assert svc.upsert_invoices(delta) == expected_svc.upsert_invoices(delta) == 1
+    assert [r.model_dump() for r in svc.results_cache[:]] == [r.model_dump() for r in expected_svc.results_cache[:]]
+
+
+def test_upserts_recompute_only_touched_claims_and_match_full_reconcile():
+    claims, invoices = _random_dataset(n_claims=200, seed=3)
+    claims = claims[:-1]  # unique claim ids
+    svc = ReconciliationService()
+    svc.load_claims(claims)
+    svc.load_invoices(invoices)
+    svc.reconcile()
+
+    claim_delta = [
+        Claim(claim_id="c5", patient_id=9, date_of_service="2023-02-01", charges_amount=1.0),
+        Claim(claim_id="c5", patient_id=9, date_of_service="2023-02-01", charges_amount=2.0),
+        Claim(claim_id="c10", patient_id=claims[10].patient_id, date_of_service=claims[10].date_of_service,
+              charges_amount=claims[10].charges_amount),  # unchanged
+        Claim(claim_id="new1", patient_id=1, date_of_service="2023-02-02", charges_amount=50.0),
+    ]
+    invoice_delta = [
+        Invoice(invoice_id=invoices[0].invoice_id, claim_id="new1", transaction_value=50.0),
+        Invoice(invoice_id="fresh", claim_id="c7", transaction_value=12.5),
+        Invoice(invoice_id="fresh-orphan", claim_id="nowhere", transaction_value=1.0),
+    ]
+    assert svc.upsert_claims(claim_delta) == 2
+    assert svc.upsert_invoices(invoice_delta) == 3  # c0 loses an invoice, new1 gains it, c7 gains one
+
+    merged_claims = {c.claim_id: c for c in claims + claim_delta}
+    merged_invoices = {i.invoice_id: i for i in invoices + invoice_delta}
+    expected = ReconciliationService()
+    expected.load_claims(list(merged_claims.values()))
+    expected.load_invoices(list(merged_invoices.values()))
+
+    assert [r.model_dump() for r in svc.results_cache[:]] == [r.model_dump() for r in expected.reconcile()[:]]
+    assert svc.results_cache[-1].status == "BALANCED"
+    # materialized analytics were moved along with the delta
+    assert svc.get_analytics() == expected.get_analytics()
+
+
+def test_upserts_recompute_only_the_affected_claim_rows(monkeypatch):
+    import numpy as np
+    from app.utils import reconciliation
+
+    claims, invoices = _random_dataset(n_claims=200, seed=8)
+    svc = ReconciliationService()
+    svc.load_claims(claims[:-1])  # unique claim ids: claim c{i} is row i
+    svc.load_invoices(invoices)
+    svc.reconcile()
+    assert svc._invoice_ids is not None  # the invoice_id table is built by the reconcile, not the first upsert
+
+    recomputed = []
+
+    def spy(claims, index, rows=None):
+        recomputed.append(sorted(rows.tolist()))
+        return reconcile_rows(claims, index, rows)
+
+    reconcile_rows = reconciliation.reconcile_rows
+    monkeypatch.setattr(reconciliation, "reconcile_rows", spy)
+    moved = invoices[0]
+    svc.upsert_invoices([
+        Invoice(invoice_id=moved.invoice_id, claim_id="c7", transaction_value=1.0),  # leaves its claim for c7
+        Invoice(invoice_id="fresh", claim_id="c12", transaction_value=2.0),
+        Invoice(invoice_id="stray", claim_id="nowhere", transaction_value=3.0),
+    ])
+    svc.upsert_claims([
+        Claim(claim_id="c3", patient_id=1, date_of_service="2023-02-01", charges_amount=5.0),
+        Claim(claim_id="nowhere", patient_id=2, date_of_service="2023-02-02", charges_amount=3.0),
+    ])
+    assert recomputed == [sorted({int(moved.claim_id[1:]), 7, 12}), [3, 200]]
+    assert svc.results_cache[200].status == "BALANCED"  # the new claim adopted the stray invoice
+
+
+def test_published_versions_are_immutable_for_readers():
+    claims, invoices = _random_dataset(n_claims=100, seed=4)
+    svc = ReconciliationService()
+    svc.load_claims(claims[:-1])
+    svc.load_invoices(invoices)
+    svc.reconcile()
+
+    pinned = svc.current
+    before = [r.model_dump() for r in pinned.results[:]]
+    summary = pinned.summary
+
+    svc.upsert_claims([Claim(claim_id="c1", patient_id=1, date_of_service="2023-03-01", charges_amount=1.0),
+                       Claim(claim_id="extra", patient_id=2, date_of_service="2023-03-02", charges_amount=5.0)])
+    svc.upsert_invoices([Invoice(invoice_id="late", claim_id="c2", transaction_value=7.0)])
+    svc.load_claims(claims[:10])  # a replace in progress: readers still see the last publish
+
+    assert svc.current.version == pinned.version + 2
+    assert [r.model_dump() for r in pinned.results[:]] == before
+    assert pinned.summary is summary and pinned.summary["summary"]["total"] == 100
+    assert svc.get_analytics()["summary"]["total"] == 101
+    assert svc.current.results[1].charges_amount == 1.0 and pinned.results[1].charges_amount != 1.0
+
+
+def test_analytics_match_a_full_scan_of_results():
+    from collections import Counter, defaultdict
+    claims, invoices = _random_dataset(n_claims=300, seed=11)
+    svc = ReconciliationService()
+    svc.load_claims(claims)
+    svc.load_invoices(invoices)
+    results = svc.reconcile()[:]
+    analytics = svc.get_analytics()
+
+    statuses = Counter(r.status for r in results)
+    assert analytics["summary"] == {
+        "total": len(results), "balanced": statuses["BALANCED"], "overpaid": statuses["OVERPAID"],
+        "underpaid": statuses["UNDERPAID"], "no_invoices": statuses["N/A"],
+    }
+    days = Counter(r.date_of_service for r in results)
+    assert analytics["daily_volume_trend"] == [{"date": d, "count": days[d]} for d in sorted(days)]
+    bins = Counter(int(r.charges_amount // 100) * 100 for r in results)
+    assert analytics["charge_distribution"] == [{"bin": b, "count": bins[b]} for b in sorted(bins)]
+
+    per_patient = defaultdict(int)
+    for r in results:
+        per_patient[r.patient_name] += 1
+    assert [p["count"] for p in analytics["top_patients_volume"]] == sorted(per_patient.values(), reverse=True)[:20]
+    overpaid = round(sum(r.credit for r in results if r.status == "OVERPAID"), 2)
+    assert analytics["financial_impact_by_status"][0] == {"status": "OVERPAID", "amount": overpaid}
+
+
+def test_summary_rollup_matches_regrouped_results():
+    import random
+    from collections import Counter
+    from datetime import timedelta
+    rng = random.Random(3)
+    claims = [Claim(claim_id=f"c{i}", patient_id=rng.randint(1, 9),
+                    date_of_service=date(2022, 11, 1) + timedelta(days=rng.randrange(200)),
+                    charges_amount=rng.uniform(0, 900)) for i in range(600)]
+    invoices = [Invoice(invoice_id=f"i{i}", claim_id=f"c{rng.randrange(650)}", transaction_value=rng.uniform(0, 900))
+                for i in range(700)]
+    svc = ReconciliationService()
+    svc.load_claims(claims)
+    svc.load_invoices(invoices)
+    svc.reconcile()
+    svc.upsert_invoices([Invoice(invoice_id="late", claim_id="c1", transaction_value=5.0)])
+    results = svc.results_cache[:]
+
+    def start(d, granularity):
+        if granularity == "week":
+            return d - timedelta(days=d.weekday())
+        if granularity == "month":
+            return d.replace(day=1)
+        return d.replace(month=(d.month - 1) // 3 * 3 + 1, day=1)
+
+    lo, hi = date(2022, 12, 14), date(2023, 4, 2)
+    for granularity in ("week", "month", "quarter"):
+        summary = svc.current.rollup.summary(svc._patient_name, granularity, lo, hi, ["UNDERPAID", "BALANCED"])
+        picked = [r for r in results if lo <= r.date_of_service <= hi and r.status in ("UNDERPAID", "BALANCED")]
+        periods = Counter(start(r.date_of_service, granularity) for r in picked)
+        assert summary["daily_volume_trend"] == [{"date": d, "count": periods[d]} for d in sorted(periods)]
+        assert summary["summary"]["total"] == len(picked)
+        bins = Counter(int(r.charges_amount // 100) * 100 for r in picked)
+        assert summary["charge_distribution"] == [{"bin": b, "count": bins[b]} for b in sorted(bins)]
+        underpaid = round(-sum(r.credit for r in picked if r.status == "UNDERPAID"), 2)
+        assert summary["financial_impact_by_status"][1]["amount"] == pytest.approx(underpaid)
+    assert svc.current.rollup.summary(svc._patient_name) == svc.get_analytics()
@@ -1,8 +1,14 @@
+import asyncio
 import os
 import io
+import json
+import threading
+import time
 import pytest
 from fastapi.testclient import TestClient
 from app.main import app
+from app.routes.upload import get_jobs, get_renders
+from app.utils.export import dumps
 
 client = TestClient(app)
 
@@ -28,7 +34,7 @@ def test_upload_and_reconcile_flow():
         "invoices": ("invoices.csv", invoices_csv, "text/csv"),
     }
 
-    r = client.post("/api/upload", files=files)
+    r = client.post("/api/upload?wait=true", files=files)
     assert r.status_code == 200
 
     data = r.json()
@@ -57,3 +63,376 @@ def test_upload_and_reconcile_flow():
 
     assert summary["total_claims"] == 1
     assert summary["balanced"] == 1
+
+def test_upload_upsert_reports_changed_results():
+    files = {
+        "claims": ("claims.csv", "claim_id,patient_id,date_of_service,charges_amount\nc1,1,2023-01-01,100\nc2,2,2023-01-02,50\n", "text/csv"),
+        "invoices": ("invoices.csv", "invoice_id,claim_id,transaction_value\ni1,c1,100\n", "text/csv"),
+    }
+    r = client.post("/api/upload?wait=true", files=files)
+    assert r.status_code == 200
+
+    delta = {"invoices": ("delta.csv", "invoice_id,claim_id,transaction_value\ni2,c2,50\n", "text/csv")}
+    r = client.post("/api/upload?mode=upsert&wait=true", files=delta)
+    assert r.status_code == 200
+    data = r.json()
+    assert data["changed_results"] == 1
+    assert data["summary"]["summary"]["balanced"] == 2
+
+def test_reconciliation_filters_and_sort():
+    files = {
+        "claims": ("claims.csv", "claim_id,patient_id,date_of_service,charges_amount\n"
+                   "c1,1,2023-01-01,100\nc2,1,2023-07-02,50\nc3,2,2023-08-03,80\n", "text/csv"),
+        "invoices": ("invoices.csv", "invoice_id,claim_id,transaction_value\ni1,c1,100\ni2,c2,10\ni3,c3,20\n", "text/csv"),
+    }
+    assert client.post("/api/upload?wait=true", files=files).status_code == 200
+
+    r = client.get("/api/reconciliation", params={"status": "UNDERPAID", "sort": "credit"})
+    assert r.status_code == 200
+    body = r.json()
+    assert body["total"] == 2
+    assert [row["claim_id"] for row in body["data"]] == ["c3", "c2"]
+
+    r = client.get("/api/reconciliation", params={"patient_id": 1, "date_from": "2023-07-01"})
+    assert [row["claim_id"] for row in r.json()["data"]] == ["c2"]
+
+    assert client.get("/api/reconciliation", params={"sort": "name"}).status_code == 400
+
+
+def test_reconciliation_cursor_and_export():
+    claims = "claim_id,patient_id,date_of_service,charges_amount\n" + "".join(
+        f"c{i},{i % 3},2023-01-{i % 28 + 1:02d},{i * 10}\n" for i in range(1, 11))
+    files = {
+        "claims": ("claims.csv", claims, "text/csv"),
+        "invoices": ("invoices.csv", "invoice_id,claim_id,transaction_value\ni1,c1,10\ni2,c2,5\n", "text/csv"),
+    }
+    assert client.post("/api/upload?wait=true", files=files).status_code == 200
+
+    ids, params = [], {"sort": "-charges_amount", "limit": 4}
+    while True:
+        body = client.get("/api/reconciliation", params=params).json()
+        ids += [row["claim_id"] for row in body["data"]]
+        if not body["next_cursor"]:
+            break
+        params["cursor"] = body["next_cursor"]
+    assert ids == [f"c{i}" for i in range(10, 0, -1)]
+
+    r = client.get("/api/reconciliation/export", params={"format": "csv", "status": "BALANCED"})
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/csv")
+    lines = r.text.strip().splitlines()
+    assert lines[0].startswith("claim_id,")
+    assert len(lines) == 2 and lines[1].startswith("c1,")
+
+    r = client.get("/api/reconciliation/export", params={"format": "ndjson", "sort": "charges_amount"})
+    rows = [json.loads(line) for line in r.text.splitlines()]
+    assert [row["claim_id"] for row in rows] == [f"c{i}" for i in range(1, 11)]
+
+    # a cursor from before the data changed is rejected
+    cursor = client.get("/api/reconciliation", params={"limit": 2}).json()["next_cursor"]
+    delta = {"invoices": ("delta.csv", "invoice_id,claim_id,transaction_value\ni3,c3,30\n", "text/csv")}
+    assert client.post("/api/upload?mode=upsert&wait=true", files=delta).status_code == 200
+    assert client.get("/api/reconciliation", params={"limit": 2, "cursor": cursor}).status_code == 410
+
+
+def test_upload_job_reports_stages():
+    files = {
+        "claims": ("claims.csv", "claim_id,patient_id,date_of_service,charges_amount\nc1,1,2023-01-01,100\n", "text/csv"),
+        "invoices": ("invoices.csv", "invoice_id,claim_id,transaction_value\ni1,c1,100\n", "text/csv"),
+    }
+    r = client.post("/api/upload", files=files)
+    assert r.status_code == 202
+    job_id = r.json()["job_id"]
+
+    get_jobs().get(job_id).future.result(timeout=10)
+    job = client.get(f"/api/jobs/{job_id}").json()
+    assert job["status"] == "done"
+    assert all(s["status"] == "done" for s in job["stages"].values())
+    assert job["counts"]["claims_parsed"] == 1 and job["counts"]["results"] == 1
+    assert job["result"]["total_records"] == 1
+
+    bad = {"claims": ("claims.csv", "claim_id,patient_id\nc1,1\n", "text/csv")}
+    job_id = client.post("/api/upload", files=bad).json()["job_id"]
+    get_jobs().get(job_id).future.result(timeout=10)
+    job = client.get(f"/api/jobs/{job_id}").json()
+    assert job["status"] == "failed"
+    assert "Missing required columns" in job["errors"][0]
+    assert client.get("/api/jobs/unknown").status_code == 404
+
+
+def test_named_datasets_are_isolated():
+    claims = "claim_id,patient_id,date_of_service,charges_amount\nc1,1,2023-01-01,100\n"
+    for name, value in (("payer-a", 100), ("payer-b", 40)):
+        files = {
+            "claims": ("claims.csv", claims, "text/csv"),
+            "invoices": ("invoices.csv", f"invoice_id,claim_id,transaction_value\ni1,c1,{value}\n", "text/csv"),
+        }
+        assert client.post(f"/api/upload?wait=true&dataset={name}", files=files).status_code == 200
+
+    a = client.get("/api/reconciliation", params={"dataset": "payer-a"}).json()["data"]
+    b = client.get("/api/reconciliation", params={"dataset": "payer-b"}).json()["data"]
+    assert (a[0]["status"], b[0]["status"]) == ("BALANCED", "UNDERPAID")
+    assert client.get("/api/summary", params={"dataset": "payer-b"}).json()["summary"]["underpaid"] == 1
+
+    assert client.get("/api/summary", params={"dataset": "nope"}).status_code == 404
+    assert client.get("/api/summary", params={"dataset": "../etc"}).status_code == 422
+    listed = {d["name"]: d for d in client.get("/api/datasets").json()["datasets"]}
+    assert listed["payer-a"]["resident"] and listed["payer-a"]["resident_bytes"] > 0
+
+
+def test_summary_granularity_and_filters():
+    claims = ("claim_id,patient_id,date_of_service,charges_amount\n"
+              "c1,1,2023-01-05,100\nc2,1,2023-01-20,100\nc3,2,2023-02-11,250\nc4,2,2023-04-02,50\n")
+    invoices = "invoice_id,claim_id,transaction_value\ni1,c1,100\ni2,c2,60\ni3,c3,250\n"
+    files = {"claims": ("claims.csv", claims, "text/csv"), "invoices": ("invoices.csv", invoices, "text/csv")}
+    assert client.post("/api/upload?wait=true&dataset=rollup", files=files).status_code == 200
+
+    params = {"dataset": "rollup", "granularity": "month", "date_to": "2023-03-31", "status": ["BALANCED", "UNDERPAID"]}
+    summary = client.get("/api/summary", params=params).json()
+    assert summary["daily_volume_trend"] == [{"date": "2023-01-01", "count": 2}, {"date": "2023-02-01", "count": 1}]
+    assert summary["summary"]["total"] == 3
+    quarters = client.get("/api/summary", params={"dataset": "rollup", "granularity": "quarter"}).json()
+    assert [p["count"] for p in quarters["daily_volume_trend"]] == [3, 1]
+
+    assert client.get("/api/summary", params={"dataset": "rollup", "status": "PAID"}).status_code == 400
+    assert client.get("/api/summary", params={"dataset": "rollup", "granularity": "year"}).status_code == 422
+
+
+def test_first_pages_and_summaries_are_served_pre_rendered():
+    files = {
+        "claims": ("claims.csv", "claim_id,patient_id,date_of_service,charges_amount\nc1,1,2023-01-01,100\n", "text/csv"),
+        "invoices": ("invoices.csv", "invoice_id,claim_id,transaction_value\ni1,c1,90\n", "text/csv"),
+    }
+    assert client.post("/api/upload?wait=true&dataset=rendered", files=files).status_code == 200
+
+    before = client.get("/api/datasets").json()["render_cache"]
+    first = client.get("/api/reconciliation", params={"dataset": "rendered"})
+    again = client.get("/api/reconciliation", params={"dataset": "rendered"})
+    assert first.content == again.content
+    assert again.json()["data"][0] == {
+        "claim_id": "c1", "patient_id": "1", "patient_name": "Mark Mcdowell", "date_of_service": "2023-01-01",
+        "charges_amount": 100.0, "invoice_total": 90.0, "status": "UNDERPAID", "credit": -10.0,
+    }
+    client.get("/api/summary", params={"dataset": "rendered"})
+    client.get("/api/summary", params={"dataset": "rendered"})
+    after = client.get("/api/datasets").json()["render_cache"]
+    assert (after["hits"] - before["hits"], after["misses"] - before["misses"]) == (2, 2)
+
+    # a new version is rendered afresh
+    delta = {"invoices": ("delta.csv", "invoice_id,claim_id,transaction_value\ni2,c1,10\n", "text/csv")}
+    assert client.post("/api/upload?mode=upsert&wait=true&dataset=rendered", files=delta).status_code == 200
+    assert client.get("/api/reconciliation", params={"dataset": "rendered"}).json()["data"][0]["status"] == "BALANCED"
+
+
+def test_reads_are_conditional_and_compressed(monkeypatch):
+    files = {
+        "claims": ("claims.csv", "claim_id,patient_id,date_of_service,charges_amount\nc1,1,2023-01-01,100\n", "text/csv"),
+        "invoices": ("invoices.csv", "invoice_id,claim_id,transaction_value\ni1,c1,100\n", "text/csv"),
+    }
+    assert client.post("/api/upload?wait=true&dataset=etags", files=files).status_code == 200
+    monkeypatch.setattr(get_renders(), "min_compress", 0)
+
+    for path in ("/api/summary", "/api/reconciliation", "/api/reconciliation/export"):
+        r = client.get(path, params={"dataset": "etags"}, headers={"Accept-Encoding": "gzip"})
+        assert r.status_code == 200 and r.headers["etag"] and r.headers["last-modified"]
+        if path != "/api/reconciliation/export":
+            assert r.headers["content-encoding"] == "gzip" and r.json()
+        etag = r.headers["etag"]
+        assert client.get(path, params={"dataset": "etags"}, headers={"If-None-Match": etag}).status_code == 304
+        assert client.get(path, params={"dataset": "etags"},
+                          headers={"If-Modified-Since": r.headers["last-modified"]}).status_code == 304
+
+    delta = {"invoices": ("delta.csv", "invoice_id,claim_id,transaction_value\ni2,c1,5\n", "text/csv")}
+    assert client.post("/api/upload?mode=upsert&wait=true&dataset=etags", files=delta).status_code == 200
+    r = client.get("/api/summary", params={"dataset": "etags"}, headers={"If-None-Match": etag})
+    assert r.status_code == 200 and r.headers["etag"] != etag
+
+
+def test_malformed_rows_fail_the_upload_unless_skipped():
+    files = {
+        "claims": ("claims.csv", "claim_id,patient_id,date_of_service,charges_amount\nc1,1,2023-01-01,100\nc2,x,2023-01-01,5\n", "text/csv"),
+        "invoices": ("invoices.csv", "invoice_id,claim_id,transaction_value\ni1,c1,100\ni2,c1,abc\n", "text/csv"),
+    }
+    r = client.post("/api/upload?wait=true&dataset=strict", files=files)
+    assert r.status_code == 400
+    assert r.json()["detail"] == [
+        "Claims CSV error: 1 invalid claims rows: line 3: invalid patient_id 'x'",
+        "Invoices CSV error: 1 invalid invoices rows: line 3: invalid transaction_value 'abc'",
+    ]
+    assert client.get("/api/reconciliation", params={"dataset": "strict"}).json() == []  # nothing was loaded
+
+    r = client.post("/api/upload?wait=true&on_error=skip&dataset=strict", files=files)
+    assert r.status_code == 200 and r.json()["total_records"] == 1
+    assert r.json()["ingest"]["claims"]["errors"] == ["line 3: invalid patient_id 'x'"]
+    assert client.post("/api/upload?on_error=drop&dataset=strict", files=files).status_code == 422
+
+
+def test_metrics_and_request_profiles(monkeypatch, tmp_path):
+    files = {
+        "claims": ("claims.csv", "claim_id,patient_id,date_of_service,charges_amount\nc1,1,2023-01-01,100\nc2,x,2023-01-01,5\n", "text/csv"),
+        "invoices": ("invoices.csv", "invoice_id,claim_id,transaction_value\ni1,c1,100\n", "text/csv"),
+    }
+    assert client.post("/api/upload?wait=true&on_error=skip&dataset=metrics", files=files).status_code == 200
+    assert client.get("/api/summary", params={"dataset": "metrics"}).status_code == 200
+
+    r = client.get("/metrics")
+    assert r.status_code == 200 and r.headers["content-type"].startswith("text/plain")
+    lines = r.text.splitlines()
+    assert any(l.startswith('recon_ingest_rows_total{kind="claims",outcome="rejected"}') for l in lines)
+    assert any(l.startswith('recon_stage_seconds_count{stage="reconcile"}') for l in lines)
+    assert any(l.startswith('recon_http_requests_total{method="GET",route="/api/summary",status="200"}') for l in lines)
+    assert 'recon_dataset_results{dataset="metrics"} 1' in lines
+    assert any(l.startswith("recon_process_peak_rss_bytes ") for l in lines)
+
+    monkeypatch.setattr("app.main.PROFILE_DIR", str(tmp_path))
+    assert "x-profile" not in client.get("/api/summary", params={"dataset": "metrics"}).headers
+    r = client.get("/api/reconciliation", params={"dataset": "metrics"}, headers={"X-Profile": "1"})
+    assert r.status_code == 200
+    assert (tmp_path / r.headers["x-profile"]).exists()
+
+    # a streamed body is sampled until it is sent, on the threads producing it, and nothing else is
+    from app.utils.profiler import SamplingProfiler
+    monkeypatch.setattr(SamplingProfiler.__init__, "__defaults__", (0.001,))
+
+    # pages are rendered in the threadpool, off the event loop, and still show up in the profile
+    loops = []
+
+    def slow_dumps(payload):
+        try:
+            loops.append(asyncio.get_running_loop())
+        except RuntimeError:
+            loops.append(None)
+        end = time.perf_counter() + 0.05
+        while time.perf_counter() < end:
+            pass
+        return dumps(payload)
+
+    with monkeypatch.context() as m:
+        m.setattr("app.routes.reconciliation.dumps", slow_dumps)
+        m.setattr("app.routes.summary.dumps", slow_dumps)
+        r = client.get("/api/reconciliation", params={"dataset": "metrics", "limit": 7}, headers={"X-Profile": "1"})
+        assert r.status_code == 200
+        assert "slow_dumps" in (tmp_path / r.headers["x-profile"]).read_text()
+        assert client.get("/api/summary", params={"dataset": "metrics", "granularity": "week"}).status_code == 200
+    assert loops == [None, None]
+
+    def slow_csv(batches):
+        for batch in batches:
+            end = time.perf_counter() + 0.05
+            while time.perf_counter() < end:
+                pass
+            yield "".join(",".join(map(str, row)) + "\n" for row in batch)
+
+    def bystander():
+        while not done.is_set():
+            pass
+
+    monkeypatch.setattr("app.routes.reconciliation.iter_csv", slow_csv)
+    done = threading.Event()
+    other = threading.Thread(target=bystander)
+    other.start()
+    try:
+        r = client.get("/api/reconciliation/export", params={"dataset": "metrics"}, headers={"X-Profile": "1"})
+    finally:
+        done.set()
+        other.join()
+    profile = (tmp_path / r.headers["x-profile"]).read_text()
+    assert "slow_csv" in profile and "bystander" not in profile
+
+
+def test_patient_upload_renames_without_reconciling(monkeypatch, tmp_path):
+    from app.utils.patients import get_patients
+    patients = get_patients()
+    monkeypatch.setattr(patients, "_directory", patients.directory)  # restored after the test
+    monkeypatch.setattr(patients, "root", tmp_path)
+
+    files = {
+        "claims": ("claims.csv", "claim_id,patient_id,date_of_service,charges_amount\nc1,900001,2023-01-01,100\n", "text/csv"),
+        "invoices": ("invoices.csv", "invoice_id,claim_id,transaction_value\ni1,c1,100\n", "text/csv"),
+    }
+    assert client.post("/api/upload?wait=true&dataset=names", files=files).status_code == 200
+    r = client.get("/api/reconciliation", params={"dataset": "names"})
+    assert r.json()["data"][0]["patient_name"] == "Patient 900001"
+    etag = r.headers["etag"]
+    assert "Patient 900001" in client.get("/api/summary", params={"dataset": "names"}).text
+
+    csv = "patient_id,name\n900001,Zelda Quist\nbad,Nobody\n"
+    r = client.post("/api/patients?wait=true", files={"patients": ("patients.csv", csv, "text/csv")})
+    assert r.status_code == 200
+    assert r.json()["patients"] == "1 patients loaded" and r.json()["rows_rejected"] == 1
+
+    r = client.get("/api/reconciliation", params={"dataset": "names"}, headers={"If-None-Match": etag})
+    assert r.status_code == 200 and r.headers["etag"] != etag
+    assert r.json()["data"][0]["patient_name"] == "Zelda Quist"
+    # the patients job re-rendered the default summary; reading it renders nothing
+    from app.utils.analytics import Rollup
+    with monkeypatch.context() as m:
+        m.setattr(Rollup, "summary", lambda *a, **k: pytest.fail("summary rendered on read"))
+        assert "Zelda Quist" in client.get("/api/summary", params={"dataset": "names"}).text
+    r = client.get("/api/reconciliation", params={"dataset": "names", "patient_name": "zel"})
+    assert [row["claim_id"] for row in r.json()["data"]] == ["c1"]
+    assert client.get("/api/datasets").json()["patients"]["patients"] == 1
+
+    r = client.post("/api/patients?wait=true", files={"patients": ("patients.csv", "id,name\n1,x\n", "text/csv")})
+    assert r.status_code == 400
+
+
+def test_upload_accepts_several_compressed_files_per_side():
+    import gzip
+    header = "invoice_id,claim_id,transaction_value\n"
+    files = [
+        ("claims", ("claims.csv", "claim_id,patient_id,date_of_service,charges_amount\nc1,1,2023-01-01,100\n", "text/csv")),
+        ("invoices", ("day1.csv.gz", gzip.compress((header + "i1,c1,60\n").encode()), "application/gzip")),
+        ("invoices", ("day2.csv.gz", gzip.compress((header + "i2,c1,40\ni1,c1,60\n").encode()), "application/gzip")),
+    ]
+    r = client.post("/api/upload?wait=true&dataset=parts", files=files)
+    assert r.status_code == 200
+    data = r.json()
+    assert data["invoices"] == "3 invoices loaded"
+    assert data["ingest"]["invoices"]["duplicate_ids"] == ["i1"]
+    rows = client.get("/api/reconciliation", params={"dataset": "parts"}).json()["data"]
+    assert rows[0]["invoice_total"] == 160
+
+
+def test_orphan_invoices_and_version_diff():
+    files = {
+        "claims": ("claims.csv", "claim_id,patient_id,date_of_service,charges_amount\n"
+                   "c1,1,2023-01-01,100\nc2,2,2023-01-02,50\n", "text/csv"),
+        "invoices": ("invoices.csv", "invoice_id,claim_id,transaction_value\ni1,c1,100\ni2,c9,7.5\n", "text/csv"),
+    }
+    r = client.post("/api/upload?wait=true&dataset=diffs", files=files)
+    assert r.status_code == 200 and r.json()["orphan_invoices"] == 1
+    r = client.get("/api/reconciliation/orphans", params={"dataset": "diffs"})
+    body = r.json()
+    assert body["data"] == [{"invoice_id": "i2", "claim_id": "c9", "transaction_value": 7.5}]
+    assert body["total"] == 1 and body["total_value"] == 7.5
+    first = body["version"]
+
+    # the orphan's claim arrives: it is no longer an orphan, and c9 shows up in the diff
+    delta = {"claims": ("delta.csv", "claim_id,patient_id,date_of_service,charges_amount\nc9,3,2023-01-03,7.5\n", "text/csv")}
+    assert client.post("/api/upload?mode=upsert&wait=true&dataset=diffs", files=delta).json()["orphan_invoices"] == 0
+    r = client.get("/api/reconciliation/diff", params={"dataset": "diffs", "from_version": first})
+    assert r.status_code == 200
+    assert r.json()["data"] == [{"claim_id": "c9", "before": None, "after": {"status": "BALANCED", "credit": 0.0}}]
+
+    current = r.json()["to_version"]
+    assert client.get("/api/reconciliation/diff", params={"dataset": "diffs", "from_version": current,
+                                                           "to_version": first}).status_code == 400
+    assert client.get("/api/reconciliation/diff", params={"dataset": "diffs", "from_version": 0}).status_code == 410
+
+
+def test_snapshot_write_failure_does_not_fail_the_upload(monkeypatch, tmp_path):
+    from app.utils.reconciliation import ReconciliationService
+
+    def broken(self):
+        raise ValueError("unsupported column type")
+
+    monkeypatch.setattr("app.routes.upload.SNAPSHOT_DIR", str(tmp_path))
+    monkeypatch.setattr(ReconciliationService, "save_snapshot", broken)
+    files = {
+        "claims": ("claims.csv", "claim_id,patient_id,date_of_service,charges_amount\nc1,1,2023-01-01,100\n", "text/csv"),
+        "invoices": ("invoices.csv", "invoice_id,claim_id,transaction_value\ni1,c1,100\n", "text/csv"),
+    }
+    r = client.post("/api/upload?wait=true&dataset=snapfail", files=files)
+    assert r.status_code == 200 and r.json()["total_records"] == 1
+    assert client.get("/api/reconciliation", params={"dataset": "snapfail"}).json()["total"] == 1
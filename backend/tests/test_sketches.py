@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from app.models.claim import Claim
+from app.models.invoice import Invoice
+from app.utils.reconciliation import ReconciliationService
+from app.utils.sketches import HeavyHitters, QuantileSketch
+from app.utils.sqlite_backend import SqliteReconciliationService
+from tests.test_reconciliation import _random_dataset
+
+
+def test_quantiles_within_relative_error():
+    rng = np.random.default_rng(3)
+    values = np.concatenate([rng.lognormal(8, 2, 50_000).astype(np.int64), -rng.integers(1, 10**6, 5_000), [0] * 100])
+    sketch = QuantileSketch(0.01)
+    for chunk in np.array_split(values, 7):
+        sketch.add(chunk)
+    ordered = np.sort(values)
+    for q, estimate in zip((0.01, 0.5, 0.9, 0.99), sketch.quantiles((0.01, 0.5, 0.9, 0.99))):
+        exact = ordered[int(q * (len(values) - 1))]
+        assert abs(estimate - exact) <= 0.01 * abs(exact) + 1e-9
+
+    # removing rows is exact: the sketch equals one built without them
+    sketch.add(values[:1000], sign=-1)
+    fresh = QuantileSketch(0.01)
+    fresh.add(values[1000:])
+    assert sketch.quantiles() == fresh.quantiles()
+
+
+def test_heavy_hitters_error_bound_and_merge():
+    rng = np.random.default_rng(5)
+    keys = np.concatenate([rng.zipf(1.5, 20_000) % 5000, np.full(3000, 42)])
+    exact = np.bincount(keys)
+    whole, a, b = HeavyHitters(50), HeavyHitters(50), HeavyHitters(50)
+    whole.add(keys, np.ones(len(keys), dtype=np.int64))
+    a.add(keys[::2], np.ones(len(keys[::2]), dtype=np.int64))
+    b.add(keys[1::2], np.ones(len(keys[1::2]), dtype=np.int64))
+    a.merge(b)
+    for sketch in (whole, a):
+        assert sketch.error <= len(keys) / 51
+        assert [k for k, _ in sketch.top(2)] == list(np.argsort(-exact, kind="stable")[:2])
+        for key, estimate in sketch.top(50):
+            assert exact[key] - sketch.error <= estimate <= exact[key]
+
+
+@pytest.fixture
+def sketch_mode(monkeypatch):
+    monkeypatch.setattr("app.utils.analytics.ANALYTICS_MODE", "sketch")
+
+
+def test_sketch_summary_survives_upserts_and_backends(tmp_path, sketch_mode):
+    claims, invoices = _random_dataset(n_claims=600, seed=13)
+    memory, sqlite = ReconciliationService(), SqliteReconciliationService(str(tmp_path))
+    for svc in (memory, sqlite):
+        svc.load_claims(claims)
+        svc.load_invoices(invoices)
+        svc.reconcile()
+    summary = memory.get_analytics()
+    assert set(summary["quantiles"]) == {"charges", "invoice_totals", "credits"}
+    assert summary["sketch_error"]["relative_error"] == 0.01
+    assert sqlite.get_analytics() == summary
+
+    # an incremental upsert lands on the same sketches as a full rebuild
+    changes = [Claim(claim_id="c5", patient_id="3", date_of_service="2023-01-09", charges_amount=4200.0)]
+    extra = [Invoice(invoice_id="x1", claim_id="c5", transaction_value=4300.0)]
+    for svc in (memory, sqlite):
+        svc.upsert_claims(changes)
+        svc.upsert_invoices(extra)
+    rebuilt = ReconciliationService()
+    rebuilt.load_claims([changes[0] if c.claim_id == "c5" else c for c in claims])
+    rebuilt.load_invoices(invoices + extra)
+    rebuilt.reconcile()
+    assert memory.get_analytics()["quantiles"] == rebuilt.get_analytics()["quantiles"]
+    assert sqlite.get_analytics()["quantiles"] == rebuilt.get_analytics()["quantiles"]
+
+    by_status = memory.current.rollup.summary(memory._patient_name, statuses=["OVERPAID"])
+    assert list(by_status["top_patients_by_status"]) == ["OVERPAID"]
+    assert by_status["top_patients_underpaid"] == []
+
+
+def test_sketch_snapshot_roundtrip(tmp_path, sketch_mode):
+    claims, invoices = _random_dataset(n_claims=300, seed=2)
+    svc = ReconciliationService(snapshot_dir=str(tmp_path))
+    svc.load_claims(claims)
+    svc.load_invoices(invoices)
+    svc.reconcile()
+    svc.save_snapshot()
+
+    restored = ReconciliationService(snapshot_dir=str(tmp_path))
+    assert restored.load_snapshot()
+    assert restored.get_analytics() == svc.get_analytics()
@@ -0,0 +1,87 @@
+import numpy as np
+
+from app.models.invoice import Invoice
+from app.utils.reconciliation import ReconciliationService
+from app.utils.snapshot import LATEST
+from tests.test_reconciliation import _random_dataset
+
+
+def _service():
+    claims, invoices = _random_dataset(n_claims=300, seed=5)
+    svc = ReconciliationService()
+    svc.load_claims(claims[:-1])
+    svc.load_invoices(invoices)
+    svc.reconcile()
+    return svc
+
+
+def test_snapshot_round_trip_is_memory_mapped(tmp_path):
+    svc = _service()
+    path = svc.save_snapshot(str(tmp_path))
+    assert (tmp_path / LATEST).read_text() == path.name
+
+    restored = ReconciliationService()
+    assert restored.load_snapshot(str(tmp_path))
+    assert isinstance(restored.claims.charges_cents, np.memmap)
+    assert isinstance(restored._invoice_row, np.memmap)  # the invoice_id table is mapped, not rebuilt
+    assert restored.version == svc.version
+    assert [r.model_dump() for r in restored.results_cache[:]] == [r.model_dump() for r in svc.results_cache[:]]
+    assert restored.get_analytics() == svc.get_analytics()
+
+    # upserts keep working on the mapped arrays without touching the files
+    delta = [Invoice(invoice_id="late", claim_id="c4", transaction_value=3.0)]
+    assert restored.upsert_invoices(delta) == svc.upsert_invoices(delta) == 1
+    assert restored.get_analytics() == svc.get_analytics()
+    reread = ReconciliationService()
+    reread.load_snapshot(str(tmp_path))
+    assert reread.results_cache[4].invoice_total != restored.results_cache[4].invoice_total
+
+
+def test_snapshots_are_pruned_and_missing_ones_ignored(tmp_path):
+    assert not ReconciliationService().load_snapshot(str(tmp_path))
+    svc = _service()
+    first = svc.save_snapshot(str(tmp_path))
+    svc.reconcile()
+    second = svc.save_snapshot(str(tmp_path))
+    svc.reconcile()
+    third = svc.save_snapshot(str(tmp_path))
+
+    assert sorted(p.name for p in tmp_path.glob("snapshot-*")) == [second.name, third.name]
+    assert not first.exists()
+    restored = ReconciliationService()
+    assert restored.load_snapshot(str(tmp_path))
+    assert restored.version == svc.version
+
+
+def test_upserts_are_appended_to_the_snapshot_and_replayed(tmp_path, monkeypatch):
+    from app.models.claim import Claim
+    monkeypatch.setattr("app.utils.reconciliation.SNAPSHOT_MAX_DELTAS", 3)
+    svc = _service()
+    svc.snapshot_dir = str(tmp_path)
+    base = svc.save_snapshot()
+    base_files = {p.name: p.stat().st_mtime_ns for p in base.iterdir()}
+
+    reader = ReconciliationService(snapshot_dir=str(tmp_path))
+    reader.load_snapshot()
+    svc.upsert_invoices([Invoice(invoice_id="late", claim_id="c4", transaction_value=3.0)])
+    svc.upsert_claims([Claim(claim_id="new", patient_id=1, date_of_service="2023-04-01", charges_amount=3.0)])
+    assert svc.save_snapshot() == base
+    assert sorted(p.name for p in tmp_path.glob("snapshot-*")) == [base.name]
+    assert {p.name: p.stat().st_mtime_ns for p in base.iterdir() if p.is_file()} == base_files
+
+    restored = ReconciliationService()
+    restored.load_snapshot(str(tmp_path))
+    assert restored.version == svc.version
+    assert [r.model_dump() for r in restored.results_cache[:]] == [r.model_dump() for r in svc.results_cache[:]]
+    assert restored.get_analytics() == svc.get_analytics()
+    # another process catches up by replaying only the new segments
+    assert reader.refresh() and reader.version == svc.version
+    assert [r.model_dump() for r in reader.current.results[:]] == [r.model_dump() for r in svc.results_cache[:]]
+    assert not reader.refresh()
+
+    # past SNAPSHOT_MAX_DELTAS segments the next save is a full snapshot again
+    svc.upsert_invoices([Invoice(invoice_id="later", claim_id="c5", transaction_value=1.0)])
+    svc.upsert_invoices([Invoice(invoice_id="latest", claim_id="c6", transaction_value=1.0)])
+    compacted = svc.save_snapshot()
+    assert compacted != base and not list(compacted.glob("delta-*"))
+    assert reader.refresh() and reader.version == svc.version
@@ -0,0 +1,140 @@
+import gzip
+import io
+from datetime import date
+
+import pytest
+from fastapi import UploadFile
+
+from app.models.claim import Claim
+from app.models.invoice import Invoice
+from app.models.schemas import ResultQuery
+from app.utils.patients import PatientDirectory, Patients
+from app.utils.reconciliation import ReconciliationService
+from app.utils.sqlite_backend import SqliteReconciliationService
+from tests.test_reconciliation import _random_dataset
+
+
+def _pair(tmp_path, n_claims=400, seed=11):
+    claims, invoices = _random_dataset(n_claims=n_claims, seed=seed)
+    memory, sqlite = ReconciliationService(), SqliteReconciliationService(str(tmp_path))
+    for svc in (memory, sqlite):
+        svc.load_claims(claims)
+        svc.load_invoices(invoices)
+        svc.reconcile()
+    return memory, sqlite
+
+
+def _dump(models):
+    return [m.model_dump() for m in models]
+
+
+@pytest.mark.parametrize("params", [
+    {},
+    {"sort": "credit"},
+    {"sort": "-credit"},
+    {"sort": "-date_of_service"},
+    {"status": ["UNDERPAID", "N/A"], "sort": "charges_amount"},
+    {"patient_name": "pat", "sort": "-charges_amount"},
+    {"min_credit": -50, "max_credit": 50, "date_from": date(2023, 3, 1)},
+])
+def test_sqlite_backend_matches_columnar(tmp_path, params):
+    memory, sqlite = _pair(tmp_path)
+    assert sqlite.get_analytics() == memory.get_analytics()
+
+    q = ResultQuery(**params)
+    expected, total, _ = memory.query_results(q, limit=10_000)
+    assert sqlite.query_results(q, limit=10_000)[:2] == (expected, total)
+
+    # keyset pages walk the same order
+    seen, after = [], None
+    while True:
+        page, _, after = sqlite.query_results(q, limit=29, after=after)
+        seen.extend(page)
+        if after is None:
+            break
+    assert _dump(seen) == _dump(expected)
+    assert [row for batch in sqlite.current.iter_rows(q, 50) for row in batch] == \
+        [row for batch in memory.current.iter_rows(q, 50) for row in batch]
+
+
+def test_sqlite_upserts_and_reopen(tmp_path):
+    memory, sqlite = _pair(tmp_path)
+    claims = [Claim(claim_id="c3", patient_id="2", date_of_service="2023-02-02", charges_amount=75.0),
+              Claim(claim_id="fresh", patient_id="9", date_of_service="2023-05-05", charges_amount=20.0)]
+    invoices = [Invoice(invoice_id="i1", claim_id="fresh", transaction_value=20.0),
+                Invoice(invoice_id="new", claim_id="c3", transaction_value=75.0)]
+    assert sqlite.upsert_claims(claims) == memory.upsert_claims(claims)
+    assert sqlite.upsert_invoices(invoices) == memory.upsert_invoices(invoices)
+    assert sqlite.version == 3
+    assert (len(sqlite.claims), len(sqlite.invoices)) == (len(memory.claims), len(memory.invoices))
+    assert _dump(sqlite.get_results(limit=10_000)) == _dump(memory.get_results(limit=10_000))
+    assert sqlite.get_analytics() == memory.get_analytics()
+
+    reopened = SqliteReconciliationService(str(tmp_path))
+    assert reopened.load_snapshot()
+    assert reopened.version == 3
+    assert len(reopened.claims) == len(memory.claims)
+    assert _dump(reopened.get_results(skip=5, limit=20)) == _dump(memory.get_results(skip=5, limit=20))
+
+
+def test_sqlite_streams_csv_into_staging(tmp_path):
+    svc = SqliteReconciliationService(str(tmp_path))
+    claims_csv = b"claim_id,patient_id,date_of_service,charges_amount\nc1,1,2023-01-01,10.00\nc2,2,bad,5\nc3,2,2023-01-02,7.5\n"
+    with pytest.raises(ValueError, match="1 invalid claims rows"):
+        svc.read_claims(UploadFile(io.BytesIO(claims_csv), filename="claims.csv"))
+    staged = svc.read_claims(UploadFile(io.BytesIO(claims_csv), filename="claims.csv"), on_error="skip")
+    assert len(staged) == 2 and staged.report.rows_rejected == 1
+    svc.load_claims(staged)
+    svc.load_invoices(svc.read_invoices(UploadFile(
+        io.BytesIO(b"invoice_id,claim_id,transaction_value\ni1,c1,10\ni2,c3,8\n"), filename="invoices.csv")))
+    assert len(svc.reconcile()) == 2
+    assert [(r.claim_id, r.status) for r in svc.get_results()] == [("c1", "BALANCED"), ("c3", "OVERPAID")]
+
+    # several parts, one of them gzip-compressed, are staged one after another
+    header = b"invoice_id,claim_id,transaction_value\n"
+    staged = svc.read_invoices([UploadFile(io.BytesIO(header + b"i1,c1,4\n"), filename="a.csv"),
+                                UploadFile(io.BytesIO(gzip.compress(header + b"i1,c1,6\ni3,c3,x\n")), filename="b.csv.gz")],
+                               on_error="skip")
+    assert len(staged) == 2 and staged.report.errors == ["b.csv.gz line 3: invalid transaction_value 'x'"]
+    assert staged.report.duplicate_ids == ["i1"]
+
+
+def test_name_filters_read_a_patients_table_that_only_writers_sync(tmp_path):
+    svc = SqliteReconciliationService(str(tmp_path))
+    svc.patients = Patients(None, PatientDirectory.from_names([1, 2], ["Mark Mcdowell", "Mary Major"]))
+    svc.load_claims([Claim(claim_id=f"c{p}", patient_id=p, date_of_service="2023-01-01", charges_amount=5.0)
+                     for p in (1, 2, 3)])
+    svc.load_invoices([Invoice(invoice_id="i1", claim_id="c1", transaction_value=5.0)])
+    svc.reconcile()  # syncs the directory in its own transaction
+    q = ResultQuery(patient_name="mar")
+    assert {r.patient_id for r in svc.query_results(q, limit=1000)[0]} == {"1", "2"}
+
+    svc.patients.replace(PatientDirectory.from_names([1, 2], ["Mark Mcdowell", "Zoe Major"]))
+    writes = svc._conn().total_changes
+    assert {r.patient_id for r in svc.query_results(q, limit=1000)[0]} == {"1", "2"}  # stale until synced
+    assert svc._conn().total_changes == writes  # the read never writes
+
+    svc.sync_patients()
+    assert {r.patient_id for r in svc.query_results(q, limit=1000)[0]} == {"1"}
+
+
+def test_a_pinned_version_keeps_reading_its_own_rows(tmp_path):
+    memory, sqlite = _pair(tmp_path)
+    old = sqlite.current
+    q = ResultQuery(sort="-charges_amount")
+    before = _dump(old.query(q, limit=10_000)[0])
+    stream = old.iter_rows(ResultQuery(), 50)
+    first_batch = next(stream)  # an export already under way
+
+    claims, invoices = _random_dataset(n_claims=150, seed=5)
+    sqlite.load_claims(claims)
+    sqlite.load_invoices(invoices)
+    sqlite.reconcile()  # commits a new version while `old` is still being read
+    sqlite.upsert_invoices([Invoice(invoice_id="late", claim_id="c1", transaction_value=1.0)])
+    assert sqlite.version == old.version + 2 and len(sqlite.current) == 151
+
+    assert _dump(old.query(q, limit=10_000)[0]) == before
+    assert old.query(ResultQuery(status=["OVERPAID"]))[1] == memory.query_results(ResultQuery(status=["OVERPAID"]))[1]
+    assert old.orphan_invoices(0, 10) == memory.current.orphan_invoices(0, 10)
+    exported = first_batch + [row for batch in stream for row in batch]
+    assert exported == [row for batch in memory.current.iter_rows(ResultQuery(), 50) for row in batch]
@@ -0,0 +1,45 @@
+from datetime import date
+
+import numpy as np
+
+from app.models.claim import Claim
+from app.models.invoice import Invoice
+from app.utils.store import KeyTable, ClaimStore, InvoiceStore
+
+
+def test_key_table_interns_and_looks_up():
+    table = KeyTable()
+    codes = table.intern(["c1", "c2", "c1", "ü-3"])
+    assert codes.tolist() == [0, 1, 0, 2]
+    assert table[2] == "ü-3"
+
+    assert table.intern(["c3", "c2"]).tolist() == [3, 1]
+    assert table.lookup(["c2", "missing", "c3"]).tolist() == [1, -1, 3]
+    assert len(table) == 4
+
+
+def test_key_table_resolves_hash_collisions(monkeypatch):
+    import app.utils.store as store
+    monkeypatch.setattr(store, "_hash", lambda ids: np.zeros(len(ids), dtype=np.uint64))
+
+    table = KeyTable()
+    assert table.intern(["a", "b", "c"]).tolist() == [0, 1, 2]
+    assert table.lookup(["c", "b", "a", "d"]).tolist() == [2, 1, 0, -1]
+
+
+def test_stores_round_trip_models():
+    claims = ClaimStore.from_models([
+        Claim(claim_id="c1", patient_id=7, date_of_service="2023-03-04", charges_amount=100.1),
+    ])
+    assert claims.date_of_service.dtype == np.int32
+    assert claims.charges_cents.tolist() == [10010]
+    assert claims[0] == Claim(claim_id="c1", patient_id=7, date_of_service=date(2023, 3, 4), charges_amount=100.1)
+
+    invoices = InvoiceStore.from_models([
+        Invoice(invoice_id="i1", claim_id="c9", transaction_value=-5.5),
+        Invoice(invoice_id="i2", claim_id="c1", transaction_value=1.0),
+    ]).rekey(claims.keys)
+    assert invoices.keys is claims.keys
+    assert invoices.key.tolist() == [1, 0]
+    assert invoices[0].claim_id == "c9"
+    assert invoices[0].transaction_value == -5.5
@@ -19,8 +19,10 @@ export const useUploadClaims = () => {
     return useMutation({
         mutationKey: ["uploadClaims"],
         mutationFn: async (formData: FormData) => {
+            // wait=true: block on the background upload job and return its result
             const { data } = await apiClient.post<UploadResponse>("/upload", formData, {
                 headers: { "Content-Type": "multipart/form-data" },
+                params: { wait: true },
             });
             return data;
         },